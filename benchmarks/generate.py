@@ -0,0 +1,131 @@
+# Copyright (c) 2022-2023 - University of Liège
+# Author : Anass Yarroudh (ayarroudh@uliege.be), GeoScITY Lab of ULiege
+# This file is distributed under the BSD-3 licence. See LICENSE file for complete text of the license.
+
+# Seeded synthetic data for the benchmarks: building footprints, LAS point clouds and EPT indexes.
+# The same seed and scale always give the same data, so results can be compared between versions.
+
+import os
+import json
+import numpy as np
+import geopandas as gpd
+import shapely
+
+CRS = 31370
+ORIGIN = np.array([200000.0, 150000.0])
+BUILDINGS_PER_DISTRICT = 2000
+EPT_SCALE = 0.01
+
+def footprints(n: int, seed: int = 0, spacing: float = 25.0):
+    # n rotated rectangular buildings with a height, grouped in districts with open land between them
+    rng = np.random.default_rng(seed)
+    extent = spacing * np.sqrt(n) * 1.5
+    districts = max(1, n // BUILDINGS_PER_DISTRICT)
+    centers = rng.uniform(0, extent, (districts, 2))
+    spread = spacing * np.sqrt(min(n, BUILDINGS_PER_DISTRICT)) / 3
+    xy = ORIGIN + centers[rng.integers(0, districts, n)] + rng.normal(0, spread, (n, 2))
+
+    # Corners of each rectangle from its center, size and orientation
+    width, depth = rng.uniform(6, 25, n), rng.uniform(6, 18, n)
+    angle = rng.uniform(0, np.pi, n)
+    u = np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    v = np.stack([-u[:, 1], u[:, 0]], axis=1)
+    signs = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1], [-1, -1]], dtype=np.float64) / 2
+    corners = xy[:, None, :] + signs[None, :, :1] * width[:, None, None] * u[:, None, :] + signs[None, :, 1:] * depth[:, None, None] * v[:, None, :]
+
+    return gpd.GeoDataFrame({"id": np.arange(n), "height": rng.uniform(3, 30, n).round(2)}, geometry=shapely.polygons(corners), crs=f"EPSG:{CRS}")
+
+def pointcloud(buildings, density: float = 4.0, max_points: int = 2_000_000, seed: int = 0):
+    # Ground points (class 2) over the extent and roof points (class 6) on the buildings, as a PDAL
+    # structured array. The density (points/m²) is lowered so that the total stays under max_points.
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = buildings.total_bounds
+    areas = buildings.area.to_numpy()
+    ground_area = (maxx - minx) * (maxy - miny)
+    density = min(density, max_points / (ground_area + areas.sum()))
+
+    ground = rng.poisson(density * ground_area)
+    roofs = rng.poisson(density * areas)
+    points = np.zeros(ground + roofs.sum(), dtype=[("X", "<f8"), ("Y", "<f8"), ("Z", "<f8"), ("Classification", "u1")])
+    points["X"][:ground] = rng.uniform(minx, maxx, ground)
+    points["Y"][:ground] = rng.uniform(miny, maxy, ground)
+    points["Z"][:ground] = rng.normal(0, 0.2, ground)
+    points["Classification"][:ground] = 2
+
+    # Roof points are sampled in the parallelogram spanned by the first two edges of each rectangle
+    corners = shapely.get_coordinates(buildings.geometry.values).reshape(len(buildings), 5, 2)
+    owner = np.repeat(np.arange(len(buildings)), roofs)
+    s, t = rng.uniform(0, 1, (2, len(owner)))
+    origin, first, second = corners[owner, 0], corners[owner, 1] - corners[owner, 0], corners[owner, 3] - corners[owner, 0]
+    roof = origin + s[:, None] * first + t[:, None] * second
+    points["X"][ground:], points["Y"][ground:] = roof[:, 0], roof[:, 1]
+    points["Z"][ground:] = buildings["height"].to_numpy()[owner] + rng.normal(0, 0.1, len(owner))
+    points["Classification"][ground:] = 6
+    return points[rng.permutation(len(points))]
+
+def write_las(points, filename):
+    import pdal
+    pipeline = pdal.Pipeline(json.dumps({"pipeline": [{"type": "writers.las", "filename": filename, "a_srs": f"EPSG:{CRS}"}]}), arrays=[points])
+    pipeline.execute()
+
+def write_ept(points, path, max_node_points: int = 100_000, max_depth: int = 10):
+    # Binary EPT index of the points: every node keeps up to max_node_points of the points in its cube
+    # and passes the rest down to its children, like Entwine does
+    for folder in ("ept-data", "ept-hierarchy", "ept-sources"):
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    mins = np.array([points[d].min() for d in "XYZ"])
+    size = max(points[d].max() - points[d].min() for d in "XYZ") + 1.0
+    center = mins + size / 2
+    schema = [{"name": d, "type": "signed", "size": 4, "scale": EPT_SCALE, "offset": float(np.round(c))} for d, c in zip("XYZ", center)]
+    schema.append({"name": "Classification", "type": "unsigned", "size": 1})
+    dtype = [("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("Classification", "u1")]
+
+    hierarchy = {}
+    remaining = np.arange(len(points))
+    for depth in range(max_depth + 1):
+        cell = size / 2 ** depth
+        keys = np.stack([np.minimum((points[d][remaining] - mins[i]) // cell, 2 ** depth - 1).astype(np.int64) for i, d in enumerate("XYZ")], axis=1)
+        unique, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+
+        # Points sorted by node, in their (random) order within each node
+        order = np.argsort(inverse, kind="stable")
+        starts = np.cumsum(counts) - counts
+        keep = np.zeros(len(remaining), dtype=bool)
+        for node, key in enumerate(unique):
+            kept = counts[node] if depth == max_depth else min(counts[node], max_node_points)
+            taken = order[starts[node]:starts[node] + kept]
+            keep[taken] = True
+            selected = remaining[taken]
+            raw = np.empty(len(selected), dtype=dtype)
+            for i, d in enumerate("XYZ"):
+                raw[d] = np.round((points[d][selected] - schema[i]["offset"]) / EPT_SCALE)
+            raw["Classification"] = points["Classification"][selected]
+            name = f"{depth}-{key[0]}-{key[1]}-{key[2]}"
+            raw.tofile(os.path.join(path, "ept-data", f"{name}.bin"))
+            hierarchy[name] = len(selected)
+        remaining = remaining[~keep]
+        if not len(remaining):
+            break
+
+    with open(os.path.join(path, "ept-hierarchy", "0-0-0-0.json"), "w") as f:
+        json.dump(hierarchy, f)
+    bounds = mins.tolist() + (mins + size).tolist()
+    ept = {
+        "bounds": bounds,
+        "boundsConforming": [float(points[d].min()) for d in "XYZ"] + [float(points[d].max()) for d in "XYZ"],
+        "dataType": "binary",
+        "hierarchyType": "json",
+        "points": len(points),
+        "schema": schema,
+        "span": 128,
+        "srs": {"authority": "EPSG", "horizontal": str(CRS)},
+        "version": "1.1.0",
+    }
+    with open(os.path.join(path, "ept.json"), "w") as f:
+        json.dump(ept, f)
+    with open(os.path.join(path, "ept-build.json"), "w") as f:
+        json.dump({"software": "benchmark stub"}, f)
+    with open(os.path.join(path, "ept-sources", "list.json"), "w") as f:
+        json.dump([], f)
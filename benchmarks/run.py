@@ -0,0 +1,340 @@
+# Copyright (c) 2022-2023 - University of Liège
+# Author : Anass Yarroudh (ayarroudh@uliege.be), GeoScITY Lab of ULiege
+# This file is distributed under the BSD-3 licence. See LICENSE file for complete text of the license.
+
+# Benchmarks of Optim3D's own overhead on synthetic data. Entwine and GeoFlow are replaced by the stubs
+# in benchmarks/bin, so that only the work done by Optim3D is measured. Usage:
+#
+#   python benchmarks/run.py run --scale 10k --scale 100k --output results.json
+#   python benchmarks/run.py compare before.json after.json
+
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import subprocess
+import statistics
+import click
+import numpy as np
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(ROOT, "optim3d"))
+import generate
+
+SCENARIOS = ["startup", "quadtree", "knn", "index2d", "router", "tile3d", "order", "reconstruct", "post"]
+
+# Modules that must not be imported to start the CLI or run prepare
+HEAVY_MODULES = ["geopandas", "pandas", "osmnx", "pdal", "shapely", "psutil"]
+
+# Size of the nearest neighbour benchmark: points in the tree, batched queries, single queries
+# on the object QuadTree, queries checked against brute force, and radius of the circle queries
+KNN_POINTS = 1_000_000
+KNN_QUERIES = 100_000
+KNN_SINGLE_QUERIES = 1_000
+KNN_CHECKED = 50
+KNN_RADIUS = 10.0
+
+def parse_scale(value) -> int:
+    # 10k, 2.5M or 5000
+    value = value.strip().lower()
+    factor = {"k": 1_000, "m": 1_000_000}.get(value[-1], 1)
+    return int(float(value.rstrip("km")) * factor)
+
+class Workspace(object):
+    # Synthetic data and output folder of one scale. Data is generated on first use, outside of the
+    # timed sections, and reused by the following scenarios.
+    def __init__(self, path, buildings: int, seed: int, max_points: int, geof_delay: float, startup_threshold: float = 0.5):
+        self.path = os.path.abspath(path)
+        self.buildings = buildings
+        self.seed = seed
+        self.max_points = max_points
+        self.geof_delay = geof_delay
+        self.startup_threshold = startup_threshold
+        self.output = os.path.join(self.path, "output")
+        self.steps = set()
+        self._footprints = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return "<Workspace: {} buildings in {}>".format(self.buildings, self.path)
+
+    @property
+    def footprints(self):
+        if self._footprints is None:
+            self._footprints = generate.footprints(self.buildings, self.seed)
+        return self._footprints
+
+    def environment(self, env=None):
+        return dict(os.environ, PATH=os.path.join(BENCHMARKS, "bin") + os.pathsep + os.environ.get("PATH", ""), PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""), **(env or {}))
+
+    def optim3d(self, *args, env=None):
+        # Run a command of this working tree with the stubs on the PATH, returns its wall time
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-m", "optim3d.main", *args], cwd=self.path, env=self.environment(env), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            raise RuntimeError(f"optim3d {' '.join(args)} failed:\n{process.stderr[-2000:]}")
+        return elapsed
+
+    def require(self, step):
+        # Untimed preparation steps, each run once
+        if step in self.steps:
+            return
+        if step == "index2d":
+            self.optim3d("prepare", "--output", self.output)
+            self.footprints.to_file(os.path.join(self.path, "footprints.gpkg"), driver="GPKG")
+            self.optim3d("index2d", "footprints.gpkg", "--output", self.output)
+        elif step == "index3d":
+            generate.write_las(generate.pointcloud(self.footprints, max_points=self.max_points, seed=self.seed), os.path.join(self.path, "pointcloud.las"))
+            self.optim3d("index3d", "pointcloud.las", "--output", self.output)
+        elif step == "tile3d":
+            self.require("index2d")
+            self.require("index3d")
+            self.optim3d("tile3d", "--output", self.output)
+        elif step == "reconstruct":
+            self.require("tile3d")
+            self.reconstruct()
+        self.steps.add(step)
+
+    def reconstruct(self):
+        return self.optim3d("reconstruct", "--output", self.output, "--force", env={"GEOF_STUB_SECONDS_PER_BUILDING": str(self.geof_delay)})
+
+    def tiles(self, folder, suffix) -> int:
+        return sum(f.endswith(suffix) for f in os.listdir(os.path.join(self.output, folder)))
+
+def bench_startup(ws, repeat):
+    # Start-up of the CLI, which must stay under the threshold without importing the heavy dependencies
+    check = "import sys, optim3d.main; print(','.join(m for m in %r if m in sys.modules))" % HEAVY_MODULES
+    loaded = subprocess.run([sys.executable, "-c", check], cwd=ws.path, env=ws.environment(), capture_output=True, text=True).stdout.strip()
+    for name, args in (("startup[help]", ["--help"]), ("startup[prepare]", ["prepare", "--output", os.path.join(ws.path, "startup")])):
+        times = [ws.optim3d(*args) for _ in range(max(repeat, 5))]
+        passed = statistics.median(times) <= ws.startup_threshold and not loaded
+        yield name, times, {"threshold": ws.startup_threshold, "heavy_modules": loaded.split(",") if loaded else [], "passed": passed}
+
+def bench_quadtree(ws, repeat):
+    from utils import Bounds, ArrayQuadTree, WeightedKdTree, building_costs
+    centroids = np.column_stack([ws.footprints.centroid.x, ws.footprints.centroid.y])
+    minx, miny, maxx, maxy = ws.footprints.total_bounds
+    bounds = Bounds(minx, miny, maxx - minx, maxy - miny)
+    costs = building_costs(ws.footprints.geometry.values)
+
+    results = {"quadtree": [], "kdtree": []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tree = ArrayQuadTree(bounds, centroids, max_objects=3500)
+        results["quadtree"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        kdtree = WeightedKdTree(bounds, centroids, costs, max_weight=3500 * costs.mean())
+        results["kdtree"].append(time.perf_counter() - start)
+    yield "quadtree", results["quadtree"], {"leaves": len(tree.leaves())}
+    yield "quadtree[cost]", results["kdtree"], {"leaves": len(kdtree.leaves())}
+
+def bench_knn(ws, repeat):
+    # Nearest neighbour and circle queries on KNN_POINTS points of the synthetic point cloud (in process):
+    # batched on the ArrayQuadTree, and one query at a time on the object QuadTree. Fails if a sample of
+    # the queries does not match brute force.
+    from utils import Bounds, Point, QuadTree, ArrayQuadTree
+    cloud = generate.pointcloud(ws.footprints, max_points=KNN_POINTS, seed=ws.seed)
+    points = np.column_stack([cloud["X"], cloud["Y"]])
+    minx, miny, maxx, maxy = ws.footprints.total_bounds
+    bounds = Bounds(minx, miny, maxx - minx, maxy - miny)
+    rng = np.random.default_rng(ws.seed)
+    queries = np.column_stack([rng.uniform(minx, maxx, KNN_QUERIES), rng.uniform(miny, maxy, KNN_QUERIES)])
+    tree = ArrayQuadTree(bounds, points, max_objects=64, max_level=12)
+    objects = QuadTree(bounds, max_objects=64, max_level=12)
+    for i, (x, y) in enumerate(points.tolist()):
+        objects.insert(Point(x, y, i))
+
+    results = {"knn": [], "radius": [], "single": []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        distances, _ = tree.knn(queries, 10)
+        results["knn"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        pairs = tree.query_radius(queries, KNN_RADIUS)
+        results["radius"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        nearest = [objects.nearest_neighbors(Point(x, y), None, 10, 'circle') for x, y in queries[:KNN_SINGLE_QUERIES].tolist()]
+        results["single"].append(time.perf_counter() - start)
+
+    # Brute force on a sample of the queries
+    start = time.perf_counter()
+    matches = True
+    for i in rng.choice(KNN_SINGLE_QUERIES, KNN_CHECKED, replace=False):
+        brute = np.hypot(points[:, 0] - queries[i, 0], points[:, 1] - queries[i, 1])
+        matches &= np.allclose(np.sort(brute)[:10], distances[i])
+        matches &= np.allclose(np.sort(brute)[:10], [np.hypot(p.x - queries[i, 0], p.y - queries[i, 1]) for p in nearest[i]])
+        matches &= np.array_equal(np.sort(pairs[1][pairs[0] == i]), np.flatnonzero(brute <= KNN_RADIUS))
+    brute_force = KNN_CHECKED / (time.perf_counter() - start)
+
+    extra = {"points": len(points), "brute_force_queries_per_second": brute_force, "passed": bool(matches)}
+    yield "knn[batch]", results["knn"], {**extra, "queries": KNN_QUERIES, "k": 10, "queries_per_second": KNN_QUERIES / min(results["knn"])}
+    yield "knn[radius]", results["radius"], {**extra, "queries": KNN_QUERIES, "radius": KNN_RADIUS, "pairs": pairs.shape[1], "queries_per_second": KNN_QUERIES / min(results["radius"])}
+    yield "knn[best-first]", results["single"], {**extra, "queries": KNN_SINGLE_QUERIES, "k": 10, "queries_per_second": KNN_SINGLE_QUERIES / min(results["single"])}
+
+def bench_index2d(ws, repeat):
+    ws.require("index2d")
+    yield "index2d", [ws.optim3d("index2d", "footprints.gpkg", "--output", ws.output) for _ in range(repeat)], {"tiles": ws.tiles("footprint_tiles", ".shp")}
+
+def bench_router(ws, repeat):
+    # Routing of --max-points random points to the processing areas of index2d (in process)
+    import geopandas as gpd
+    from utils import TileRouter
+    ws.require("index2d")
+    boxes = gpd.read_file(os.path.join(ws.output, "processing_areas.gpkg")).bounds.to_numpy()
+    rng = np.random.default_rng(ws.seed)
+    x = rng.uniform(boxes[:, 0].min(), boxes[:, 2].max(), ws.max_points)
+    y = rng.uniform(boxes[:, 1].min(), boxes[:, 3].max(), ws.max_points)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        router = TileRouter(boxes)
+        for _ in router.groups(x, y):
+            pass
+        times.append(time.perf_counter() - start)
+    yield "router", times, {"tiles": len(boxes), "points": ws.max_points, "points_per_second": ws.max_points / min(times)}
+
+def bench_tile3d(ws, repeat):
+    ws.require("index2d")
+    ws.require("index3d")
+    with open(os.path.join(ws.output, "indexed_pointcloud", "ept.json")) as f:
+        points = json.load(f)["points"]
+    for engine in ("pipeline", "shared"):
+        times = [ws.optim3d("tile3d", "--output", ws.output, "--engine", engine, "--force") for _ in range(repeat)]
+        yield f"tile3d[{engine}]", times, {"tiles": ws.tiles("pointcloud_tiles", ".las"), "points": points, "points_per_second": points / min(times)}
+
+def evict(path):
+    # Drop the files under path from the page cache, so that the next run reads them from disk.
+    # Only clean pages can be dropped, so the files are flushed first. Does not need root.
+    for folder, _, files in os.walk(path):
+        for name in files:
+            fd = os.open(os.path.join(folder, name), os.O_RDONLY)
+            try:
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+def bench_order(ws, repeat):
+    # tile3d with a cold page cache, with the tiles run largest first or along a space-filling curve.
+    # Disk reads are the blocks read by the finished child processes; the hit ratio compares them with
+    # the EPT bytes that the tiles ask for, each node being read once by every tile that overlaps it.
+    import geopandas as gpd
+    from utils import EptIndex
+    ws.require("index2d")
+    ws.require("index3d")
+    indexed = os.path.join(ws.output, "indexed_pointcloud")
+    index = EptIndex(indexed)
+    requested = int(index.sizes[index.overlaps(gpd.read_file(os.path.join(ws.output, "processing_areas.gpkg")).bounds.to_numpy())[1]].sum())
+    points = int(index.counts.sum())
+    for order in ("size", "hilbert", "zorder"):
+        times, disk = [], []
+        for _ in range(repeat):
+            evict(indexed)
+            blocks = resource.getrusage(resource.RUSAGE_CHILDREN).ru_inblock
+            times.append(ws.optim3d("tile3d", "--output", ws.output, "--force", "--order", order))
+            disk.append(512 * (resource.getrusage(resource.RUSAGE_CHILDREN).ru_inblock - blocks))
+        read = statistics.median(disk)
+        yield f"tile3d[{order}]", times, {"points": points, "points_per_second": points / min(times), "disk_bytes": read, "requested_bytes": requested, "cache_hit_ratio": 1 - read / max(requested, 1)}
+
+def bench_reconstruct(ws, repeat):
+    ws.require("tile3d")
+    tiles = ws.tiles("pointcloud_tiles", ".las")
+    yield "reconstruct", [ws.reconstruct() for _ in range(repeat)], {"tiles": tiles, "geof_seconds": ws.geof_delay * ws.buildings}
+
+def bench_post(ws, repeat):
+    ws.require("reconstruct")
+    times = []
+    for i in range(repeat):
+        # Regenerate the CityJSON files, so that post has to process all of them again
+        if i:
+            ws.reconstruct()
+        times.append(ws.optim3d("post", "--output", ws.output))
+    size = sum(os.path.getsize(os.path.join(ws.output, "model", "cityjson", f)) for f in os.listdir(os.path.join(ws.output, "model", "cityjson")))
+    yield "post", times, {"tiles": ws.tiles(os.path.join("model", "cityjson"), ".json"), "bytes": size}
+
+def version():
+    # Package version and git commit of the working tree
+    sys.path.insert(0, ROOT)
+    from optim3d import __version__
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"version": __version__, "commit": commit or None}
+
+@click.group(help="Benchmarks of Optim3D on synthetic data, with stub Entwine and GeoFlow.")
+def cli():
+    pass
+
+@click.command()
+@click.option("--scale", "scales", multiple=True, default=["10k", "100k"], show_default=True, help="Number of buildings (10k, 1M, 5M...). Can be repeated.")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS), default=SCENARIOS, show_default=True, help="Scenarios to run. Can be repeated.")
+@click.option("--repeat", type=int, default=3, show_default=True, help="Number of timed runs of each scenario.")
+@click.option("--seed", type=int, default=0, show_default=True, help="Seed of the synthetic data.")
+@click.option("--max-points", type=int, default=2_000_000, show_default=True, help="Maximum size of the synthetic point cloud.")
+@click.option("--geof-delay", type=float, default=0.0, show_default=True, help="Seconds the stub GeoFlow spends per building.")
+@click.option("--startup-threshold", type=float, default=0.5, show_default=True, help="Maximum median start-up time of the CLI in seconds.")
+@click.option("--workdir", type=click.Path(), default="benchmark_data", show_default=True, help="Directory for the synthetic data and outputs, reused between runs.")
+@click.option("--output", type=click.Path(), default="benchmark_results.json", show_default=True, help="JSON file for the results.")
+def run(scales, scenarios, repeat, seed, max_points, geof_delay, startup_threshold, workdir, output):
+    """
+    Run the benchmark scenarios at each scale. Exits with status 1 if a threshold is exceeded.
+    """
+    report = {
+        **version(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": seed,
+        "results": [],
+    }
+    for scale in scales:
+        buildings = parse_scale(scale)
+        ws = Workspace(os.path.join(workdir, f"{buildings}-{seed}"), buildings, seed, max_points, geof_delay, startup_threshold)
+        for scenario in scenarios:
+            for name, times, extra in globals()[f"bench_{scenario}"](ws, repeat):
+                result = {"scenario": name, "buildings": buildings, "median": statistics.median(times), "min": min(times), "times": times, **extra}
+                report["results"].append(result)
+                click.echo(f"{name:<18} {buildings:>9} buildings  median {result['median']:8.3f} s  min {result['min']:8.3f} s  {'' if result.get('passed', True) else 'FAILED'}")
+
+        # Save after each scale, so that a long run keeps its first results
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    click.echo(f"Results saved at: {os.path.abspath(output)}")
+    sys.exit(0 if all(result.get("passed", True) for result in report["results"]) else 1)
+
+@click.command()
+@click.argument("before", type=click.Path(exists=True))
+@click.argument("after", type=click.Path(exists=True))
+@click.option("--threshold", type=float, default=1.10, show_default=True, help="Ratio of the medians above which a scenario is reported as a regression.")
+def compare(before, after, threshold):
+    """
+    Compare two result files. Exits with status 1 if a scenario regressed.
+    """
+    with open(before) as f:
+        old = {(r["scenario"], r["buildings"]): r for r in json.load(f)["results"]}
+    with open(after) as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for result in new:
+        key = (result["scenario"], result["buildings"])
+        if key not in old:
+            continue
+        ratio = result["median"] / max(old[key]["median"], 1e-9)
+        flag = "REGRESSION" if ratio > threshold else ""
+        regressions += ratio > threshold
+        click.echo(f"{key[0]:<18} {key[1]:>9}  {old[key]['median']:8.3f} s -> {result['median']:8.3f} s  x{ratio:5.2f}  {flag}")
+    sys.exit(1 if regressions else 0)
+
+cli.add_command(run)
+cli.add_command(compare)
+
+if __name__ == "__main__":
+    cli()
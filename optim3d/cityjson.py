@@ -0,0 +1,225 @@
+# Copyright (c) 2022-2023 - University of Liège
+# Author : Anass Yarroudh (ayarroudh@uliege.be), GeoScITY Lab of ULiege
+# This file is distributed under the BSD-3 licence. See LICENSE file for complete text of the license.
+
+import os
+import re
+import sys
+import json
+import numpy as np
+
+sys.path.append(os.path.dirname(__file__))
+from profiler import span
+
+# orjson is used when it is installed, it is several times faster than json for large files
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def load(filename):
+    with open(filename, "rb") as f:
+        return orjson.loads(f.read()) if orjson else json.load(f)
+
+def dump(data, filename, pretty: bool = False):
+    # Write to a temporary file first so that an interrupted run never leaves a truncated file
+    tmp = f"{filename}.tmp"
+    with open(tmp, "wb") as f:
+        if orjson:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0))
+        else:
+            f.write(json.dumps(data, indent=2 if pretty else None, separators=None if pretty else (",", ":")).encode("utf-8"))
+    os.replace(tmp, filename)
+
+def tile_id(filename):
+    # Tile number of a tile_{i}.city.json file, or None
+    match = re.match(r"tile_(\d+)\.", os.path.basename(filename))
+    return int(match.group(1)) if match else None
+
+def namespace_ids(data, prefix):
+    # Prefix the ID of every city object, and its references in children and parents, in a single pass
+    objects = data["CityObjects"]
+    for value in objects.values():
+        for relation in ("children", "parents"):
+            if value.get(relation):
+                value[relation] = [f"{prefix}{ref}" for ref in value[relation]]
+    data["CityObjects"] = {f"{prefix}{key}": value for key, value in objects.items()}
+    return data
+
+def postprocess(filename, prefix, pretty: bool = False):
+    with span("json load"):
+        data = load(filename)
+    namespace_ids(data, prefix)
+    with span("json dump"):
+        dump(data, filename, pretty)
+
+def dumps(data) -> bytes:
+    return orjson.dumps(data) if orjson else json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+def flatten(boundaries):
+    # All vertex indices of a (nested) geometry boundary
+    for b in boundaries:
+        if isinstance(b, list):
+            yield from flatten(b)
+        else:
+            yield b
+
+def remap(boundaries, mapping):
+    return [remap(b, mapping) if isinstance(b, list) else mapping[b] for b in boundaries]
+
+def source_id(key):
+    # ID of a city object without the tile prefix added by namespace_ids
+    return re.sub(r"^T\d+_", "", key)
+
+class CityJSONMerger(object):
+    # Streams CityJSON tiles into a single CityJSON file, or a CityJSONSeq file with one
+    # CityJSONFeature per line. Only one tile is held in memory at a time. Vertices are snapped to
+    # one global transform (the translate of the first tile and the given scale) and duplicates are
+    # removed within each tile. For a single CityJSON file, the vertices are spooled to a temporary
+    # binary file and appended after the city objects.
+    # Buildings on tile borders are assigned to several tiles and reconstructed in each of them: only
+    # the first top-level object with a given source ID is kept. With the processing areas of the tiles
+    # ((n, 4) [minx, miny, maxx, maxy] by tile number, in the coordinates of the vertices), only the
+    # objects and vertices in the overlap of two areas can be shared by tiles, so only those are kept
+    # in memory: the vertices there are deduplicated across tiles, and the source IDs of the objects
+    # there are remembered. Without areas, every source ID is remembered and vertices are only
+    # deduplicated within each tile.
+    def __init__(self, filename, seq: bool = False, scale=None, areas=None):
+        self.filename = filename
+        self.seq = seq
+        self.scale = scale
+        self.areas = None if areas is None else np.asarray(areas, dtype=np.float64).reshape(-1, 4)
+        self.transform = None
+        self.objects = 0
+        self.duplicates = 0
+        self.vertices_in = 0
+        self.vertices_out = 0
+        self.sources = set()
+        self.shared = {}
+        self.tmp = f"{filename}.tmp"
+        self.file = open(self.tmp, "wb")
+        self.spool = None if seq else open(f"{filename}.vertices", "w+b")
+
+    def __repr__(self):
+        return "<CityJSONMerger: {}, {} objects>".format(self.filename, self.objects)
+
+    def header(self, data):
+        scale = data.get("transform", {}).get("scale", [0.001, 0.001, 0.001]) if self.scale is None else [self.scale] * 3
+        translate = data.get("transform", {}).get("translate", [0, 0, 0])
+        self.transform = {"scale": list(scale), "translate": list(translate)}
+
+        header = {"type": "CityJSON", "version": data.get("version", "2.0"), "transform": self.transform}
+        if "metadata" in data and "referenceSystem" in data["metadata"]:
+            header["metadata"] = {"referenceSystem": data["metadata"]["referenceSystem"]}
+        if self.seq:
+            header["CityObjects"] = {}
+            header["vertices"] = []
+            self.file.write(dumps(header) + b"\n")
+        else:
+            self.file.write(dumps(header)[:-1] + b',"CityObjects":{')
+
+    def snap(self, data):
+        # Vertices of a tile in the global transform, deduplicated: returns (unique vertices, tile index -> unique
+        # index) and the real coordinates of the vertices
+        vertices = np.asarray(data.get("vertices", []), dtype=np.float64).reshape(-1, 3)
+        if "transform" in data:
+            vertices = vertices * data["transform"]["scale"] + data["transform"]["translate"]
+        snapped = np.round((vertices - self.transform["translate"]) / self.transform["scale"]).astype(np.int64)
+        unique, inverse = np.unique(snapped, axis=0, return_inverse=True)
+        return unique, inverse.reshape(-1), vertices
+
+    def border(self, vertices, tile):
+        # Vertices of a tile that are also in the processing area of another tile, or None if that is unknown
+        if self.areas is None or tile is None or not 0 <= tile < len(self.areas):
+            return None
+        margin = max(self.transform["scale"][:2])
+        box = self.areas[tile]
+        others = np.flatnonzero((self.areas[:, 0] <= box[2]) & (self.areas[:, 2] >= box[0]) & (self.areas[:, 1] <= box[3]) & (self.areas[:, 3] >= box[1]))
+        inside = np.zeros(len(vertices), dtype=bool)
+        for other in others[others != tile]:
+            minx, miny, maxx, maxy = self.areas[other]
+            inside |= (vertices[:, 0] >= minx - margin) & (vertices[:, 0] <= maxx + margin) & (vertices[:, 1] >= miny - margin) & (vertices[:, 1] <= maxy + margin)
+        return inside
+
+    def add(self, filename, prefix=None, tile=None):
+        data = load(filename)
+        if prefix is not None:
+            namespace_ids(data, prefix)
+        if self.transform is None:
+            self.header(data)
+
+        unique, inverse, vertices = self.snap(data)
+        border = self.border(vertices, tile)
+        self.vertices_in += len(inverse)
+        objects = data["CityObjects"]
+
+        # Top-level objects with their children and vertex indices, without those already merged from another tile
+        features = []
+        for key, value in objects.items():
+            if any(parent in objects for parent in value.get("parents", [])):
+                continue
+            members = [key]
+            for member in members:
+                members.extend(c for c in objects[member].get("children", []) if c in objects)
+            indices = [i for m in members for g in objects[m].get("geometry", []) for i in flatten(g["boundaries"])]
+            if border is None or border[indices].any():
+                source = source_id(key)
+                if source in self.sources:
+                    self.duplicates += 1
+                    continue
+                self.sources.add(source)
+            features.append((key, members, indices))
+
+        if self.seq:
+            # One feature per top-level object with its children, with its own vertex list
+            for key, members, indices in features:
+                used, local = np.unique(inverse[indices].astype(np.int64), return_inverse=True)
+                mapping = dict(zip(indices, local.reshape(-1).tolist()))
+                feature = {"type": "CityJSONFeature", "id": key, "CityObjects": {m: self.remap_object(objects[m], mapping) for m in members}, "vertices": unique[used].tolist()}
+                self.file.write(dumps(feature) + b"\n")
+                self.objects += len(members)
+                self.vertices_out += len(used)
+        else:
+            # Vertices in the overlap of two processing areas are looked up among those of the previous tiles,
+            # the others are new
+            used = np.unique(inverse[[i for _, _, indices in features for i in indices]].astype(np.int64))
+            numbers = np.full(len(unique), -1, dtype=np.int64)
+            shared = np.zeros(len(unique), dtype=bool)
+            if border is not None:
+                shared[inverse[border]] = True
+                for u in used[shared[used]].tolist():
+                    numbers[u] = self.shared.get(unique[u].tobytes(), -1)
+            fresh = used[numbers[used] < 0]
+            numbers[fresh] = self.vertices_out + np.arange(len(fresh))
+            for u in fresh[shared[fresh]].tolist():
+                self.shared[unique[u].tobytes()] = int(numbers[u])
+            unique[fresh].astype("<i8").tofile(self.spool)
+            self.vertices_out += len(fresh)
+
+            mapping = numbers[inverse].tolist()
+            for key, members, _ in features:
+                for member in members:
+                    self.file.write((b"," if self.objects else b"") + dumps(member) + b":" + dumps(self.remap_object(objects[member], mapping)))
+                    self.objects += 1
+
+    def remap_object(self, value, mapping):
+        for geometry in value.get("geometry", []):
+            geometry["boundaries"] = remap(geometry["boundaries"], mapping)
+        return value
+
+    def close(self, chunk_size: int = 1_000_000):
+        if not self.seq:
+            if self.transform is None:
+                self.header({})
+            self.file.write(b'},"vertices":[')
+            self.spool.flush()
+            size = os.path.getsize(self.spool.name)
+            vertices = np.memmap(self.spool.name, dtype="<i8", mode="r").reshape(-1, 3) if size else np.empty((0, 3), dtype=np.int64)
+            for start in range(0, len(vertices), chunk_size):
+                self.file.write((b"," if start else b"") + dumps(vertices[start:start + chunk_size].tolist())[1:-1])
+            self.file.write(b"]}")
+            del vertices
+            self.spool.close()
+            os.remove(self.spool.name)
+        self.file.close()
+        os.replace(self.tmp, self.filename)
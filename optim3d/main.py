@@ -4,21 +4,37 @@
 
 import click
 import json
-import copy
 import time
 import os
 import tempfile
-import geopandas as gpd
-import osmnx as ox
-import multiprocessing
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import glob
+import functools
+import importlib.util
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import shutil
-import psutil
 import sys
+import socket
 import xml.etree.ElementTree as ET
 
 sys.path.append(os.path.dirname(__file__))
-from utils import OrderedGroup, Point, Bounds, QuadTree, tile, run_command_in_terminal
+from scheduler import (
+    AdmissionController, StagePipeline,
+    PDAL_BYTES_PER_POINT, GEOFLOW_MEMORY_FACTOR, GEOFLOW_BASE_MEMORY, CITYJSON_MEMORY_FACTOR,
+)
+from manifest import Manifest
+from profiler import Profiler
+from cityjson import postprocess, tile_id, CityJSONMerger
+from workqueue import WorkQueue, work
+from utils import (
+    configure_proj, OrderedGroup, run_command_in_terminal,
+    Bounds, ArrayQuadTree, WeightedKdTree, load_tree, save_arrays, CURVES, curve_keys, box_centers,
+    EptDensity, building_costs, tile_extents, processing_areas,
+    TILE_FORMATS, write_footprint_tile, footprint_hashes, footprint_ids, tile_signatures, update_tile_ids, find_tile,
+    FOOTPRINT_CHUNK_SIZE, footprint_centroids, spool_footprints, write_spooled_tile,
+    POINTCLOUD_FORMATS, tile, EptIndex, tile_ept_nodes, merge_tile_parts, points_crs,
+    las_files, tile_las_file, DIRECT_CHUNK_POINTS, DIRECT_BUFFER_POINTS, reconstruct_tile, log_reconstruct_times,
+)
 
 from rich.console import Console
 from rich.progress import Progress
@@ -34,10 +50,14 @@ Licensed under the BSD 3-Clause License.
 
 @click.group(cls=OrderedGroup, help="CLI tool to manage full optimized reconstruction of large-scale 3D building models.")
 def cli():
-    pass
+    configure_proj()
 
 console = Console()
 
+# Shared by every command
+profile_option = click.option('--profile', is_flag=True, default=False, help="Record the time, CPU, memory and I/O of each step and tile to profile_<command>.json and a Chrome trace.")
+order_option = click.option('--order', type=click.Choice(["size"] + CURVES), default="size", show_default=True, help="Run the tiles largest first, or along a Hilbert or Z-order curve through their centers so that consecutive tiles read nearby data.")
+
 @click.command()
 @click.option('--output', type=click.Path(), default="output", show_default=True, help="Output directory.")
 @click.option('--footprint_tiles', type=click.Path(), default="footprint_tiles", show_default=True, help="Footprint tiles directory.")
@@ -45,11 +65,13 @@ console = Console()
 @click.option('--model', type=click.Path(), default="model", show_default=True, help="Model directory.")
 @click.option('--pointcloud_tiles', type=click.Path(), default="pointcloud_tiles", show_default=True, help="Pointcloud tiles directory.")
 @click.option('--folder_structure', type=click.Path(), default="folder_structure.xml", show_default=True, help="Folder structure file.")
+@profile_option
 
-def prepare(output, footprint_tiles, indexed_pointcloud, model, pointcloud_tiles, folder_structure):
+def prepare(output, footprint_tiles, indexed_pointcloud, model, pointcloud_tiles, folder_structure, profile):
     """
     Prepare the output folder structure.
     """
+    profiler = Profiler("prepare", profile)
     os.makedirs(os.path.join(output, footprint_tiles), exist_ok=True)
     os.makedirs(os.path.join(output, indexed_pointcloud, "ept-data"), exist_ok=True)
     os.makedirs(os.path.join(output, indexed_pointcloud, "ept-hierarchy"), exist_ok=True)
@@ -81,6 +103,9 @@ def prepare(output, footprint_tiles, indexed_pointcloud, model, pointcloud_tiles
     console.print(structure)
     console.print(f"[green]\nOutput folder structure prepared at:[/green] {os.path.abspath(output)}")
     console.print(f"Please refer to [bold]{folder_structure}[/bold] for the folder structure.")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
 
 
 
@@ -93,13 +118,27 @@ def prepare(output, footprint_tiles, indexed_pointcloud, model, pointcloud_tiles
 @click.option("--quadtree-fname", type=click.Path(), default="quadtree.gpkg", show_default=True, help="Filename for the QuadTree file (forced to GPKG format).")
 @click.option("--processing-areas-fname", type=click.Path(), default="processing_areas.gpkg", show_default=True, help="Filename for the processing areas file (forced to GPKG format).")
 @click.option("--crs", type=int, help="Coordinate Reference System (EPSG).")
-@click.option("--max", type=int, default=3500, show_default=True, help="Max number of buildings per tile.")
-
-def index2d(footprints, output, folder_structure, osm, osm_save_path, quadtree_fname, processing_areas_fname, crs, max):
+@click.option("--max", type=int, default=3500, show_default=True, help="Max number of buildings per tile. With --partition cost, budget of predicted reconstruction cost per tile, in buildings of average cost.")
+@click.option("--buffer", type=float, default=10, show_default=True, help="Buffer distance around the extent of each tile for its processing area.")
+@click.option("--tile-format", type=click.Choice(list(TILE_FORMATS)), default="shp", show_default=True, help="File format of the footprint tiles.")
+@click.option("--max-workers", type=int, default=os.cpu_count(), show_default=True, help="Maximum number of workers for writing tiles.")
+@click.option("--partition", type=click.Choice(["quadtree", "cost"]), default="quadtree", show_default=True, help="Tiling scheme: QuadTree on building count, or balanced k-d split on predicted reconstruction cost (about --max average buildings per tile).")
+@click.option("--stream", is_flag=True, help="Read the footprints in chunks, in two passes, for files larger than memory.")
+@click.option("--chunk-size", type=int, default=FOOTPRINT_CHUNK_SIZE, show_default=True, help="Number of footprints read at a time with --stream.")
+@click.option("--order", type=click.Choice(CURVES), default=None, help="Sort the buildings of each tile along a Hilbert or Z-order curve through their centroids.")
+@click.option("--update", is_flag=True, help="Only rewrite the tiles whose footprints changed since the previous run, and mark them for the next stages.")
+@profile_option
+
+def index2d(footprints, output, folder_structure, osm, osm_save_path, quadtree_fname, processing_areas_fname, crs, max, buffer, tile_format, max_workers, partition, stream, chunk_size, order, update, profile):
     """
     QuadTree indexing and tiling of 2D building footprints.
     """
     start_time = time.time()
+    profiler = Profiler("index2d", profile)
+
+    # Heavy dependencies are only imported by the commands that use them, to keep the CLI fast to start
+    import geopandas as gpd
+    import pandas as pd
 
     # Print header
     console.print(f"{copyright}")
@@ -116,13 +155,43 @@ def index2d(footprints, output, folder_structure, osm, osm_save_path, quadtree_f
     root = tree.getroot()
     tiles_path = root.find("footprint_tiles").text
 
+    # GeoParquet tiles need pyarrow
+    if tile_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        console.print("[bold red]Error: pyarrow is required for GeoParquet tiles. Please install it using 'pip install pyarrow'[/bold red]")
+        return
+
     # Ensure output directories exist
     os.makedirs(output, exist_ok=True)
     tiles_full_path = os.path.join(output, tiles_path)
     os.makedirs(tiles_full_path, exist_ok=True)
 
+    # The streaming mode reads the footprint file twice, so it cannot be used with OSM
+    if stream and osm != (-1, -1, -1, -1):
+        console.print("[bold red]Error: --stream needs a footprints file, it cannot be used with --osm.[/bold red]")
+        return
+
+    # Updates compare every footprint with the previous run, and only keep the QuadTree leaves that did not change
+    if update and (stream or partition != "quadtree"):
+        console.print("[bold red]Error: --update only works with --partition quadtree, without --stream.[/bold red]")
+        return
+
+    # Point density of the EPT index if it exists, for the predicted reconstruction costs of the cost partition
+    indexed_full_path = os.path.join(output, root.find("indexed_pointcloud").text)
+    ept_density = EptDensity(indexed_full_path) if partition == "cost" and os.path.exists(os.path.join(indexed_full_path, "ept.json")) else None
+
     # Load building footprints (from OSM or file)
-    if osm != (-1, -1, -1, -1):
+    if stream:
+        # First pass: only the centroids and costs are kept in memory
+        with profiler.span("read footprints"):
+            try:
+                centroids, building_cost, bounds, crs = footprint_centroids(footprints, chunk_size, crs, ept_density)
+            except ValueError as e:
+                console.print(f"[bold red]Error: {e}[/bold red]")
+                return
+        width, height = bounds[2] - bounds[0], bounds[3] - bounds[1]
+
+    elif osm != (-1, -1, -1, -1):
+        import osmnx as ox
         console.print(f"[bold cyan]Downloading building footprints from OSM for bounding box: {osm}[/bold cyan]")
         buildings = ox.features.features_from_bbox(osm, tags={"building": True}).dropna(subset=["geometry"])
         buildings.crs = "EPSG:4326"
@@ -132,57 +201,204 @@ def index2d(footprints, output, folder_structure, osm, osm_save_path, quadtree_f
             console.print(f"[green]Saved OSM footprints to {osm_save_path}[/green]")
 
     else:
-        buildings = gpd.read_file(footprints, encoding="utf-8")
-
-    # Handle CRS conversion
-    buildings = buildings.to_crs(epsg=crs) if crs else buildings
-    crs = buildings.crs.to_epsg()  # Ensure CRS is numeric EPSG format
-
-    # Compute centroids (vectorized for performance)
-    if buildings.crs.is_geographic:
-        buildings = buildings.to_crs(epsg=3857)  # Re-project to a projected CRS (e.g., EPSG:3857)
-    buildings["centroid"] = buildings.geometry.centroid
-    centroids = buildings.centroid.apply(lambda p: [p.x, p.y]).tolist()
-
-    # Compute bounding box
-    bounds = buildings.total_bounds  # [minx, miny, maxx, maxy]
-    width, height = bounds[2] - bounds[0], bounds[3] - bounds[1]
-
-    # Build QuadTree with progress bar
-    quadTree = QuadTree(Bounds(bounds[0], bounds[1], width, height), max_objects=max)
-
-    with Progress() as progress:
-        task = progress.add_task("[cyan]Building QuadTree", total=len(centroids))
-        for point in centroids:
-            quadTree.insert(Point(*point))
-            progress.update(task, advance=1)
-
-    # Export QuadTree and read it back
+        with profiler.span("read footprints"):
+            buildings = gpd.read_file(footprints, encoding="utf-8")
+
+    if not stream:
+        # Handle CRS conversion
+        buildings = buildings.to_crs(epsg=crs) if crs else buildings
+        crs = buildings.crs.to_epsg()  # Ensure CRS is numeric EPSG format
+
+        # Compute centroids (vectorized for performance)
+        if buildings.crs.is_geographic:
+            buildings = buildings.to_crs(epsg=3857)  # Re-project to a projected CRS (e.g., EPSG:3857)
+        with profiler.span("hash footprints"):
+            buildings["hash"] = footprint_hashes(buildings)
+        hashes = buildings["hash"].to_numpy()
+        buildings["OIDN"] = footprint_ids(hashes)
+        buildings["centroid"] = buildings.geometry.centroid
+        centroids = np.column_stack([buildings["centroid"].x, buildings["centroid"].y])
+
+        # Compute bounding box
+        bounds = buildings.total_bounds  # [minx, miny, maxx, maxy]
+        width, height = bounds[2] - bounds[0], bounds[3] - bounds[1]
+
+        # Predicted reconstruction cost per building, using the point density of the EPT index if it exists
+        density = None
+        if ept_density is not None:
+            try:
+                ept_density.check_crs(buildings.crs.to_epsg())
+            except ValueError as e:
+                console.print(f"[bold red]Error: {e}[/bold red]")
+                return
+            density = ept_density.density(centroids)
+        buildings["cost"] = building_costs(buildings.geometry.values, density)
+        building_cost = buildings["cost"].to_numpy()
+
+    # The tree is also saved as .npz next to the GPKG. It is loaded instead of rebuilt when the footprints,
+    # the point cloud (for cost partitions) and the parameters did not change since the last run.
     quadtree_path = os.path.join(output, quadtree_fname)
-    quadTree.create().to_file(quadtree_path, driver="GPKG")
-    boundings = gpd.read_file(quadtree_path)
-    boundings.crs = buildings.crs
+    tree_path = os.path.splitext(quadtree_path)[0] + ".npz"
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+    inputs = {"footprints": footprints} if osm == (-1, -1, -1, -1) else {}
+    if ept_density is not None:
+        inputs["ept"] = os.path.join(indexed_full_path, "ept.json")
+    params = {"partition": partition, "max": max, "crs": crs}
+
+    # The tiles of the previous run are described in a second .npz: the leaf box, number of buildings
+    # and signature of each tile, and the hash of every footprint. With --update, they are kept unless
+    # the parameters changed or the footprints extend beyond the previous QuadTree.
+    state_path = os.path.splitext(quadtree_path)[0] + "_tiles.npz"
+    state_params = {"partition": partition, "max": max, "crs": crs, "tile_format": tile_format, "order": order}
+    previous = None
+    if update and os.path.exists(state_path):
+        with np.load(state_path) as data:
+            previous = {name: data[name] for name in data.files}
+        x, y, width, height = previous["root"]
+        if json.loads(str(previous["params"])) != state_params:
+            console.print("The parameters changed since the previous run, all the tiles are written again.")
+            previous = None
+        elif bounds[0] < x or bounds[1] < y or bounds[2] > x + width or bounds[3] > y + height:
+            console.print("The footprints extend beyond the QuadTree of the previous run, all the tiles are written again.")
+            previous = None
+    elif update:
+        console.print(f"No previous run found in {os.path.abspath(output)}, all the tiles are written.")
+
+    # Build QuadTree from all centroids at once, or a k-d tree balanced on predicted cost
+    with console.status("[cyan]Building QuadTree"), profiler.span("quadtree"):
+        if inputs and manifest.is_current("index2d", "quadtree", inputs, params):
+            quadTree = load_tree(tree_path)
+        else:
+            if previous is not None:
+                # The leaves of a QuadTree only depend on the points inside them, so building it again in
+                # the previous root box gives the same leaves where nothing changed, and splits or merges
+                # the leaves whose number of buildings crossed --max
+                quadTree = ArrayQuadTree(Bounds(*previous["root"]), centroids, max_objects=max, max_level=int(previous["max_level"]))
+            elif partition == "cost":
+                quadTree = WeightedKdTree(Bounds(bounds[0], bounds[1], width, height), centroids, building_cost, max_weight=max * building_cost.mean())
+            else:
+                quadTree = ArrayQuadTree(Bounds(bounds[0], bounds[1], width, height), centroids, max_objects=max)
+            quadTree.save(tree_path)
+            if inputs:
+                manifest.record("index2d", "quadtree", "done", inputs, params, [tree_path])
+                manifest.save()
+
+    # Export QuadTree, the leaf boxes are joined with the buildings directly
+    with profiler.span("quadtree export"):
+        boundings = quadTree.create()
+        boundings.crs = f"EPSG:{crs}" if stream else buildings.crs
+        boundings.to_file(quadtree_path, driver="GPKG")
+
+    if stream:
+        # Second pass: each chunk is joined with the tiles and its buildings appended to their tile spool
+        parts_path = os.path.join(tiles_full_path, ".parts")
+        shutil.rmtree(parts_path, ignore_errors=True)
+        os.makedirs(parts_path)
+        with console.status("[cyan]Joining footprints with tiles"), profiler.span("sjoin"):
+            extent, costs = spool_footprints(footprints, boundings, building_cost, parts_path, chunk_size, crs)
+        write = functools.partial(write_spooled_tile, keys=curve_keys(centroids, order, bounds) if order else None)
+        jobs = {node: (write, os.path.join(parts_path, f"tile_{node}.pkl")) for node in extent.index}
 
-    # Spatial join (efficient replacement for nested loops)
-    buildings = buildings.sjoin(boundings, how="left", predicate="intersects")
-    buildings.rename(columns={"index_right": "node"}, inplace=True)
+    else:
+        # Buildings keep their order within each tile, so sorting them along the curve sorts every tile
+        if order:
+            buildings = buildings.iloc[np.argsort(curve_keys(centroids, order, bounds), kind="stable")]
+
+        # Spatial join (efficient replacement for nested loops)
+        with profiler.span("sjoin"):
+            buildings = buildings.sjoin(boundings, how="left", predicate="intersects")
+            buildings.rename(columns={"index_right": "node"}, inplace=True)
+
+        # Group buildings by node and create bounding boxes
+        costs = buildings.groupby("node")["cost"].sum()
+        grouped = buildings.drop(columns=["centroid", "cost", "hash"]).groupby("node")
+        extent = tile_extents(buildings.bounds, buildings["node"])
+        jobs = {node: (write_footprint_tile, group) for node, group in grouped}
+
+    # Tiles are numbered from 0 in the order of their leaves, skipping the leaves without buildings, so
+    # that tile3d finds the processing area of each tile at the same row. With --update, a tile keeps
+    # its number if its leaf did not change.
+    leaf_boxes = quadTree.bounds[quadTree.leaves()][extent.index.to_numpy(dtype=np.int64)]
+    if previous is not None:
+        ids, kept = update_tile_ids(previous["boxes"], leaf_boxes)
+    else:
+        ids = np.arange(len(extent))
+    numbers = pd.Series(ids, index=extent.index)
+    jobs = {int(numbers[node]): job for node, job in jobs.items()}
+    costs = costs.reindex(extent.index)
+    extent.index = costs.index = pd.Index(ids, name="node")
+    extent, costs = extent.sort_index(), costs.sort_index()
+    leaf_boxes = leaf_boxes[np.argsort(ids)]
+
+    if not stream:
+        # A tile is up to date if it kept its number and has the same buildings as in the previous run
+        assigned = buildings["node"].notna()
+        counts, signatures = tile_signatures(buildings.loc[assigned, "hash"].to_numpy(), buildings.loc[assigned, "node"].map(numbers).to_numpy(dtype=np.int64), len(ids))
+        if previous is not None:
+            unchanged = kept.copy()
+            unchanged[kept] = (counts[ids[kept]] == previous["counts"][ids[kept]]) & (signatures[ids[kept]] == previous["signatures"][ids[kept]])
+            dirty = set(ids[~unchanged].tolist())
+            jobs = {number: job for number, job in jobs.items() if number in dirty}
+            removed = range(len(ids), len(previous["boxes"]))
+            added = np.count_nonzero(~np.isin(hashes, previous["hashes"]))
+            deleted = np.count_nonzero(~np.isin(previous["hashes"], hashes))
+            console.print(f"Footprints: {added} new or changed, {deleted} removed or changed since the previous run. Tiles: {len(jobs)} of {len(ids)} to write, {len(removed)} removed.")
+
+            # The next stages process the tiles written again, and forget the removed tiles and their outputs
+            for number in jobs:
+                manifest.invalidate("tile3d", number)
+                manifest.invalidate("reconstruct", number)
+                manifest.invalidate("post", f"tile_{number}.city.json")
+            for number in removed:
+                for path in glob.glob(os.path.join(tiles_full_path, f"tile_{number}.*")):
+                    os.remove(path)
+                manifest.invalidate("tile3d", number, remove_outputs=True)
+                manifest.invalidate("reconstruct", number, remove_outputs=True)
+                manifest.invalidate("post", f"tile_{number}.city.json", remove_outputs=True)
+        manifest.save()
+
+    # Processing areas are the buffered extent of each tile, aggregated from the building bounds
+    with profiler.span("processing areas"):
+        bbox_geoms = processing_areas(extent, buffer)
+        bbox_gdf = gpd.GeoDataFrame({"cost": costs}, geometry=bbox_geoms, index=extent.index, crs=f"EPSG:{crs}")
+        processing_areas_path = os.path.join(output, processing_areas_fname)
+        bbox_gdf.to_file(processing_areas_path, driver="GPKG")
+
+    # Remove the tiles of the other formats, so that reconstruct does not pick up an outdated tile
+    stale = [other for other in TILE_FORMATS if other != tile_format]
+    if "shp" in stale:
+        stale += ["shx", "dbf", "prj", "cpg"]
+    for node in jobs:
+        for other in stale:
+            if os.path.exists(f"{tiles_full_path}/tile_{node}.{other}"):
+                os.remove(f"{tiles_full_path}/tile_{node}.{other}")
+
+    # Save individual footprint tiles concurrently
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(profiler.wrap(write, "write tile"), group, f"{tiles_full_path}/tile_{node}.{tile_format}", tile_format): node for node, (write, group) in jobs.items()}
 
-    # Group buildings by node and create bounding boxes
-    grouped = buildings.drop(columns=["centroid"]).groupby("node")
+        with Progress() as progress:
+            task = progress.add_task("[cyan]Tiling", total=len(futures))
+            for future in as_completed(futures):
+                try:
+                    profiler.result(future.result(), futures[future])
+                except Exception as e:
+                    failed.append(futures[future])
+                    console.print(f"[bold red]Error: {e}[/bold red]")
+                finally:
+                    progress.update(task, advance=1)
 
-    bbox_geoms = grouped.apply(lambda g: g.dissolve().boundary.iloc[0].envelope.buffer(10) if not g.dissolve().boundary.empty else None)
-    bbox_gdf = gpd.GeoDataFrame(geometry=bbox_geoms, crs=f"EPSG:{crs}")
-    processing_areas_path = os.path.join(output, processing_areas_fname)
-    bbox_gdf.to_file(processing_areas_path, driver="GPKG")
+    if stream:
+        shutil.rmtree(parts_path, ignore_errors=True)
 
-    # Save individual footprint tiles
-    with Progress() as progress:
-        task = progress.add_task("[cyan]Tiling", total=len(grouped))
-        for node, group in grouped:
-            tile_path = f"{tiles_full_path}/tile_{node}.shp"
-            group['OIDN'] = range(1, len(group) + 1)
-            group.to_file(tile_path, encoding="utf-8")
-            progress.update(task, advance=1)
+    # Save the tiles for the next --update. Tiles that could not be written are saved with no buildings,
+    # so that they are written again. Streamed footprints are not hashed, so they cannot be updated.
+    if not stream and partition == "quadtree":
+        counts[failed] = -1
+        save_arrays(state_path, params=json.dumps(state_params), root=quadTree.bounds[0], max_level=quadTree.max_level, boxes=leaf_boxes, counts=counts, signatures=signatures, hashes=np.sort(hashes))
+    elif os.path.exists(state_path):
+        os.remove(state_path)
 
     # Completion message with execution time
     elapsed_time = time.time() - start_time
@@ -194,6 +410,9 @@ def index2d(footprints, output, folder_structure, osm, osm_save_path, quadtree_f
     console.print(f"[green]All tiles generated successfully and saved at:[/green] {os.path.abspath(tiles_full_path)}")
     console.print(structure)
     console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
 
 
 @click.command()
@@ -208,13 +427,15 @@ def index2d(footprints, output, folder_structure, osm, osm_save_path, quadtree_f
 @click.option('--minnodesize', type=int, default=None, show_default=True, help="Soft minimum on the point count of nodes.")
 @click.option('--cachesize', type=int, default=None, show_default=True, help="Number of recently-unused nodes to hold in reserve.")
 @click.option('--kwargs', type=click.Path(exists=True), default=None, help="Additional keyword arguments for Entwine [.json].")
+@profile_option
 
-def index3d(pointcloud, folder_structure, output, threads, force, srs, reprojection, maxnodesize, minnodesize, cachesize, kwargs):
+def index3d(pointcloud, folder_structure, output, threads, force, srs, reprojection, maxnodesize, minnodesize, cachesize, kwargs, profile):
     """
     OcTree indexing of 3D point cloud using Entwine.
     """
     
     start_time = time.time()
+    profiler = Profiler("index3d", profile)
 
     # Print header
     console.print(f"{copyright}")
@@ -297,7 +518,8 @@ def index3d(pointcloud, folder_structure, output, threads, force, srs, reproject
 
     # Run Entwine and wait for completion
     command = f"entwine build -c {config_file}"
-    run_command_in_terminal(command)
+    with profiler.span("entwine"):
+        run_command_in_terminal(command)
 
     # Completion message with execution time
     elapsed_time = time.time() - start_time
@@ -306,6 +528,9 @@ def index3d(pointcloud, folder_structure, output, threads, force, srs, reproject
     console.print(f"[green]\n3D point cloud indexed successfully and saved at:[/green] {os.path.abspath(tiles_full_path)}")
     console.print(structure)
     console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
 
 
 
@@ -316,18 +541,37 @@ def index3d(pointcloud, folder_structure, output, threads, force, srs, reproject
 @click.option('--max-workers', type=int, default=os.cpu_count(), show_default=True, help="Maximum number of workers for tiling.")
 @click.option('--crs', type=int, default=None, show_default=True, help="Coordinate system for the point cloud [EPSG code].")
 @click.option('--reprojection', type=int, default=None, show_default=True, help="Coordinate system reprojection for the point cloud [EPSG code].")
-
-def tile3d(areas, output, folder_structure, crs, reprojection, max_workers):
+@click.option('--engine', type=click.Choice(["pipeline", "shared"]), default="pipeline", show_default=True, help="Tiling engine: one readers.ept pipeline per tile, or read each EPT node once in worker processes and share its points between overlapping tiles.")
+@click.option('--direct', type=click.Path(exists=True), default=None, help="Tile this raw LAS/LAZ file or directory in one streaming pass, without the EPT index of index3d.")
+@click.option('--crop', type=float, default=None, help="Only keep the points within this distance of the footprints of each tile [CRS units].")
+@click.option('--classes', type=str, default=None, help="Only keep these classifications, comma-separated. GeoFlow uses ground (2) and building (6) points.")
+@click.option('--prune', is_flag=True, default=False, help="Only write the dimensions of LAS point format 0, without GPS time, colors and extra dimensions.")
+@click.option('--laz', is_flag=True, default=False, help="Write compressed LAZ tiles instead of LAS.")
+@click.option('--memory-threshold', type=float, default=85, show_default=True, help="Hold back new jobs while system memory usage is above this percentage.")
+@click.option('--resume', is_flag=True, default=False, help="Only retry tiles that failed or are missing in the manifest.")
+@click.option('--force', is_flag=True, default=False, help="Process all tiles, even if they are up to date.")
+@click.option('--queue', type=click.Path(), default=None, help="Queue the tiles in this shared directory for 'optim3d worker' processes and wait for them.")
+@order_option
+@profile_option
+
+def tile3d(areas, output, folder_structure, crs, reprojection, max_workers, engine, direct, crop, classes, prune, laz, memory_threshold, resume, force, queue, order, profile):
     """
     Tiling of point cloud using the calculated processing areas.
     """
 
     start = time.time()
+    profiler = Profiler("tile3d", profile)
+    import geopandas as gpd
+    import pandas as pd
 
     # Print header
     console.print(f"{copyright}")
     console.print("[bold cyan]Tiling of point cloud using the calculated processing areas[/bold cyan]\n")
 
+    if queue is not None and (direct is not None or engine == "shared"):
+        console.print("[bold red]Error: --queue only works with the pipeline engine, not with --engine shared or --direct.[/bold red]")
+        return
+
     # Read folder structure XML file
     try:
         folder_structure = os.path.join(output, folder_structure) if not os.path.exists(folder_structure) else folder_structure
@@ -341,21 +585,28 @@ def tile3d(areas, output, folder_structure, crs, reprojection, max_workers):
     tiles_full_path = os.path.join(output, tiles_path)
     indexed_path = root.find("indexed_pointcloud").text
     indexed_full_path = os.path.join(output, indexed_path)
+    footprints_full_path = os.path.join(output, root.find("footprint_tiles").text)
 
-    # Ensure the indexed point cloud exists
-    assert os.path.exists(indexed_full_path), "Indexed point cloud directory not found"
-    assert os.path.exists(os.path.join(indexed_full_path, "ept-data")), "ept-data not found in the indexed point cloud directory"
-    assert os.path.exists(os.path.join(indexed_full_path, "ept-hierarchy")), "ept-hierarchy not found in the indexed point cloud directory"
-    assert os.path.exists(os.path.join(indexed_full_path, "ept-sources")), "ept-sources not found in the indexed point cloud directory"
-    assert os.path.exists(os.path.join(indexed_full_path, "ept-build.json")), "ept.json not found in the indexed point cloud directory"
-    assert os.path.exists(os.path.join(indexed_full_path, "ept.json")), "ept.json not found in the indexed point cloud directory"
+    # Ensure the indexed point cloud exists, or the raw point cloud files with --direct
+    if direct is not None:
+        pointcloud_files = las_files(direct)
+        assert pointcloud_files, "No LAS/LAZ file found in the point cloud directory"
+    else:
+        assert os.path.exists(indexed_full_path), "Indexed point cloud directory not found"
+        assert os.path.exists(os.path.join(indexed_full_path, "ept-data")), "ept-data not found in the indexed point cloud directory"
+        assert os.path.exists(os.path.join(indexed_full_path, "ept-hierarchy")), "ept-hierarchy not found in the indexed point cloud directory"
+        assert os.path.exists(os.path.join(indexed_full_path, "ept-sources")), "ept-sources not found in the indexed point cloud directory"
+        assert os.path.exists(os.path.join(indexed_full_path, "ept-build.json")), "ept.json not found in the indexed point cloud directory"
+        assert os.path.exists(os.path.join(indexed_full_path, "ept.json")), "ept.json not found in the indexed point cloud directory"
     
     # Check if areas file exists inside or outside the output directory
     areas = os.path.join(output, areas) if not os.path.exists(areas) else areas
     assert os.path.exists(areas), "Processing areas file not found"
 
-    # Get CRS from ept.json
-    if crs is None:
+    # Get CRS from ept.json. Raw files are read in their own CRS, so --crs is needed to reproject them.
+    if crs is None and direct is not None:
+        in_crs = None
+    elif crs is None:
         with open(os.path.join(indexed_full_path, "ept.json")) as f:
             ept = json.load(f)
             crs = ept['srs']['horizontal'] if 'srs' in ept else None
@@ -372,21 +623,223 @@ def tile3d(areas, output, folder_structure, crs, reprojection, max_workers):
 
     # Load processing areas and indexed point cloud
     tiles = gpd.read_file(areas)
+    index = EptIndex(indexed_full_path) if direct is None else None
+    boxes = tiles.bounds.to_numpy()
+
+    # Skip tiles whose area, point cloud and parameters did not change since the last run,
+    # or with --resume, every tile that already finished
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+    if direct is None:
+        inputs = {"ept": os.path.join(indexed_full_path, "ept.json")}
+    else:
+        inputs = {os.path.abspath(filename): filename for filename in pointcloud_files}
+    params = [{"bounds": box.tolist(), "in_crs": in_crs, "out_crs": out_crs} for box in boxes]
+    extension = "laz" if laz else "las"
+    outputs = [f"{tiles_full_path}/tile_{idx}.{extension}" for idx in range(len(tiles))]
+
+    # Classes, dimensions and format are only part of the parameters when they are not the defaults
+    classes = [int(c) for c in classes.split(",")] if classes else None
+    for param in params:
+        if classes is not None:
+            param["classes"] = classes
+        if prune:
+            param["prune"] = True
+        if laz:
+            param["format"] = extension
+
+    # With --crop, the points of a tile are cropped to its footprints buffered by the distance. Tiles
+    # without footprints are not cropped.
+    crops = [None] * len(tiles)
+    if crop is not None:
+        for idx in range(len(tiles)):
+            footprint = find_tile(footprints_full_path, f"tile_{idx}", TILE_FORMATS)
+            crops[idx] = (footprint, crop) if footprint is not None else None
+            params[idx]["crop"] = crop
+
+    if force:
+        todo = np.arange(len(tiles))
+    elif resume:
+        todo = np.array([idx for idx in range(len(tiles)) if not manifest.is_done("tile3d", idx)], dtype=np.int64)
+    else:
+        todo = np.array([idx for idx in range(len(tiles)) if not manifest.is_current("tile3d", idx, inputs, params[idx])], dtype=np.int64)
+    if len(todo) < len(tiles):
+        console.print(f"Skipping {len(tiles) - len(todo)} of {len(tiles)} tiles that are already up to date.")
+
+    # With --order, the tiles are run along the curve through their centers instead of largest first
+    if order != "size":
+        keys = curve_keys(box_centers(boxes), order)
+        todo = todo[np.argsort(keys[todo], kind="stable")]
+
+    # Remove the tiles of the other format, so that reconstruct does not pick up an outdated tile
+    for idx in todo:
+        for other in POINTCLOUD_FORMATS:
+            if other != extension and os.path.exists(f"{tiles_full_path}/tile_{idx}.{other}"):
+                os.remove(f"{tiles_full_path}/tile_{idx}.{other}")
+
+    # Estimate the point count of each tile from the EPT hierarchy; the largest tiles are scheduled first
+    # and new jobs are only admitted while memory stays under the threshold
+    if direct is None:
+        pairs = index.overlaps(boxes[todo])
+        pairs[0] = todo[pairs[0]]
+        predicted = index.estimate(boxes, pairs)
+    actual = np.zeros(len(tiles), dtype=np.int64)
+    kept = np.zeros(len(tiles), dtype=np.int64)
+
+    if direct is not None or engine == "shared":
+        parts_path = os.path.join(tiles_full_path, ".parts")
+        os.makedirs(parts_path, exist_ok=True)
+        parts = {}
+        failed = set()
+        controller = AdmissionController(max_workers, memory_threshold, executor=ProcessPoolExecutor)
+
+    if direct is not None:
+        # Use worker processes to stream the raw files and route their points to the tiles, one file per job
+        jobs = [(number, filename, boxes[todo], todo.tolist(), parts_path, in_crs, out_crs, classes) for number, filename in enumerate(pointcloud_files)]
+        estimates = [(DIRECT_BUFFER_POINTS + DIRECT_CHUNK_POINTS) * PDAL_BYTES_PER_POINT] * len(jobs)
+        points_read = 0
+        routed = np.zeros(2)
 
-    # Use ThreadPoolExecutor for tiling the point cloud with tile function
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(tile, idx, tiles, indexed_full_path, tiles_full_path, in_crs, out_crs) for idx in range(len(tiles))]
-        
         with Progress() as progress:
-            task = progress.add_task("[cyan]Tiling point cloud", total=len(futures))
-            for future in as_completed(futures):
+            task = progress.add_task("[cyan]Reading point cloud files", total=len(jobs))
+            for job, future in controller.run(profiler.wrap(tile_las_file, "read file"), jobs, estimates):
+                try:
+                    written, read, routing = profiler.result(future.result())
+                    points_read += read
+                    routed += routing
+                    for idx, filename, count in written:
+                        parts.setdefault(idx, []).append(filename)
+                        actual[idx] += count
+                except Exception as e:
+                    # Every tile may miss the points of this file
+                    failed.update(todo.tolist())
+                    console.print(f"[bold red]Error: {e}[/bold red]")
+                finally:
+                    progress.update(task, advance=1)
+
+        console.print(f"Points read: {points_read} from {len(pointcloud_files)} files, {actual[todo].sum()} written to tiles")
+
+    elif engine == "shared":
+        # Plan the EPT nodes needed by each tile, so that every node is read only once
+        per_tile_bytes = index.sizes[pairs[1]].sum()
+        batches = index.batches(np.unique(pairs[1]), max_points=10_000_000)
+        bytes_read = 0
+        routed = np.zeros(2)
+
+        # Use worker processes to read node batches and route their points to the tiles
+        jobs = []
+        for batch, nodes in enumerate(batches):
+            candidates = np.unique(pairs[0][np.isin(pairs[1], nodes)])
+            jobs.append((batch, [index.files[n] for n in nodes], index.data_type, index.schema, boxes[candidates], candidates.tolist(), parts_path, in_crs, out_crs, classes))
+        estimates = [index.counts[nodes].sum() * PDAL_BYTES_PER_POINT for nodes in batches]
+
+        with Progress() as progress:
+            task = progress.add_task("[cyan]Reading EPT nodes", total=len(jobs))
+            for job, future in controller.run(profiler.wrap(tile_ept_nodes, "read nodes"), jobs, estimates):
+                try:
+                    written, read, routing = profiler.result(future.result())
+                    bytes_read += read
+                    routed += routing
+                    for idx, filename, count in written:
+                        parts.setdefault(idx, []).append(filename)
+                        actual[idx] += count
+                except Exception as e:
+                    failed.update(jobs[job][5])
+                    console.print(f"[bold red]Error: {e}[/bold red]")
+                finally:
+                    progress.update(task, advance=1)
+
+        console.print(f"EPT data read: {bytes_read / 1e6:.1f} MB (one pipeline per tile would read {per_tile_bytes / 1e6:.1f} MB)")
+
+    if direct is not None or engine == "shared":
+        console.print(f"Point routing: {routed[0]:.0f} points at {routed[0] / max(routed[1], 1e-9) / 1e6:.1f}M points/s per worker")
+
+        # Merge the part files of every tile
+        merged = [idx for idx in parts if idx not in failed]
+        if order != "size":
+            merged.sort(key=lambda idx: keys[idx])
+        jobs = [(sorted(parts[idx]), outputs[idx], crops[idx], points_crs(in_crs, out_crs), prune) for idx in merged]
+        estimates = [actual[idx] * PDAL_BYTES_PER_POINT for idx in merged]
+
+        with Progress() as progress:
+            task = progress.add_task("[cyan]Tiling point cloud", total=len(jobs))
+            for job, future in controller.run(profiler.wrap(merge_tile_parts, "merge parts"), jobs, estimates, ordered=order != "size"):
+                idx = merged[job]
                 try:
-                    future.result()
+                    written = profiler.result(future.result(), idx)
+                    kept[idx] = actual[idx] if written is None else written
+                    manifest.record("tile3d", idx, "done", inputs, params[idx], [outputs[idx]])
                 except Exception as e:
+                    manifest.record("tile3d", idx, "failed", inputs, params[idx], [])
                     console.print(f"[bold red]Error: {e}[/bold red]")
                 finally:
                     progress.update(task, advance=1)
 
+        # Tiles without any point are done as well, unless one of their node batches or files failed
+        for idx in todo:
+            if idx in failed:
+                manifest.record("tile3d", idx, "failed", inputs, params[idx], [])
+            elif idx not in parts:
+                manifest.record("tile3d", idx, "done", inputs, params[idx], [])
+
+        shutil.rmtree(parts_path, ignore_errors=True)
+
+    elif queue is not None:
+        # Queue one task per tile for the workers, and record the tiles as their tasks finish
+        work_queue = WorkQueue(queue)
+        tokens = {}
+        for idx in todo:
+            args = {"index": int(idx), "areas": os.path.abspath(areas), "indexed_path": os.path.abspath(indexed_full_path), "tiles_path": os.path.abspath(tiles_full_path), "in_crs": in_crs, "out_crs": out_crs, "crop": [os.path.abspath(crops[idx][0]), crop] if crops[idx] else None, "classes": classes, "prune": prune, "extension": extension}
+            tokens[f"tile3d_{idx}"] = work_queue.submit(f"tile3d_{idx}", "tile3d", args)
+        console.print(f"{len(tokens)} tiles queued in {os.path.abspath(queue)}, run 'optim3d worker {queue}' on each host.")
+
+        with Progress() as progress:
+            task = progress.add_task("[cyan]Tiling point cloud", total=len(tokens))
+            for task_id, done in work_queue.wait(tokens):
+                idx = int(task_id.split("_")[-1])
+                if done["status"] == "done":
+                    actual[idx], kept[idx] = done["result"]
+                    manifest.record("tile3d", idx, "done", inputs, params[idx], [outputs[idx]])
+                else:
+                    manifest.record("tile3d", idx, "failed", inputs, params[idx], [])
+                    console.print(f"[bold red]Error in tile_{idx} on {done['worker']}: {done['error']}[/bold red]")
+                progress.update(task, advance=1)
+
+    else:
+        # Use worker threads for tiling the point cloud with tile function
+        controller = AdmissionController(max_workers, memory_threshold)
+        jobs = [(idx, tiles, indexed_full_path, tiles_full_path, in_crs, out_crs, crops[idx], classes, prune, extension) for idx in todo]
+
+        with Progress() as progress:
+            task = progress.add_task("[cyan]Tiling point cloud", total=len(jobs))
+            for job, future in controller.run(profiler.wrap(tile, "tile"), jobs, predicted[todo] * PDAL_BYTES_PER_POINT, ordered=order != "size"):
+                idx = todo[job]
+                try:
+                    actual[idx], kept[idx] = profiler.result(future.result(), idx)
+                    manifest.record("tile3d", idx, "done", inputs, params[idx], [outputs[idx]])
+                except Exception as e:
+                    manifest.record("tile3d", idx, "failed", inputs, params[idx], [])
+                    console.print(f"[bold red]Error: {e}[/bold red]")
+                finally:
+                    progress.update(task, advance=1)
+
+    manifest.save()
+
+    # Log predicted versus actual point counts to check the estimator, which counts the points of all classes
+    if direct is None and classes is None and len(todo):
+        estimates_path = os.path.join(output, "tile3d_estimates.csv")
+        pd.DataFrame({"tile": todo, "predicted": predicted[todo].round().astype(np.int64), "actual": actual[todo]}).to_csv(estimates_path, index=False)
+        error = np.abs(predicted[todo] - actual[todo]) / np.maximum(actual[todo], 1)
+        console.print(f"Point count estimate: median error {np.median(error):.1%}, max error {error.max():.1%} (see {estimates_path})")
+
+    # Log the points and bytes removed by cropping. Cropped files are smaller by about the share of
+    # points removed, so the uncropped size is extrapolated from the point counts.
+    if crop is not None and len(todo):
+        crop_path = os.path.join(output, "tile3d_crop.csv")
+        size = np.array([os.path.getsize(outputs[idx]) if os.path.exists(outputs[idx]) else 0 for idx in todo], dtype=np.int64)
+        reduction = 1 - kept[todo] / np.maximum(actual[todo], 1)
+        pd.DataFrame({"tile": todo, "points": actual[todo], "kept": kept[todo], "reduction": reduction.round(4), "bytes": size, "uncropped_bytes": np.where(kept[todo] > 0, size * actual[todo] // np.maximum(kept[todo], 1), size)}).to_csv(crop_path, index=False)
+        console.print(f"Cropping kept {kept[todo].sum()} of {actual[todo].sum()} points ({1 - kept[todo].sum() / max(actual[todo].sum(), 1):.1%} removed, median {np.median(reduction):.1%} per tile, see {crop_path})")
+
     # Completion message with execution time
     elapsed_time = time.time() - start
     structure = Tree(output)
@@ -394,19 +847,30 @@ def tile3d(areas, output, folder_structure, crs, reprojection, max_workers):
     console.print(f"[green]\n3D point cloud tiled successfully and saved at:[/green] {os.path.abspath(tiles_full_path)}")
     console.print(structure)
     console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
 
 
 @click.command()
 @click.option('--output', help='Output directory.', type=click.Path(exists=False), default="output", show_default=True)
 @click.option('--folder-structure', type=click.Path(), default="folder_structure.xml", show_default=True, help="Folder structure file.")
 @click.option('--max-workers', type=int, default=os.cpu_count(), show_default=True, help="Maximum number of workers for reconstruction.")
-
-def reconstruct(output, folder_structure, max_workers):
+@click.option('--memory-threshold', type=float, default=85, show_default=True, help="Hold back new GeoFlow processes while system memory usage is above this percentage.")
+@click.option('--resume', is_flag=True, default=False, help="Only retry tiles that failed or are missing in the manifest.")
+@click.option('--force', is_flag=True, default=False, help="Process all tiles, even if they are up to date.")
+@click.option('--queue', type=click.Path(), default=None, help="Queue the tiles in this shared directory for 'optim3d worker' processes and wait for them.")
+@click.option('--areas', type=click.Path(), default="processing_areas.gpkg", show_default=True, help="Processing areas file, for the tile centers of --order.")
+@order_option
+@profile_option
+
+def reconstruct(output, folder_structure, max_workers, memory_threshold, resume, force, queue, areas, order, profile):
     """
     Optimized 3D reconstruction of buildings using GeoFlow.
     """
 
     start = time.time()
+    profiler = Profiler("reconstruct", profile)
 
     # Print header
     console.print(f"{copyright}")
@@ -449,28 +913,99 @@ def reconstruct(output, folder_structure, max_workers):
     shutil.copy(config_file, os.path.join(script_dir, 'reconstruct.json'))
     shutil.copy(config_file_, os.path.join(script_dir, 'reconstruct_.json'))
 
-    commands = [
-        f"geof reconstruct.json --input_footprint={footprints_full_path}/tile_{i}.shp --input_pointcloud={pointcloud_full_path}/tile_{i}.las --output_cityjson={output}/model/cityjson/tile_{i}.city.json"
-        for i in range(len(os.listdir(f"{output}/pointcloud_tiles")))
-    ]
+    # Skip tiles whose inputs did not change since the last run, or with --resume, every tile that already finished
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+
+    # Footprint tiles may be written in any of the supported formats, point cloud tiles as LAS or LAZ
+    commands = []
+    pointclouds = {}
+    estimates = []
+    tasks = []
+    skipped = 0
+    for i in range(len(os.listdir(pointcloud_full_path))):
+        footprint = find_tile(footprints_full_path, f"tile_{i}", TILE_FORMATS)
+        if footprint is None:
+            console.print(f"[bold red]Error: footprint tile tile_{i} not found in {footprints_full_path}[/bold red]")
+            continue
+        pointcloud = find_tile(pointcloud_full_path, f"tile_{i}", POINTCLOUD_FORMATS) or f"{pointcloud_full_path}/tile_{i}.las"
+        cityjson = f"{output}/model/cityjson/tile_{i}.city.json"
+        inputs = {"footprint": footprint, "pointcloud": pointcloud, "config": config_file}
+        if not force and (manifest.is_done("reconstruct", i) if resume else manifest.is_current("reconstruct", i, inputs, {})):
+            skipped += 1
+            continue
+        commands.append((f"geof reconstruct.json --input_footprint={footprint} --input_pointcloud={pointcloud} --output_cityjson={cityjson}",))
+        estimates.append(GEOFLOW_BASE_MEMORY + GEOFLOW_MEMORY_FACTOR * os.path.getsize(pointcloud) if os.path.exists(pointcloud) else None)
+        tasks.append((i, inputs, cityjson))
+        pointclouds[i] = pointcloud
+
+    if skipped:
+        console.print(f"Skipping {skipped} of {skipped + len(tasks)} tiles that are already up to date.")
+
+    # With --order, the tiles are run along the curve through the centers of their processing areas
+    if order != "size":
+        import geopandas as gpd
+        areas = os.path.join(output, areas) if not os.path.exists(areas) else areas
+        assert os.path.exists(areas), "Processing areas file not found"
+        boxes = gpd.read_file(areas).bounds.to_numpy()
+        keys = curve_keys(box_centers(boxes), order)
+        # Tiles without a processing area go last
+        ranks = np.argsort([keys[i] if i < len(keys) else np.iinfo(np.int64).max for i, _, _ in tasks], kind="stable")
+        commands, estimates, tasks = [commands[j] for j in ranks], [estimates[j] for j in ranks], [tasks[j] for j in ranks]
+
+    seconds = {}
+
+    if queue is not None:
+        # Queue one task per tile for the workers, with absolute paths since they may run in another directory
+        work_queue = WorkQueue(queue)
+        tokens = {}
+        for i, inputs, cityjson in tasks:
+            command = f"geof reconstruct.json --input_footprint={os.path.abspath(inputs['footprint'])} --input_pointcloud={os.path.abspath(inputs['pointcloud'])} --output_cityjson={os.path.abspath(cityjson)}"
+            tokens[f"reconstruct_{i}"] = work_queue.submit(f"reconstruct_{i}", "reconstruct", {"index": int(i), "command": command, "cityjson": os.path.abspath(cityjson)})
+        queued = {f"reconstruct_{i}": (i, inputs, cityjson) for i, inputs, cityjson in tasks}
+        console.print(f"{len(tokens)} tiles queued in {os.path.abspath(queue)}, run 'optim3d worker {queue}' on each host.")
 
-    # Using ThreadPoolExecutor for managing concurrent execution
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
+        with Progress() as progress:
+            task = progress.add_task("[cyan]Reconstructing buildings", total=len(tokens))
+            for task_id, done in work_queue.wait(tokens):
+                i, inputs, cityjson = queued[task_id]
+                if done["status"] == "done":
+                    seconds[i] = done["result"]
+                    manifest.record("reconstruct", i, "done", inputs, {}, [cityjson])
+                else:
+                    manifest.record("reconstruct", i, "failed", inputs, {}, [])
+                    console.print(f"[bold red]Error in tile_{i} on {done['worker']}: {done['error']}[/bold red]")
+                progress.update(task, advance=1)
 
-        for cmd in commands:
-            futures.append(executor.submit(run_command_in_terminal, cmd))
+    else:
+        # GeoFlow processes are started largest tile first, while memory stays under the threshold
+        controller = AdmissionController(max_workers, memory_threshold)
 
         with Progress() as progress:
-            task = progress.add_task("[cyan]Reconstructing buildings", total=len(futures))
-            for future in as_completed(futures):
+            task = progress.add_task("[cyan]Reconstructing buildings", total=len(commands))
+            for job, future in controller.run(profiler.wrap(reconstruct_tile, "geof"), commands, estimates, ordered=order != "size"):
+                i, inputs, cityjson = tasks[job]
                 try:
-                    future.result()  # Check if any exceptions occurred in the threads
+                    succeeded, seconds[i] = profiler.result(future.result(), i)  # Check if any exceptions occurred in the threads
+                    manifest.record("reconstruct", i, "done" if succeeded and os.path.exists(cityjson) else "failed", inputs, {}, [cityjson])
                 except Exception as e:
+                    manifest.record("reconstruct", i, "failed", inputs, {}, [])
                     console.print(f"[bold red]Error with command execution: {e}[/bold red]")
                 finally:
                     progress.update(task, advance=1)
 
+    manifest.save()
+
+    # Log the reconstruction time and point cloud size of each tile, next to those of the previous run of
+    # the same tile, to see the effect of changes to the tiles such as tile3d --crop
+    if seconds:
+        import pandas as pd
+        times_path = os.path.join(output, "reconstruct_times.csv")
+        times = pd.DataFrame({"tile": list(seconds), "bytes": [os.path.getsize(pointclouds[i]) if os.path.exists(pointclouds[i]) else 0 for i in seconds], "seconds": [round(t, 3) for t in seconds.values()]})
+        times = log_reconstruct_times(times_path, times)
+        compared = times.dropna()
+        if len(compared):
+            console.print(f"Reconstruction time of {len(compared)} tiles: {compared['seconds'].sum():.1f} s, {compared['previous_seconds'].sum():.1f} s in the previous run ({compared['seconds'].sum() / max(compared['previous_seconds'].sum(), 1e-9) - 1:+.1%}), point clouds {compared['bytes'].sum() / max(compared['previous_bytes'].sum(), 1) - 1:+.1%} (see {times_path})")
+
     # Delete the config files after execution
     os.remove(os.path.join(script_dir, 'reconstruct.json'))
     os.remove(os.path.join(script_dir, 'reconstruct_.json'))
@@ -482,17 +1017,25 @@ def reconstruct(output, folder_structure, max_workers):
     console.print(f"[green]\n3D buildings reconstructed successfully and saved at:[/green] {os.path.abspath(model_full_path)}")
     console.print(structure)
     console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
 
 
 @click.command()
 @click.option('--output', help='Output directory.', type=click.Path(exists=False), default="output", show_default=True)
 @click.option('--folder-structure', type=click.Path(), default="folder_structure.xml", show_default=True, help="Folder structure file.")
+@click.option('--max-workers', type=int, default=os.cpu_count(), show_default=True, help="Maximum number of workers for postprocessing.")
+@click.option('--memory-threshold', type=float, default=85, show_default=True, help="Hold back new jobs while system memory usage is above this percentage.")
+@click.option('--pretty', is_flag=True, default=False, help="Write indented CityJSON instead of compact CityJSON.")
+@profile_option
 
-def post(output, folder_structure):
+def post(output, folder_structure, max_workers, memory_threshold, pretty, profile):
     """
     Postprocess the generated CityJSON files.
     """
     start = time.time()
+    profiler = Profiler("post", profile)
 
     # Print header
     console.print(f"{copyright}")
@@ -516,40 +1059,434 @@ def post(output, folder_structure):
     assert os.path.exists(model_full_path), "Model directory not found"
     assert os.path.exists(cityjson_full_path), "CityJSON directory not found"
 
-    # Postprocess the CityJSON files
+    # City object IDs are prefixed with the tile number, so that reruns give the same IDs.
+    # Files that were already postprocessed and not regenerated since are skipped.
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+    filenames = sorted(f for f in os.listdir(cityjson_full_path) if f.endswith(".json"))
+    jobs = []
+    for i, filename in enumerate(filenames):
+        path = os.path.join(cityjson_full_path, filename)
+        if manifest.is_done("post", filename):
+            continue
+        tile_number = tile_id(filename)
+        jobs.append((path, f"T{tile_number if tile_number is not None else i}_", pretty))
+
+    if len(jobs) < len(filenames):
+        console.print(f"Skipping {len(filenames) - len(jobs)} of {len(filenames)} files that are already postprocessed.")
+
+    # Postprocess the CityJSON files in worker processes
+    controller = AdmissionController(max_workers, memory_threshold, executor=ProcessPoolExecutor)
+    estimates = [CITYJSON_MEMORY_FACTOR * os.path.getsize(path) for path, _, _ in jobs]
+
     with Progress() as progress:
-        task = progress.add_task("[cyan]Postprocessing CityJSON files", total=len(os.listdir(cityjson_full_path)))
-        for i, filename in enumerate(os.listdir(cityjson_full_path)):
-            with open(os.path.join(cityjson_full_path, filename)) as file:
-                data = json.load(file)
-                twin = copy.deepcopy(data)
+        task = progress.add_task("[cyan]Postprocessing CityJSON files", total=len(jobs))
+        for job, future in controller.run(profiler.wrap(postprocess, "post"), jobs, estimates):
+            path = jobs[job][0]
+            try:
+                profiler.result(future.result(), tile_id(path))
+                manifest.record("post", os.path.basename(path), "done", {}, {"prefix": jobs[job][1]}, [path])
+                manifest.update_output("reconstruct", tile_id(path), path)
+            except Exception as e:
+                console.print(f"[bold red]Error: {e}[/bold red]")
+            finally:
+                progress.update(task, advance=1)
+
+    manifest.save()
+    
+    # Completion message with execution time
+    elapsed_time = time.time() - start
+    structure = Tree(output)
+    structure.add(model_path)
+    console.print(f"[green]\nCityJSON files postprocessed successfully and saved at:[/green] {os.path.abspath(cityjson_full_path)}")
+    console.print(structure)
+    console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
 
-                for key, value in data['CityObjects'].items():
-                    children = twin['CityObjects'][key].get('children')
-                    parents = twin['CityObjects'][key].get('parents')
 
-                    if children:
-                        for j in range(len(children)):
-                            children[j] = f'T{i}_{children[j]}'
+@click.command()
+@click.option('--output', help='Output directory.', type=click.Path(exists=False), default="output", show_default=True)
+@click.option('--folder-structure', type=click.Path(), default="folder_structure.xml", show_default=True, help="Folder structure file.")
+@click.option('--format', 'output_format', type=click.Choice(["cityjson", "cityjsonseq"]), default="cityjson", show_default=True, help="Merge into a single CityJSON file, or a CityJSONSeq file with one feature per line.")
+@click.option('--output-file', type=click.Path(), default=None, help="Merged file. Defaults to city.json or city.city.jsonl in the model directory.")
+@click.option('--scale', type=float, default=None, help="Scale of the merged vertices. Defaults to the scale of the first tile.")
+@click.option('--areas', type=click.Path(), default="processing_areas.gpkg", show_default=True, help="Processing areas file, to deduplicate the vertices shared by tiles.")
+@profile_option
 
-                    if parents:
-                        for j in range(len(parents)):
-                            parents[j] = f'T{i}_{parents[j]}'
+def merge(output, folder_structure, output_format, output_file, scale, areas, profile):
+    """
+    Merge the CityJSON tiles into a single dataset.
+    """
+    start = time.time()
+    profiler = Profiler("merge", profile)
 
-                    twin['CityObjects'][f'T{i}_{key}'] = twin['CityObjects'].pop(key)
+    # Print header
+    console.print(f"{copyright}")
+    console.print("[bold cyan]Merging CityJSON files[/bold cyan]\n")
 
-            with open(os.path.join(cityjson_full_path, filename), 'w') as file:
-                json.dump(twin, file, indent=2)
+    # Read folder structure XML file
+    try:
+        folder_structure = os.path.join(output, folder_structure) if not os.path.exists(folder_structure) else folder_structure
+        tree = ET.parse(folder_structure)
+    except ET.ParseError:
+        console.print("[bold red]Error: {folder_structure} does not exist or is not a valid XML file.[/bold red]")
+        return
+
+    root = tree.getroot()
+    model_path = root.find("model").text
+    cityjson_path = os.path.join(model_path, "cityjson")
+    model_full_path = os.path.join(output, model_path)
+    cityjson_full_path = os.path.join(output, cityjson_path)
 
+    # Ensure output directories exist
+    assert os.path.exists(cityjson_full_path), "CityJSON directory not found"
+
+    seq = output_format == "cityjsonseq"
+    if output_file is None:
+        output_file = os.path.join(model_full_path, "city.city.jsonl" if seq else "city.json")
+
+    # Tiles are read one at a time. City object IDs of tiles that were not postprocessed are
+    # prefixed with the tile number on the fly, without rewriting the tile.
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+    filenames = sorted((f for f in os.listdir(cityjson_full_path) if tile_id(f) is not None and f.endswith(".json")), key=tile_id)
+
+    # Tiles can only share vertices and buildings where their processing areas overlap. The areas are
+    # reprojected like the point cloud tiles if tile3d reprojected them.
+    areas = os.path.join(output, areas) if not os.path.exists(areas) else areas
+    boxes = None
+    if os.path.exists(areas):
+        import geopandas as gpd
+        tiles = gpd.read_file(areas)
+        out_crs = {entry["params"].get("out_crs") for entry in manifest.stages.get("tile3d", {}).values()} - {None}
+        if len(out_crs) == 1 and tiles.crs is not None:
+            tiles = tiles.to_crs(out_crs.pop())
+        boxes = tiles.bounds.to_numpy()
+    else:
+        console.print("Processing areas not found, the vertices are only deduplicated within each tile.")
+    merger = CityJSONMerger(output_file, seq=seq, scale=scale, areas=boxes)
+
+    with Progress() as progress:
+        task = progress.add_task("[cyan]Merging CityJSON files", total=len(filenames))
+        for filename in filenames:
+            prefix = None if manifest.is_done("post", filename) else f"T{tile_id(filename)}_"
+            with profiler.span("merge tile", tile_id(filename)):
+                merger.add(os.path.join(cityjson_full_path, filename), prefix, tile_id(filename))
             progress.update(task, advance=1)
-    
+    with profiler.span("write vertices"):
+        merger.close()
+
+    console.print(f"Merged {merger.objects} city objects from {len(filenames)} tiles, {merger.vertices_in} vertices deduplicated to {merger.vertices_out}.")
+    if merger.duplicates:
+        console.print(f"Dropped {merger.duplicates} buildings already merged from another tile.")
+
+    # Completion message with execution time
+    elapsed_time = time.time() - start
+    console.print(f"[green]\nCityJSON files merged successfully and saved at:[/green] {os.path.abspath(output_file)}")
+    console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
+
+
+@click.command()
+@click.option('--output', help='Output directory.', type=click.Path(exists=False), default="output", show_default=True)
+@click.option('--folder-structure', type=click.Path(), default="folder_structure.xml", show_default=True, help="Folder structure file.")
+@click.option('--areas', type=click.Path(), default="processing_areas.gpkg", show_default=True, help="Processing areas file.")
+@click.option('--crs', type=int, default=None, show_default=True, help="Coordinate system for the point cloud [EPSG code].")
+@click.option('--reprojection', type=int, default=None, show_default=True, help="Coordinate system reprojection for the point cloud [EPSG code].")
+@click.option('--crop', type=float, default=None, help="Only keep the points within this distance of the footprints of each tile [CRS units].")
+@click.option('--classes', type=str, default=None, help="Only keep these classifications, comma-separated. GeoFlow uses ground (2) and building (6) points.")
+@click.option('--prune', is_flag=True, default=False, help="Only write the dimensions of LAS point format 0, without GPS time, colors and extra dimensions.")
+@click.option('--laz', is_flag=True, default=False, help="Write compressed LAZ tiles instead of LAS.")
+@click.option('--tile-workers', type=int, default=max(1, os.cpu_count() // 4), show_default=True, help="Number of workers for tiling the point cloud.")
+@click.option('--reconstruct-workers', type=int, default=os.cpu_count(), show_default=True, help="Number of workers for reconstruction.")
+@click.option('--post-workers', type=int, default=max(1, os.cpu_count() // 4), show_default=True, help="Number of workers for postprocessing.")
+@click.option('--queue-size', type=int, default=None, help="Maximum number of tiles waiting for each stage. Defaults to twice its number of workers.")
+@click.option('--memory-threshold', type=float, default=85, show_default=True, help="Hold back new jobs while system memory usage is above this percentage.")
+@click.option('--pretty', is_flag=True, default=False, help="Write indented CityJSON instead of compact CityJSON.")
+@click.option('--resume', is_flag=True, default=False, help="Only retry tiles that failed or are missing in the manifest.")
+@click.option('--force', is_flag=True, default=False, help="Process all tiles, even if they are up to date.")
+@order_option
+@profile_option
+
+def run(output, folder_structure, areas, crs, reprojection, crop, classes, prune, laz, tile_workers, reconstruct_workers, post_workers, queue_size, memory_threshold, pretty, resume, force, order, profile):
+    """
+    Tiling, reconstruction and postprocessing pipelined tile by tile.
+    """
+
+    start = time.time()
+    profiler = Profiler("run", profile)
+    import geopandas as gpd
+
+    # Print header
+    console.print(f"{copyright}")
+    console.print("[bold cyan]Tiling, reconstruction and postprocessing pipelined tile by tile[/bold cyan]\n")
+
+    # Read folder structure XML file
+    try:
+        folder_structure = os.path.join(output, folder_structure) if not os.path.exists(folder_structure) else folder_structure
+        tree = ET.parse(folder_structure)
+    except ET.ParseError:
+        console.print("[bold red]Error: {folder_structure} does not exist or is not a valid XML file.[/bold red]")
+        return
+
+    root = tree.getroot()
+    footprints_full_path = os.path.join(output, root.find("footprint_tiles").text)
+    indexed_full_path = os.path.join(output, root.find("indexed_pointcloud").text)
+    pointcloud_full_path = os.path.join(output, root.find("pointcloud_tiles").text)
+    model_path = root.find("model").text
+    model_full_path = os.path.join(output, model_path)
+    cityjson_full_path = os.path.join(model_full_path, "cityjson")
+
+    # The footprint tiles and the indexed point cloud are needed for every tile, so index2d and index3d run first
+    assert os.path.exists(footprints_full_path), "Footprint tiles directory not found"
+    assert os.path.exists(os.path.join(indexed_full_path, "ept.json")), "ept.json not found in the indexed point cloud directory"
+    areas = os.path.join(output, areas) if not os.path.exists(areas) else areas
+    assert os.path.exists(areas), "Processing areas file not found"
+    os.makedirs(pointcloud_full_path, exist_ok=True)
+    os.makedirs(cityjson_full_path, exist_ok=True)
+
+    # Get CRS from ept.json
+    if crs is None:
+        with open(os.path.join(indexed_full_path, "ept.json")) as f:
+            ept = json.load(f)
+            crs = ept['srs']['horizontal'] if 'srs' in ept else None
+            in_crs = f"EPSG:{crs}" if crs is not None else None
+    else:
+        in_crs = f"EPSG:{crs}"
+
+    out_crs = f"EPSG:{reprojection}" if reprojection is not None else None
+
+    # Copy the GeoFlow config files to the working directory
+    config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
+    config_file = os.path.join(config_dir, 'reconstruct.json')
+    script_dir = os.getcwd()
+    shutil.copy(config_file, os.path.join(script_dir, 'reconstruct.json'))
+    shutil.copy(os.path.join(config_dir, 'reconstruct_.json'), os.path.join(script_dir, 'reconstruct_.json'))
+
+    tiles = gpd.read_file(areas)
+    index = EptIndex(indexed_full_path)
+    boxes = tiles.bounds.to_numpy()
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+
+    # Decide up front which stages each tile needs. A stage runs again when its own record is not up
+    # to date, or when a stage before it runs again for that tile.
+    ept_inputs = {"ept": os.path.join(indexed_full_path, "ept.json")}
+    params = [{"bounds": box.tolist(), "in_crs": in_crs, "out_crs": out_crs} for box in boxes]
+    footprints = [find_tile(footprints_full_path, f"tile_{idx}", TILE_FORMATS) for idx in range(len(tiles))]
+    extension = "laz" if laz else "las"
+    pointclouds = [f"{pointcloud_full_path}/tile_{idx}.{extension}" for idx in range(len(tiles))]
+    cityjsons = [f"{cityjson_full_path}/tile_{idx}.city.json" for idx in range(len(tiles))]
+    inputs = [{"footprint": footprints[idx], "pointcloud": pointclouds[idx], "config": config_file} for idx in range(len(tiles))]
+
+    # The point cloud options are recorded like tile3d does, so that both commands share the manifest
+    classes = [int(c) for c in classes.split(",")] if classes else None
+    for param in params:
+        if classes is not None:
+            param["classes"] = classes
+        if prune:
+            param["prune"] = True
+        if laz:
+            param["format"] = extension
+    crops = [None] * len(tiles)
+    if crop is not None:
+        for idx in range(len(tiles)):
+            crops[idx] = (footprints[idx], crop) if footprints[idx] is not None else None
+            params[idx]["crop"] = crop
+
+    def needed(stage, tile, inputs, params):
+        if force:
+            return True
+        return not (manifest.is_done(stage, tile) if resume else manifest.is_current(stage, tile, inputs, params))
+
+    todo = {}
+    for idx in range(len(tiles)):
+        todo[idx, "tile3d"] = needed("tile3d", idx, ept_inputs, params[idx])
+        todo[idx, "reconstruct"] = todo[idx, "tile3d"] or footprints[idx] is None or needed("reconstruct", idx, inputs[idx], {})
+        todo[idx, "post"] = todo[idx, "reconstruct"] or not manifest.is_done("post", os.path.basename(cityjsons[idx]))
+
+    def tile_job(idx):
+        if not todo[idx, "tile3d"]:
+            return "skipped"
+        # Remove the tile of the other format, so that reconstruct does not pick up an outdated tile
+        for other in POINTCLOUD_FORMATS:
+            if other != extension and os.path.exists(f"{pointcloud_full_path}/tile_{idx}.{other}"):
+                os.remove(f"{pointcloud_full_path}/tile_{idx}.{other}")
+        with profiler.span("tile", idx):
+            tile(idx, tiles, indexed_full_path, pointcloud_full_path, in_crs, out_crs, crops[idx], classes, prune, extension)
+        return "done"
+
+    def reconstruct_job(idx):
+        if not todo[idx, "reconstruct"]:
+            return "skipped"
+        if footprints[idx] is None:
+            raise FileNotFoundError(f"footprint tile tile_{idx} not found in {footprints_full_path}")
+        with profiler.span("geof", idx):
+            succeeded = run_command_in_terminal(f"geof reconstruct.json --input_footprint={footprints[idx]} --input_pointcloud={pointclouds[idx]} --output_cityjson={cityjsons[idx]}")
+        return "done" if succeeded and os.path.exists(cityjsons[idx]) else False
+
+    # Start the postprocessing processes now, as forking once the stage threads run is unsafe
+    post_executor = ProcessPoolExecutor(max_workers=max(1, post_workers))
+    post_executor.submit(int).result()
+
+    def post_job(idx):
+        if not todo[idx, "post"]:
+            return "skipped"
+        profiler.result(post_executor.submit(profiler.wrap(postprocess, "post"), cityjsons[idx], f"T{idx}_", pretty).result(), idx)
+        return "done"
+
+    # Tiles are fed largest first, by their point count estimated from the EPT hierarchy, or along the curve
+    if order == "size":
+        predicted = index.estimate(boxes, index.overlaps(boxes))
+        order = sorted(range(len(tiles)), key=lambda idx: -predicted[idx])
+    else:
+        order = np.argsort(curve_keys(box_centers(boxes), order), kind="stable").tolist()
+    pipeline = StagePipeline([
+        ("tile3d", tile_job, max(1, tile_workers)),
+        ("reconstruct", reconstruct_job, max(1, reconstruct_workers)),
+        ("post", post_job, max(1, post_workers)),
+    ], queue_size, memory_threshold)
+
+    # Results are recorded in this thread only, so the manifest is never written concurrently
+    with Progress() as progress:
+        tasks = {
+            "tile3d": progress.add_task("[cyan]Tiling point cloud", total=len(tiles)),
+            "reconstruct": progress.add_task("[cyan]Reconstructing buildings", total=len(tiles)),
+            "post": progress.add_task("[cyan]Postprocessing CityJSON files", total=len(tiles)),
+        }
+        for stage, idx, result in pipeline.run(order):
+            status = "failed" if not result or isinstance(result, Exception) else result
+            if isinstance(result, Exception):
+                console.print(f"[bold red]Error in {stage} of tile_{idx}: {result}[/bold red]")
+            if stage == "tile3d" and status != "skipped":
+                manifest.record("tile3d", idx, status, ept_inputs, params[idx], [pointclouds[idx]] if status == "done" else [])
+            elif stage == "reconstruct" and status != "skipped":
+                manifest.record("reconstruct", idx, status, {name: path for name, path in inputs[idx].items() if path is not None}, {}, [cityjsons[idx]] if status == "done" else [])
+            elif stage == "post" and status != "skipped":
+                manifest.record("post", os.path.basename(cityjsons[idx]), status, {}, {"prefix": f"T{idx}_"}, [cityjsons[idx]] if status == "done" else [])
+                manifest.update_output("reconstruct", idx, cityjsons[idx])
+            progress.update(tasks[stage], advance=1)
+
+    post_executor.shutdown()
+    manifest.save()
+
+    # Delete the config files after execution
+    os.remove(os.path.join(script_dir, 'reconstruct.json'))
+    os.remove(os.path.join(script_dir, 'reconstruct_.json'))
+
     # Completion message with execution time
     elapsed_time = time.time() - start
     structure = Tree(output)
     structure.add(model_path)
-    console.print(f"[green]\nCityJSON files postprocessed successfully and saved at:[/green] {os.path.abspath(cityjson_full_path)}")
+    console.print(f"[green]\n3D buildings reconstructed successfully and saved at:[/green] {os.path.abspath(model_full_path)}")
     console.print(structure)
     console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(output)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
+
+
+def queue_task(stage, args):
+    # Run a task submitted by tile3d or reconstruct with --queue, returns its JSON result
+    if stage == "tile3d":
+        import geopandas as gpd
+        features = gpd.read_file(args["areas"])
+        count, kept = tile(args["index"], features, args["indexed_path"], args["tiles_path"], args["in_crs"], args["out_crs"], args["crop"], args["classes"], args["prune"], args["extension"])
+        return [int(count), int(kept)]
+
+    if stage == "reconstruct":
+        # GeoFlow reads its configuration from the working directory
+        config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
+        for name in ('reconstruct.json', 'reconstruct_.json'):
+            if not os.path.exists(name):
+                shutil.copy(os.path.join(config_dir, name), f"{name}.{os.getpid()}.tmp")
+                os.replace(f"{name}.{os.getpid()}.tmp", name)
+        succeeded, seconds = reconstruct_tile(args["command"])
+        if not succeeded or not os.path.exists(args["cityjson"]):
+            raise RuntimeError(f"GeoFlow did not write {args['cityjson']}")
+        return seconds
+
+    raise ValueError(f"Unknown task stage: {stage}")
+
+
+@click.command()
+@click.argument("queue", type=click.Path())
+@click.option('--max-workers', type=int, default=os.cpu_count(), show_default=True, help="Number of tasks run at the same time by this worker.")
+@click.option('--wait', type=float, default=60, show_default=True, help="Seconds to wait for new tasks once every task of the queue is finished, before exiting.")
+@profile_option
+
+def worker(queue, max_workers, wait, profile):
+    """
+    Run the tasks of a shared work queue.
+    """
+
+    start = time.time()
+    # Every worker saves its own profile in the queue folder
+    profiler = Profiler(f"worker_{socket.gethostname()}_{os.getpid()}", profile)
+
+    # Print header
+    console.print(f"{copyright}")
+    console.print("[bold cyan]Worker of a shared work queue[/bold cyan]\n")
+
+    # Tasks are claimed with lease files, so any number of workers can share the queue, on any host
+    work_queue = WorkQueue(queue)
+    console.print(f"Running tasks from {os.path.abspath(queue)} with {max_workers} workers. Leases are reclaimed after {work_queue.lease_timeout} s without heartbeat.")
+
+    def execute(stage, args):
+        with profiler.span(stage, args.get("index")):
+            return queue_task(stage, args)
+
+    count = work(work_queue, execute, max_workers=max_workers, wait=wait)
+
+    # Completion message with execution time
+    elapsed_time = time.time() - start
+    console.print(f"[green]\n{count} tasks run.[/green]")
+    console.print(f"\nElapsed time: {time.strftime('%H:%M:%S', time.gmtime(elapsed_time))}")
+    report = profiler.save(queue)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
+
+
+@click.command()
+@click.argument("queue", type=click.Path(exists=True))
+@click.option('--watch', type=float, default=None, help="Refresh every this many seconds until every task is finished.")
+@profile_option
+
+def status(queue, watch, profile):
+    """
+    Show the progress of a shared work queue.
+    """
+
+    from rich.table import Table
+    from rich.live import Live
+    profiler = Profiler("status", profile)
+    work_queue = WorkQueue(queue)
+
+    def table():
+        with profiler.span("scan queue"):
+            counts, workers = work_queue.status()
+        summary = " | ".join(f"{name}: {count}" for name, count in counts.items())
+        result = Table(title=f"{os.path.abspath(queue)}\n{summary}")
+        result.add_column("Worker")
+        result.add_column("Running", justify="right")
+        result.add_column("Finished", justify="right")
+        result.add_column("Mean time", justify="right")
+        for name, entry in sorted(workers.items()):
+            mean = entry["seconds"] / entry["finished"] if entry["finished"] else 0.0
+            result.add_row(name, str(entry["running"]), str(entry["finished"]), f"{mean:.1f} s")
+        return result
+
+    if watch is None:
+        console.print(table())
+    else:
+        with Live(table(), console=console) as live:
+            while not work_queue.finished():
+                time.sleep(watch)
+                live.update(table())
+    report = profiler.save(queue)
+    if report:
+        console.print(f"Profile saved at: {os.path.abspath(report)}")
 
 
 cli.add_command(prepare)
@@ -558,6 +1495,10 @@ cli.add_command(index3d)
 cli.add_command(tile3d)
 cli.add_command(reconstruct)
 cli.add_command(post)
+cli.add_command(merge)
+cli.add_command(run)
+cli.add_command(worker)
+cli.add_command(status)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+# Copyright (c) 2022-2023 - University of Liège
+# Author : Anass Yarroudh (ayarroudh@uliege.be), GeoScITY Lab of ULiege
+# This file is distributed under the BSD-3 licence. See LICENSE file for complete text of the license.
+
+import os
+import json
+import time
+import hashlib
+
+def fingerprint(path, checksum: bool = False):
+    # Size and modification time of a file, plus its BLAKE2 checksum if requested. None if missing.
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    result = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if checksum:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        result["blake2b"] = digest.hexdigest()
+    return result
+
+def same_file(recorded, current):
+    # Compare fingerprints on size and modification time only, so that checking is cheap
+    if recorded is None or current is None:
+        return False
+    return recorded["size"] == current["size"] and recorded["mtime"] == current["mtime"]
+
+class Manifest(object):
+    # Per-stage, per-tile record of a pipeline run, saved as JSON in the output folder:
+    # {stage: {tile: {"status", "inputs", "params", "outputs"}}}. Inputs and outputs are file
+    # fingerprints, params any JSON-serializable values that change the output of the tile.
+    def __init__(self, path, save_interval: float = 5.0):
+        self.path = path
+        self.save_interval = save_interval
+        self.last_save = 0.0
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stages = json.load(f)
+
+    def __repr__(self):
+        return "<Manifest: {}>".format(self.path)
+
+    def entry(self, stage, tile):
+        return self.stages.get(stage, {}).get(str(tile))
+
+    def is_done(self, stage, tile) -> bool:
+        # The tile finished successfully and its outputs are still there
+        entry = self.entry(stage, tile)
+        if entry is None or entry["status"] != "done":
+            return False
+        return all(same_file(recorded, fingerprint(path)) for path, recorded in entry["outputs"].items())
+
+    def is_current(self, stage, tile, inputs, params) -> bool:
+        # The tile is done and was produced from the same inputs and parameters
+        if not self.is_done(stage, tile):
+            return False
+        entry = self.entry(stage, tile)
+        if entry["params"] != json.loads(json.dumps(params)):
+            return False
+        if set(entry["inputs"]) != set(inputs):
+            return False
+        return all(same_file(entry["inputs"][name], fingerprint(path)) for name, path in inputs.items())
+
+    def record(self, stage, tile, status, inputs, params, outputs):
+        # inputs maps names to paths, outputs is a list of paths (checksummed)
+        self.stages.setdefault(stage, {})[str(tile)] = {
+            "status": status,
+            "inputs": {name: fingerprint(path) for name, path in inputs.items()},
+            "params": params,
+            "outputs": {os.path.normpath(path): fingerprint(path, checksum=True) for path in outputs},
+        }
+        if time.time() - self.last_save > self.save_interval:
+            self.save()
+
+    def update_output(self, stage, tile, path):
+        # Refresh the fingerprint of an output that a later stage rewrote in place
+        entry = self.entry(stage, tile)
+        path = os.path.normpath(path)
+        if entry is not None and path in entry["outputs"]:
+            entry["outputs"][path] = fingerprint(path, checksum=True)
+
+    def invalidate(self, stage, tile, remove_outputs: bool = False):
+        # Forget a tile so that the stage runs it again, and remove its outputs if the tile is gone
+        entry = self.stages.get(stage, {}).pop(str(tile), None)
+        if entry is not None and remove_outputs:
+            for path in entry["outputs"]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def save(self):
+        # Write to a temporary file first so that a crash never leaves a truncated manifest
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.stages, f)
+        os.replace(tmp, self.path)
+        self.last_save = time.time()
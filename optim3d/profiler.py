@@ -0,0 +1,239 @@
+# Copyright (c) 2022-2023 - University of Liège
+# Author : Anass Yarroudh (ayarroudh@uliege.be), GeoScITY Lab of ULiege
+# This file is distributed under the BSD-3 licence. See LICENSE file for complete text of the license.
+
+import os
+import json
+import time
+import threading
+import contextlib
+import functools
+
+# resource is only available on Unix, where it gives the CPU time and I/O of finished child processes
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Spans are only recorded when profiling is on in this process (--profile), or inside measure()
+_enabled = False
+_spans = []
+_open = {}
+_local = threading.local()
+_lock = threading.Lock()
+_sampler = None
+SAMPLE_INTERVAL = 0.05
+
+def _reset():
+    # A forked worker process starts with its own lock and no spans
+    global _lock, _spans, _open
+    _lock = threading.Lock()
+    _spans = []
+    _open = {}
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset)
+
+def enabled() -> bool:
+    return _enabled or getattr(_local, "spans", None) is not None
+
+def tree_rss(process) -> int:
+    # Resident memory of a process and all its children
+    import psutil
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+def io_bytes():
+    # Bytes read and written by this thread (Linux) or else this process, plus the blocks of finished
+    # child processes
+    try:
+        with open("/proc/thread-self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        read, written = int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        import psutil
+        try:
+            counters = psutil.Process().io_counters()
+            read, written = getattr(counters, "read_chars", counters.read_bytes), getattr(counters, "write_chars", counters.write_bytes)
+        except (AttributeError, psutil.Error):
+            read, written = 0, 0
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read, written = read + 512 * children.ru_inblock, written + 512 * children.ru_oublock
+    return read, written
+
+def children_cpu() -> float:
+    if resource is None:
+        return 0.0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+def sample():
+    # Background thread updating the peak RSS of the open spans of this process
+    import psutil
+    process = psutil.Process()
+    while True:
+        with _lock:
+            spans = list(_open.values())
+        if spans:
+            try:
+                rss = tree_rss(process)
+            except psutil.Error:
+                rss = 0
+            for record in spans:
+                record["peak_rss"] = max(record["peak_rss"], rss)
+        time.sleep(SAMPLE_INTERVAL)
+
+@contextlib.contextmanager
+def span(name, tile=None):
+    # Record the wall time, CPU time, peak RSS (this process and its children) and bytes read and
+    # written of a block. CPU time and bytes are those of this thread plus the child processes that
+    # finished during the block, so with concurrent threads the child part and the RSS are process-wide.
+    if not enabled():
+        yield None
+        return
+
+    import psutil
+    global _sampler
+    with _lock:
+        if _sampler is None or _sampler[0] != os.getpid():
+            thread = threading.Thread(target=sample, daemon=True)
+            thread.start()
+            _sampler = (os.getpid(), thread)
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    if tile is None and stack:
+        tile = stack[-1]["tile"]
+    tile = tile.item() if hasattr(tile, "item") else tile
+    read, written = io_bytes()
+    try:
+        rss = tree_rss(psutil.Process())
+    except psutil.Error:
+        rss = 0
+    record = {"name": name, "tile": tile, "start": time.time(), "pid": os.getpid(), "tid": threading.get_ident(), "peak_rss": rss}
+    cpu = time.thread_time() + children_cpu()
+    stack.append(record)
+    with _lock:
+        _open[id(record)] = record
+    try:
+        yield record
+    finally:
+        with _lock:
+            del _open[id(record)]
+        stack.pop()
+        record["wall"] = time.time() - record["start"]
+        record["cpu"] = time.thread_time() + children_cpu() - cpu
+        end_read, end_written = io_bytes()
+        record["read_bytes"], record["write_bytes"] = end_read - read, end_written - written
+        spans = getattr(_local, "spans", None)
+        if spans is not None:
+            spans.append(record)
+        else:
+            with _lock:
+                _spans.append(record)
+
+def measure(name, fn, *args):
+    # Call fn in a span and return its result with the spans recorded during the call, so that
+    # spans recorded in worker threads and processes can be collected by the Profiler
+    _local.spans = []
+    try:
+        with span(name):
+            result = fn(*args)
+        return result, _local.spans
+    finally:
+        _local.spans = None
+
+class Profiler(object):
+    # Profile of a command: spans recorded in this process and returned by measured jobs, saved as a
+    # JSON report with a summary per span name, and as a Chrome trace-event file (chrome://tracing or
+    # https://ui.perfetto.dev). A disabled profiler records nothing and leaves jobs unchanged.
+    def __init__(self, command, enabled: bool = False):
+        global _enabled
+        self.command = command
+        self.enabled = enabled
+        self.start = time.time()
+        self.cpu = time.process_time() + children_cpu()
+        self.spans = []
+        if enabled:
+            _enabled = True
+            # Open a span for the whole command, so that its peak RSS is sampled
+            self.root = span(command)
+            self.root.__enter__()
+
+    def __repr__(self):
+        return "<Profiler: {}, {} spans>".format(self.command, len(self.spans) + len(_spans))
+
+    def span(self, name, tile=None):
+        return span(name, tile) if self.enabled else contextlib.nullcontext()
+
+    def wrap(self, fn, name):
+        # Job function recording a span for each call; its results must go through result()
+        return functools.partial(measure, name, fn) if self.enabled else fn
+
+    def result(self, value, tile=None):
+        # Result of a wrapped job, keeping its spans under the given tile
+        if not self.enabled:
+            return value
+        value, spans = value
+        tile = tile.item() if hasattr(tile, "item") else tile
+        for record in spans:
+            record["tile"] = tile if record["tile"] is None else record["tile"]
+        self.spans.extend(spans)
+        return value
+
+    def summary(self, spans):
+        # Totals per span name, with the slowest tile to find stragglers
+        summary = {}
+        for record in spans:
+            entry = summary.setdefault(record["name"], {"count": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0, "slowest_tile": None, "peak_rss": 0, "read_bytes": 0, "write_bytes": 0})
+            entry["count"] += 1
+            entry["wall"] += record["wall"]
+            entry["cpu"] += record["cpu"]
+            entry["peak_rss"] = max(entry["peak_rss"], record["peak_rss"])
+            entry["read_bytes"] += record["read_bytes"]
+            entry["write_bytes"] += record["write_bytes"]
+            if record["wall"] >= entry["max_wall"]:
+                entry["max_wall"], entry["slowest_tile"] = record["wall"], record["tile"]
+        return summary
+
+    def trace(self, spans):
+        # Chrome trace events: one complete event per span, one row per process and thread
+        rows = {}
+        events = []
+        for record in sorted(spans, key=lambda record: record["start"]):
+            tid = rows.setdefault((record["pid"], record["tid"]), len(rows))
+            name = record["name"] if record["tile"] is None else f"{record['name']} tile_{record['tile']}"
+            args = {key: record[key] for key in ("tile", "cpu", "peak_rss", "read_bytes", "write_bytes")}
+            events.append({"name": name, "cat": record["name"], "ph": "X", "ts": int((record["start"] - self.start) * 1e6), "dur": int(record["wall"] * 1e6), "pid": record["pid"], "tid": tid, "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, output):
+        # Write {output}/profile_{command}.json and .trace.json, returns the report path or None
+        if not self.enabled:
+            return None
+        self.root.__exit__(None, None, None)
+        with _lock:
+            spans = _spans + self.spans
+        command = next(record for record in spans if record["name"] == self.command and record["tile"] is None)
+        report = {
+            "command": self.command,
+            "wall": time.time() - self.start,
+            "cpu": time.process_time() + children_cpu() - self.cpu,
+            "peak_rss": command["peak_rss"],
+            "summary": self.summary(spans),
+            "spans": spans,
+        }
+        os.makedirs(output, exist_ok=True)
+        report_path = os.path.join(output, f"profile_{self.command}.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        with open(os.path.join(output, f"profile_{self.command}.trace.json"), "w") as f:
+            json.dump(self.trace(spans), f)
+        return report_path
@@ -0,0 +1,172 @@
+# Copyright (c) 2022-2023 - University of Liège
+# Author : Anass Yarroudh (ayarroudh@uliege.be), GeoScITY Lab of ULiege
+# This file is distributed under the BSD-3 licence. See LICENSE file for complete text of the license.
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Rough peak memory of a job, used to pack jobs when only their size is known
+PDAL_BYTES_PER_POINT = 64
+GEOFLOW_MEMORY_FACTOR = 8
+GEOFLOW_BASE_MEMORY = 256 * 1024 ** 2
+CITYJSON_MEMORY_FACTOR = 10
+
+# End of a stage queue
+_DONE = object()
+
+class AdmissionController(object):
+    # Runs jobs in a pool while keeping system memory under a threshold (percent of total memory).
+    # A job is only started when its estimated memory fits in what is left under the threshold, taking
+    # into account the RSS of this process and its children and the estimates of jobs not yet grown.
+    # The concurrency limit drops by one while memory is above the threshold and grows back by one
+    # while there is headroom, up to max_workers.
+    def __init__(self, max_workers: int, threshold: float = 85.0, headroom: float = 10.0, interval: float = 0.5, executor=ThreadPoolExecutor):
+        self.max_workers = max(1, max_workers)
+        self.threshold = threshold
+        self.headroom = headroom
+        self.interval = interval
+        self.executor = executor
+        self.limit = self.max_workers
+        import psutil
+        self.process = psutil.Process()
+
+    def __repr__(self):
+        return "<AdmissionController: {}/{} workers, {}% memory>".format(self.limit, self.max_workers, self.threshold)
+
+    def rss(self) -> int:
+        # Resident memory of this process and all its children
+        import psutil
+        total = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    def free(self, running_estimates) -> int:
+        # Bytes that can still be committed before reaching the threshold
+        import psutil
+        memory = psutil.virtual_memory()
+        ours = self.rss()
+        others = memory.total - memory.available - ours
+        committed = max(ours, self.base_rss + sum(running_estimates))
+        return int(memory.total * self.threshold / 100) - others - committed
+
+    def adapt(self, blocked: bool):
+        import psutil
+        percent = psutil.virtual_memory().percent
+        if percent > self.threshold:
+            self.limit = max(1, self.limit - 1)
+        elif blocked and percent < self.threshold - self.headroom:
+            self.limit = min(self.max_workers, self.limit + 1)
+
+    def run(self, fn, jobs, estimates=None, ordered: bool = False):
+        # Generator yielding (job index, future) as jobs complete. jobs is a list of argument tuples
+        # for fn, estimates their expected peak memory in bytes (None if unknown). Pending jobs are
+        # taken largest-first, or in the given order if ordered, and smaller jobs are packed into
+        # whatever memory is left.
+        estimates = [0] * len(jobs) if estimates is None else [0 if e is None else int(e) for e in estimates]
+        pending = list(range(len(jobs))) if ordered else sorted(range(len(jobs)), key=lambda i: -estimates[i])
+        running = {}
+        self.base_rss = self.rss()
+
+        with self.executor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                while pending and len(running) < self.limit:
+                    free = self.free(estimates[i] for i in running.values())
+                    job = next((i for i in pending if estimates[i] <= free), None)
+                    if job is None and not running:
+                        # Always keep one job running, even if it does not fit
+                        job = min(pending, key=lambda i: estimates[i]) if ordered else pending[-1]
+                    if job is None:
+                        break
+                    pending.remove(job)
+                    running[executor.submit(fn, *jobs[job])] = job
+                blocked = bool(pending)
+
+                if not running:
+                    continue
+                done, _ = wait(running, timeout=self.interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield running.pop(future), future
+                self.adapt(blocked)
+
+class StagePipeline(object):
+    # Moves items (tiles) through a chain of stages, each with its own pool of worker threads and a
+    # bounded queue in front of it. An item goes on to the next stage as soon as its job is done instead
+    # of waiting for every item of the stage, and a full queue holds back the stage before it.
+    # stages is a list of (name, fn, workers): fn(item) returns a true value when the item may move on.
+    # While system memory is above the threshold, a new job only starts if no other job is running.
+    def __init__(self, stages, queue_size: int = None, threshold: float = 85.0, interval: float = 0.5):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size or 2 * workers) for _, _, workers in stages]
+        self.threshold = threshold
+        self.interval = interval
+        self.events = queue.Queue()
+        self.remaining = [workers for _, _, workers in stages]
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return "<StagePipeline: {}>".format(" -> ".join(name for name, _, _ in self.stages))
+
+    def admit(self):
+        import psutil
+        with self.condition:
+            while self.running and psutil.virtual_memory().percent > self.threshold:
+                self.condition.wait(self.interval)
+            self.running += 1
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def feed(self, items):
+        for item in items:
+            self.queues[0].put(item)
+        for _ in range(self.stages[0][2]):
+            self.queues[0].put(_DONE)
+
+    def work(self, stage):
+        name, fn, _ = self.stages[stage]
+        while True:
+            item = self.queues[stage].get()
+            if item is _DONE:
+                break
+            self.admit()
+            try:
+                result = fn(item)
+            except Exception as e:
+                result = e
+            finally:
+                self.release()
+            self.events.put((name, item, result))
+            if result and not isinstance(result, Exception) and stage + 1 < len(self.stages):
+                self.queues[stage + 1].put(item)
+
+        # The last worker of a stage closes the queue of the next stage
+        with self.condition:
+            self.remaining[stage] -= 1
+            last = self.remaining[stage] == 0
+        if last and stage + 1 < len(self.stages):
+            for _ in range(self.stages[stage + 1][2]):
+                self.queues[stage + 1].put(_DONE)
+        elif last:
+            self.events.put(_DONE)
+
+    def run(self, items):
+        # Generator yielding (stage name, item, result or exception) as jobs finish, in this thread
+        threads = [threading.Thread(target=self.feed, args=(items,), daemon=True)]
+        for stage, (_, _, workers) in enumerate(self.stages):
+            threads += [threading.Thread(target=self.work, args=(stage,), daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            event = self.events.get()
+            if event is _DONE:
+                break
+            yield event
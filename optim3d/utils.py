@@ -6,32 +6,65 @@ import click
 import json
 import os
 import sys
-import rich
-
-env_base = sys.prefix
-proj_lib_path = os.path.join(env_base, 'Library', 'share', 'proj')
-os.environ['PROJ_LIB'] = proj_lib_path
-
-import geopandas as gpd
-import pdal
+import numpy as np
 from typing import List, Any, Union
 import math
 import collections
-import shapely.geometry as geometry
-import psutil
 import subprocess
+import time
+
+# geopandas, shapely, pdal and psutil are imported in the functions that use them, so that the CLI
+# starts fast and the QuadTree classes can be used without them
+
+sys.path.append(os.path.dirname(__file__))
+from profiler import span
+
+def configure_proj():
+    # Use the PROJ database of the environment, set by the CLI before running a command
+    env_base = sys.prefix
+    proj_lib_path = os.path.join(env_base, 'Library', 'share', 'proj')
+    os.environ['PROJ_LIB'] = proj_lib_path
 
 def run_command_in_terminal(cmd):
+    # Return True if the command succeeded
     try:
         # Run the command directly without creating a new terminal window
         subprocess.run(cmd, shell=True, check=True)
+        return True
     except subprocess.CalledProcessError as e:
         print(f"Error running command {cmd}: {e}")
     except Exception as e:
         print(f"Unexpected error running command {cmd}: {e}")
+    return False
+
+def reconstruct_tile(command):
+    # Run GeoFlow for a tile, returns whether it succeeded and its wall time
+    start = time.time()
+    return run_command_in_terminal(command), time.time() - start
+
+def log_reconstruct_times(path, times):
+    # Add the reconstruction time and point cloud size of the tiles of a run (a DataFrame with tile,
+    # bytes and seconds) to the CSV at path, next to those of the previous run of each tile. The rows
+    # of the tiles that were not reconstructed in this run are kept. Returns the rows of this run.
+    import pandas as pd
+    times = times.set_index("tile")
+    if os.path.exists(path):
+        previous = pd.read_csv(path, index_col="tile")
+        times["previous_bytes"] = times.index.map(previous["bytes"])
+        times["previous_seconds"] = times.index.map(previous["seconds"])
+        merged = pd.concat([previous[~previous.index.isin(times.index)], times]).sort_index()
+    else:
+        times["previous_bytes"] = np.nan
+        times["previous_seconds"] = np.nan
+        merged = times.sort_index()
+    tmp = f"{path}.tmp"
+    merged.to_csv(tmp)
+    os.replace(tmp, path)
+    return times.reset_index()
 
 def memory_check():
     # Return the percentage of memory used
+    import psutil
     return psutil.virtual_memory().percent
 
 class OrderedGroup(click.Group):
@@ -127,6 +160,9 @@ class QuadTree(object):
         self.__bounds = bounds
         self.__nodes = []
         self.__objects = []
+        # Largest width and height of the objects in this node and below it: a Bounds goes down the
+        # tree by its corner, so it can reach past the region of its node by that much
+        self.__extent = (0, 0)
 
     def __repr__(self):
         return "<QuadTree: ({}, {}), {}x{}>".format(self.__bounds.x, self.__bounds.y, self.__bounds.width, self.__bounds.height)
@@ -155,6 +191,7 @@ class QuadTree(object):
 
     def clear(self):
         self.__objects = []
+        self.__extent = (0, 0)
         if self.__nodes:
             for i in range(len(self.__nodes)):
                 self.__nodes[i].clear()
@@ -215,6 +252,7 @@ class QuadTree(object):
         return index
 
     def insert(self, bounds: Union[Bounds, Point]):
+        self.__extent = (max(self.__extent[0], getattr(bounds, "width", 0)), max(self.__extent[1], getattr(bounds, "height", 0)))
         if self.__nodes:
             index = self.get_index(bounds)
             if index != -1:
@@ -224,34 +262,54 @@ class QuadTree(object):
         if len(self.__objects) > self.__max_objects and self.__level < self.__max_levels:
             if not self.__nodes:
                 self.split()
+            # Objects lying on a midline stay in this node
+            remaining = []
             for i in range(len(self.__objects)):
                 index = self.get_index(self.__objects[i])
                 if index != -1:
                     self.__nodes[index].insert(self.__objects[i])
-            self.__objects.clear()
+                else:
+                    remaining.append(self.__objects[i])
+            self.__objects = remaining
 
     def retrieve(self, bounds: Union[Bounds, Point]) -> List[Bounds]:
-        index = self.get_index(bounds)
-        return_objects = self.__objects
-
-        if not self.__is_leaf():
-            if index != -1:
-                return_objects.extend(self.__nodes[index].retrieve(bounds))
-            else:
-                for i in range(len(self.__nodes)):
-                    return_objects.extend(self.__nodes[i].retrieve(bounds))
+        # Objects of every node whose region, widened by the extent of its objects, overlaps the bounds.
+        # Walk the tree with an explicit stack and collect into a fresh list so the nodes are never modified.
+        # Regions are cut at the midlines of the parents like in nearest_neighbors.
+        xmin, ymin = bounds.x, bounds.y
+        xmax, ymax = bounds.x + getattr(bounds, "width", 0), bounds.y + getattr(bounds, "height", 0)
+        return_objects = []
+        stack = [(self, (-math.inf, -math.inf, math.inf, math.inf))]
+        while stack:
+            node, region = stack.pop()
+            return_objects.extend(node.__objects)
+            if node.__is_leaf():
+                continue
+            left, bottom, right, top = region
+            vertical_midpoint = node.__bounds.x + (node.__bounds.width / 2)
+            horizontal_midpoint = node.__bounds.y + (node.__bounds.height / 2)
+            quadrants = [
+                (max(left, vertical_midpoint), bottom, right, min(top, horizontal_midpoint)),
+                (left, bottom, min(right, vertical_midpoint), min(top, horizontal_midpoint)),
+                (left, max(bottom, horizontal_midpoint), min(right, vertical_midpoint), top),
+                (max(left, vertical_midpoint), max(bottom, horizontal_midpoint), right, top),
+            ]
+            for child, quadrant in reversed(list(zip(node.__nodes, quadrants))):
+                width, height = child.__extent
+                if quadrant[0] <= xmax and quadrant[2] + width >= xmin and quadrant[1] <= ymax and quadrant[3] + height >= ymin:
+                    stack.append((child, quadrant))
         return return_objects
 
     def retrieve_intersections(self, bounds: Bounds) -> List[Union[Bounds, Point]]:
         found_bounds = []
         potentials: List[Union[Bounds, Point]] = self.retrieve(bounds)
-        for i in range(len(potentials)):
-            if isinstance(potentials[0], Bounds):
-                if bounds.intersects(potentials[i]):
-                    found_bounds.append(potentials[i])
-            if isinstance(potentials[0], Point):
-                if bounds.contain_point(potentials[i]):
-                    found_bounds.append(potentials[i])
+        for potential in potentials:
+            if isinstance(potential, Bounds):
+                if bounds.intersects(potential):
+                    found_bounds.append(potential)
+            elif isinstance(potential, Point):
+                if bounds.contain_point(potential):
+                    found_bounds.append(potential)
         return found_bounds
 
     def find(self, bounds: Union[Bounds, Point]) -> List[int]:
@@ -270,36 +328,851 @@ class QuadTree(object):
                 return True
         return False
 
-    def nearest_neighbors(self, point: Point, radius: float, max_num: int = 10, search_type: str = 'rectangle') -> List[Point]:
-        nearest_results = []
-        search_results = []
-        if search_type == 'rectangle':
-            bounds = Bounds(point.x - radius, point.y - radius, radius * 2, radius * 2)
-            search_results.extend(self.retrieve_intersections(bounds))
-        elif search_type == 'circle':
-            pass
-        nearest_results.extend(sorted(search_results, key=lambda another: euclid_compare(point, another)))
-        return nearest_results[:max_num]
+    def nearest_neighbors(self, point: Point, radius: float = None, max_num: int = 10, search_type: str = 'rectangle') -> List[Union[Bounds, Point]]:
+        # Up to max_num objects nearest to the point, closest first. Only objects within radius are
+        # returned: inside the square of half side radius ('rectangle') or the circle of that radius
+        # ('circle'). radius=None or max_num=None removes the limit.
+        # Best-first search: nodes and objects are taken from a priority queue by their (minimum)
+        # distance to the point, so the search stops as soon as max_num objects are found, and nodes
+        # farther than radius are never visited.
+        import heapq
+        if search_type not in ('rectangle', 'circle'):
+            raise ValueError(f"Unknown search type: {search_type}")
+        limit = math.inf if radius is None else radius
+        found = []
+        heap = [(0.0, 0, self, (-math.inf, -math.inf, math.inf, math.inf))]
+        count = 1
+        while heap and (max_num is None or len(found) < max_num):
+            _, _, item, region = heapq.heappop(heap)
+            if region is None:
+                found.append(item)
+                continue
+
+            for obj in item.__objects:
+                dx = abs(obj.x - point.x)
+                dy = abs(obj.y - point.y)
+                if (max(dx, dy) if search_type == 'rectangle' else math.hypot(dx, dy)) <= limit:
+                    heapq.heappush(heap, (dx * dx + dy * dy, count, obj, None))
+                    count += 1
+
+            # Objects go down to a child by the midlines of its parent (see get_index), so a child holds
+            # the objects of its quadrant of the parent's region, which is unbounded around the root
+            if not item.__is_leaf():
+                xmin, ymin, xmax, ymax = region
+                vertical_midpoint = item.__bounds.x + (item.__bounds.width / 2)
+                horizontal_midpoint = item.__bounds.y + (item.__bounds.height / 2)
+                quadrants = [
+                    (max(xmin, vertical_midpoint), ymin, xmax, min(ymax, horizontal_midpoint)),
+                    (xmin, ymin, min(xmax, vertical_midpoint), min(ymax, horizontal_midpoint)),
+                    (xmin, max(ymin, horizontal_midpoint), min(xmax, vertical_midpoint), ymax),
+                    (max(xmin, vertical_midpoint), max(ymin, horizontal_midpoint), xmax, ymax),
+                ]
+                for child, quadrant in zip(item.__nodes, quadrants):
+                    dx = max(quadrant[0] - point.x, point.x - quadrant[2], 0)
+                    dy = max(quadrant[1] - point.y, point.y - quadrant[3], 0)
+                    if (max(dx, dy) if search_type == 'rectangle' else math.hypot(dx, dy)) <= limit:
+                        heapq.heappush(heap, (dx * dx + dy * dy, count, child, quadrant))
+                        count += 1
+        return found
 
     def create(self):
-        df = gpd.GeoDataFrame(columns=['geometry'], geometry='geometry')
+        # Leaf boxes depth-first, children in split order, built into a GeoDataFrame in one call
+        import geopandas as gpd
+        import shapely
+        boxes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.__is_leaf():
+                boxes.append((node.__bounds.x, node.__bounds.y, node.__bounds.x + node.__bounds.width, node.__bounds.y + node.__bounds.height))
+            else:
+                stack.extend(reversed(node.__nodes))
+        xmin, ymin, xmax, ymax = np.array(boxes, dtype=np.float64).reshape(-1, 4).T
+        return gpd.GeoDataFrame(geometry=shapely.box(xmin, ymin, xmax, ymax))
+
+class ArrayQuadTree(object):
+    # Array-backed QuadTree built in bulk from an (n, 2) array of points.
+    # A node splits when more than max_objects points reach it and its level is
+    # below max_level, exactly like QuadTree.insert, so both trees share the same leaves.
+    # Nodes are stored in flat arrays: bounds as [x, y, width, height], children in
+    # QuadTree.split order (-1 for leaves), and the points kept by each node are the
+    # slice index[offsets[node]:offsets[node + 1]].
+    def __init__(self, bounds: Bounds, points, max_objects: int = 100, max_level: int = 4):
+        self.max_objects = max_objects
+        self.max_level = max_level
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+        boxes = [(bounds.x, bounds.y, bounds.width, bounds.height)]
+        levels = [0]
+        children = [[-1, -1, -1, -1]]
+        members = [np.arange(len(self.points))]
+        kept = [None]
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            idx = members[node]
+            members[node] = None
+            if len(idx) <= max_objects or levels[node] >= max_level:
+                kept[node] = idx
+                continue
+
+            # Same midpoints and child bounds as QuadTree.get_index and QuadTree.split
+            x, y, width, height = boxes[node]
+            sub_width = width / 2
+            sub_height = height / 2
+            vertical_midpoint = x + (width / 2)
+            horizontal_midpoint = y + (height / 2)
+            px = self.points[idx, 0]
+            py = self.points[idx, 1]
+            is_north = py < horizontal_midpoint
+            is_south = py > horizontal_midpoint
+            is_west = px < vertical_midpoint
+            is_east = px > vertical_midpoint
+
+            quadrants = [is_east & is_north, is_west & is_north, is_west & is_south, is_east & is_south]
+            origins = [(x + sub_width, y), (x, y), (x, y + sub_height), (x + sub_width, y + sub_height)]
+
+            # Points lying on a midline stay in the parent node
+            kept[node] = idx[~(quadrants[0] | quadrants[1] | quadrants[2] | quadrants[3])]
+            for i in range(4):
+                child = len(boxes)
+                boxes.append((origins[i][0], origins[i][1], sub_width, sub_height))
+                levels.append(levels[node] + 1)
+                children.append([-1, -1, -1, -1])
+                members.append(idx[quadrants[i]])
+                kept.append(None)
+                children[node][i] = child
+                stack.append(child)
+
+        self.bounds = np.array(boxes, dtype=np.float64)
+        self.levels = np.array(levels, dtype=np.int64)
+        self.children = np.array(children, dtype=np.int64)
+        counts = np.array([len(k) for k in kept], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.index = np.concatenate(kept)
+
+    def __repr__(self):
+        x, y, width, height = self.bounds[0]
+        return "<ArrayQuadTree: ({}, {}), {}x{}>".format(x, y, width, height)
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def node_num(self):
+        return len(self.bounds) - 1
+
+    def is_leaf(self, node: int) -> bool:
+        return self.children[node, 0] == -1
+
+    def node_points(self, node: int):
+        return self.index[self.offsets[node]:self.offsets[node + 1]]
+
+    def leaves(self):
+        # Leaf nodes in the order QuadTree.create draws them (depth-first, children in split order)
+        if self.is_leaf(0):
+            return np.zeros(1, dtype=np.int64)
+        order = []
+        stack = list(reversed(self.children[0]))
+        while stack:
+            node = stack.pop()
+            if self.is_leaf(node):
+                order.append(node)
+            else:
+                stack.extend(reversed(self.children[node]))
+        return np.array(order, dtype=np.int64)
+
+    def query(self, boxes, chunk_size: int = 4_000_000):
+        # Batched range query. boxes is a (k, 4) array of [x, y, width, height] windows, like Bounds.
+        # Returns a (2, m) array of (box index, point index) pairs, sorted by box, for every point
+        # inside a box (edges included, as in Bounds.contain_point). The tree is never modified.
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        xmin = boxes[:, 0]
+        ymin = boxes[:, 1]
+        xmax = boxes[:, 0] + boxes[:, 2]
+        ymax = boxes[:, 1] + boxes[:, 3]
+
+        found_boxes = []
+        found_points = []
+        stack = [(0, np.arange(len(boxes)))]
+        while stack:
+            node, candidates = stack.pop()
+
+            # Test the points kept by this node against all candidate boxes at once
+            idx = self.node_points(node)
+            if len(idx):
+                px = self.points[idx, 0]
+                py = self.points[idx, 1]
+                step = max(1, chunk_size // len(idx))
+                for start in range(0, len(candidates), step):
+                    c = candidates[start:start + step, None]
+                    inside = (px >= xmin[c]) & (px <= xmax[c]) & (py >= ymin[c]) & (py <= ymax[c])
+                    rows, cols = np.nonzero(inside)
+                    found_boxes.append(c[rows, 0])
+                    found_points.append(idx[cols])
+
+            if self.is_leaf(node):
+                continue
+
+            # Only descend into children whose region overlaps the remaining boxes
+            for child in self.children[node]:
+                left, bottom, right, top = self.regions()[child]
+                overlaps = (xmin[candidates] <= right) & (xmax[candidates] >= left) & (ymin[candidates] <= top) & (ymax[candidates] >= bottom)
+                if overlaps.any():
+                    stack.append((child, candidates[overlaps]))
+
+        if not found_boxes:
+            return np.empty((2, 0), dtype=np.int64)
+        found_boxes = np.concatenate(found_boxes)
+        found_points = np.concatenate(found_points)
+        order = np.lexsort((found_points, found_boxes))
+        return np.vstack([found_boxes[order], found_points[order]])
+
+    def retrieve_intersections(self, bounds: Bounds):
+        # Indices of the points inside a single Bounds
+        return self.query([[bounds.x, bounds.y, bounds.width, bounds.height]])[1]
+
+    def regions(self):
+        # [xmin, ymin, xmax, ymax] of the part of the plane whose points go down to each node. A child
+        # gets its quadrant of the region of its parent, cut at the midlines of the parent bounds; the
+        # root region is unbounded, as points outside of the root bounds still go down the tree.
+        if getattr(self, "_regions", None) is None:
+            regions = np.empty((len(self.bounds), 4))
+            regions[0] = [-np.inf, -np.inf, np.inf, np.inf]
+            for node in range(len(self.bounds)):
+                if self.is_leaf(node):
+                    continue
+                xmin, ymin, xmax, ymax = regions[node]
+                x, y, width, height = self.bounds[node]
+                vertical_midpoint = x + (width / 2)
+                horizontal_midpoint = y + (height / 2)
+                regions[self.children[node]] = [
+                    (max(xmin, vertical_midpoint), ymin, xmax, min(ymax, horizontal_midpoint)),
+                    (xmin, ymin, min(xmax, vertical_midpoint), min(ymax, horizontal_midpoint)),
+                    (xmin, max(ymin, horizontal_midpoint), min(xmax, vertical_midpoint), ymax),
+                    (max(xmin, vertical_midpoint), max(ymin, horizontal_midpoint), xmax, ymax),
+                ]
+            self._regions = regions
+        return self._regions
+
+    def min_distance(self, node: int, points):
+        # Squared distance from each (x, y) to the region of a node, 0 inside
+        xmin, ymin, xmax, ymax = self.regions()[node]
+        dx = np.maximum(np.maximum(xmin - points[:, 0], points[:, 0] - xmax), 0)
+        dy = np.maximum(np.maximum(ymin - points[:, 1], points[:, 1] - ymax), 0)
+        return dx * dx + dy * dy
+
+    def locate(self, points):
+        # Node each (x, y) would be kept in: the leaf of its quadrants, or the node whose midline it is on
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        nodes = np.zeros(len(points), dtype=np.int64)
+        active = np.arange(len(points))
+        while len(active):
+            current = nodes[active]
+            internal = self.children[current, 0] != -1
+            active, current = active[internal], current[internal]
+            x, y, width, height = self.bounds[current].T
+            px = points[active, 0]
+            py = points[active, 1]
+            is_north = py < y + (height / 2)
+            is_south = py > y + (height / 2)
+            is_west = px < x + (width / 2)
+            is_east = px > x + (width / 2)
+            quadrant = np.select([is_east & is_north, is_west & is_north, is_west & is_south, is_east & is_south], [0, 1, 2, 3], -1)
+            moved = quadrant >= 0
+            active, current, quadrant = active[moved], current[moved], quadrant[moved]
+            nodes[active] = self.children[current, quadrant]
+        return nodes
+
+    def knn(self, points, k: int = 1, radius: float = None, chunk_size: int = 4_000_000):
+        # Batched k-nearest-neighbour search for an (m, 2) array of query points. Returns (m, k) arrays
+        # of distances and point indices, nearest first, padded with inf and -1 when fewer than k
+        # points are within radius (no limit by default). Each query first searches the node it falls
+        # in, then the tree is walked and a node is only searched for the queries whose current k-th
+        # distance is larger than the distance to the node region.
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        limit = np.inf if radius is None else radius * radius
+        best = np.full((len(queries), k), np.inf)
+        found = np.full((len(queries), k), -1, dtype=np.int64)
+
+        def search(node, candidates):
+            # Merge the points kept by a node into the k nearest of the candidate queries
+            idx = self.node_points(node)
+            if not len(idx) or not len(candidates):
+                return
+            px = self.points[idx, 0]
+            py = self.points[idx, 1]
+            step = max(1, chunk_size // len(idx))
+            for start in range(0, len(candidates), step):
+                c = candidates[start:start + step]
+                distances = (queries[c, 0, None] - px) ** 2 + (queries[c, 1, None] - py) ** 2
+                distances[distances > limit] = np.inf
+                distances = np.concatenate([best[c], distances], axis=1)
+                indices = np.concatenate([found[c], np.broadcast_to(idx, (len(c), len(idx)))], axis=1)
+                nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                best[c] = np.take_along_axis(distances, nearest, axis=1)
+                found[c] = np.take_along_axis(indices, nearest, axis=1)
+
+        home = self.locate(queries)
+        order = np.argsort(home, kind="stable")
+        nodes, starts = np.unique(home[order], return_index=True)
+        for node, group in zip(nodes, np.split(order, starts[1:])):
+            search(node, group)
+
+        stack = [(0, np.arange(len(queries)))]
+        while stack:
+            node, candidates = stack.pop()
+            distance = self.min_distance(node, queries[candidates])
+            candidates = candidates[(distance < best[candidates, -1]) & (distance <= limit)]
+            if not len(candidates):
+                continue
+            search(node, candidates[home[candidates] != node])
+            if not self.is_leaf(node):
+                stack.extend((child, candidates) for child in self.children[node])
+
+        order = np.argsort(best, axis=1, kind="stable")
+        best = np.sqrt(np.take_along_axis(best, order, axis=1))
+        found = np.take_along_axis(found, order, axis=1)
+        found[np.isinf(best)] = -1
+        return best, found
+
+    def query_radius(self, points, radius: float, chunk_size: int = 4_000_000):
+        # Batched circle query. Returns a (2, m) array of (query index, point index) pairs for every
+        # point within radius of a query point (edges included), sorted by query and then by distance.
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        limit = radius * radius
+        found_queries = []
+        found_points = []
+        found_distances = []
+        stack = [(0, np.arange(len(queries)))]
+        while stack:
+            node, candidates = stack.pop()
+            candidates = candidates[self.min_distance(node, queries[candidates]) <= limit]
+            if not len(candidates):
+                continue
+
+            idx = self.node_points(node)
+            if len(idx):
+                px = self.points[idx, 0]
+                py = self.points[idx, 1]
+                step = max(1, chunk_size // len(idx))
+                for start in range(0, len(candidates), step):
+                    c = candidates[start:start + step]
+                    distances = (queries[c, 0, None] - px) ** 2 + (queries[c, 1, None] - py) ** 2
+                    rows, cols = np.nonzero(distances <= limit)
+                    found_queries.append(c[rows])
+                    found_points.append(idx[cols])
+                    found_distances.append(distances[rows, cols])
+
+            if not self.is_leaf(node):
+                stack.extend((child, candidates) for child in self.children[node])
+
+        if not found_queries:
+            return np.empty((2, 0), dtype=np.int64)
+        found_queries = np.concatenate(found_queries)
+        found_points = np.concatenate(found_points)
+        order = np.lexsort((found_points, np.concatenate(found_distances), found_queries))
+        return np.vstack([found_queries[order], found_points[order]])
+
+    def nearest_neighbors(self, point: Point, radius: float = None, max_num: int = 10, search_type: str = 'rectangle'):
+        # Indices of up to max_num points nearest to a single Point, closest first, within the same
+        # square or circle of radius as QuadTree.nearest_neighbors
+        if search_type not in ('rectangle', 'circle'):
+            raise ValueError(f"Unknown search type: {search_type}")
+        if radius is None or (search_type == 'circle' and max_num is not None):
+            idx = self.knn([[point.x, point.y]], max(1, max_num or len(self.points)), radius)[1][0]
+            return idx[idx >= 0][:max_num].tolist()
+        if search_type == 'circle':
+            idx = self.query_radius([[point.x, point.y]], radius)[1]
+        else:
+            idx = self.retrieve_intersections(Bounds(point.x - radius, point.y - radius, radius * 2, radius * 2))
+            distances = (self.points[idx, 0] - point.x) ** 2 + (self.points[idx, 1] - point.y) ** 2
+            idx = idx[np.lexsort((idx, distances))]
+        return idx[:max_num].tolist()
+
+    def create(self):
+        x, y, width, height = self.bounds[self.leaves()].T
+        import geopandas as gpd
+        import shapely
+        return gpd.GeoDataFrame(geometry=shapely.box(x, y, x + width, y + height))
+
+    def save(self, path):
+        save_arrays(path, kind="ArrayQuadTree", max_objects=self.max_objects, max_level=self.max_level, points=self.points, bounds=self.bounds, levels=self.levels, children=self.children, offsets=self.offsets, index=self.index)
+
+    @classmethod
+    def from_arrays(cls, data):
+        tree = cls.__new__(cls)
+        tree.max_objects = int(data["max_objects"])
+        tree.max_level = int(data["max_level"])
+        for name in ("points", "bounds", "levels", "children", "offsets", "index"):
+            setattr(tree, name, data[name])
+        return tree
+
+class WeightedKdTree(object):
+    # Balanced k-d partition of weighted points. A cell is split at the weighted median of its
+    # longer side until its total weight is at most max_weight, so every leaf carries about the
+    # same predicted cost. Nodes use the same flat layout as ArrayQuadTree, with two children.
+    def __init__(self, bounds: Bounds, points, weights, max_weight: float):
+        self.max_weight = max_weight
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+        boxes = [(bounds.x, bounds.y, bounds.width, bounds.height)]
+        children = [[-1, -1]]
+        members = [np.arange(len(self.points))]
+        totals = [self.weights.sum()]
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            idx = members[node]
+            members[node] = None
+            if totals[node] <= max_weight or len(idx) < 2:
+                continue
+
+            x, y, width, height = boxes[node]
+            axes = (0, 1) if width >= height else (1, 0)
+            for axis in axes:
+                coords = self.points[idx, axis]
+                order = np.argsort(coords, kind="stable")
+                coords = coords[order]
+                if coords[0] == coords[-1]:
+                    continue
+
+                # Cut between the weighted median and the next distinct coordinate
+                cumulative = np.cumsum(self.weights[idx[order]])
+                k = min(np.searchsorted(cumulative, cumulative[-1] / 2), len(coords) - 2)
+                k = np.searchsorted(coords, coords[k], side="right") - 1
+                if k == len(coords) - 1:
+                    k = np.searchsorted(coords, coords[k], side="left") - 1
+                cut = (coords[k] + coords[k + 1]) / 2
+                break
+            else:
+                continue
+
+            if axis == 0:
+                halves = [(x, y, cut - x, height), (cut, y, x + width - cut, height)]
+            else:
+                halves = [(x, y, width, cut - y), (x, cut, width, y + height - cut)]
+
+            for i, part in enumerate((idx[order[:k + 1]], idx[order[k + 1:]])):
+                child = len(boxes)
+                boxes.append(halves[i])
+                children.append([-1, -1])
+                members.append(part)
+                totals.append(self.weights[part].sum())
+                children[node][i] = child
+                stack.append(child)
+
+        self.bounds = np.array(boxes, dtype=np.float64)
+        self.children = np.array(children, dtype=np.int64)
+        self.totals = np.array(totals, dtype=np.float64)
+
+    def __repr__(self):
+        x, y, width, height = self.bounds[0]
+        return "<WeightedKdTree: ({}, {}), {}x{}>".format(x, y, width, height)
+
+    @property
+    def node_num(self):
+        return len(self.bounds) - 1
+
+    def is_leaf(self, node: int) -> bool:
+        return self.children[node, 0] == -1
+
+    def leaves(self):
+        order = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.is_leaf(node):
+                order.append(node)
+            else:
+                stack.extend(reversed(self.children[node]))
+        return np.array(order, dtype=np.int64)
+
+    def create(self):
+        x, y, width, height = self.bounds[self.leaves()].T
+        import geopandas as gpd
+        import shapely
+        return gpd.GeoDataFrame(geometry=shapely.box(x, y, x + width, y + height))
+
+    def save(self, path):
+        save_arrays(path, kind="WeightedKdTree", max_weight=self.max_weight, points=self.points, weights=self.weights, bounds=self.bounds, children=self.children, totals=self.totals)
+
+    @classmethod
+    def from_arrays(cls, data):
+        tree = cls.__new__(cls)
+        tree.max_weight = float(data["max_weight"])
+        for name in ("points", "weights", "bounds", "children", "totals"):
+            setattr(tree, name, data[name])
+        return tree
+
+def save_arrays(path, **arrays):
+    # Uncompressed .npz, written to a temporary file first so that an interrupted run never leaves a
+    # truncated tree
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def load_tree(path):
+    # ArrayQuadTree or WeightedKdTree saved with its save method, without rebuilding it
+    with np.load(path, allow_pickle=False) as data:
+        kind = str(data["kind"])
+        arrays = {name: data[name] for name in data.files}
+    return {"ArrayQuadTree": ArrayQuadTree, "WeightedKdTree": WeightedKdTree}[kind].from_arrays(arrays)
+
+# Weights of the reconstruction cost model. A building costs a fixed overhead, plus a share per
+# footprint vertex, plus a share per point expected on its roof (area x point density).
+COST_PER_BUILDING = 1.0
+COST_PER_VERTEX = 0.1
+COST_PER_POINT = 0.01
+DEFAULT_POINT_DENSITY = 10.0
+
+def building_costs(geometries, density=None):
+    # Predicted reconstruction cost of each footprint. density is the point density (points/m²)
+    # around each building, or None to assume DEFAULT_POINT_DENSITY everywhere.
+    import shapely
+    geometries = np.asarray(geometries)
+    density = DEFAULT_POINT_DENSITY if density is None else np.asarray(density, dtype=np.float64)
+    areas = shapely.area(geometries)
+    vertices = shapely.get_num_coordinates(geometries)
+    return COST_PER_BUILDING + COST_PER_VERTEX * vertices + COST_PER_POINT * areas * density
+
+def read_ept_hierarchy(indexed_path):
+    # Point count of every node of an EPT octree, following the sub-hierarchy files (count -1)
+    counts = {}
+    stack = ["0-0-0-0"]
+    while stack:
+        with open(os.path.join(indexed_path, "ept-hierarchy", f"{stack.pop()}.json")) as f:
+            for key, count in json.load(f).items():
+                if count == -1:
+                    stack.append(key)
+                else:
+                    counts[key] = count
+    return counts
+
+class EptDensity(object):
+    # 2D grid of point counts derived from the EPT hierarchy without reading any point data.
+    # Nodes deeper than the grid are added to the cell that contains them; shallower nodes are
+    # spread evenly over the cells they cover.
+    def __init__(self, indexed_path, max_depth: int = 8):
+        with open(os.path.join(indexed_path, "ept.json")) as f:
+            ept = json.load(f)
+        xmin, ymin, _, xmax, _, _ = ept["bounds"]
+        counts = read_ept_hierarchy(indexed_path)
+
+        keys = np.array([[int(v) for v in key.split("-")] for key in counts], dtype=np.int64).reshape(-1, 4)
+        values = np.array(list(counts.values()), dtype=np.float64)
+        depth = int(min(keys[:, 0].max(), max_depth)) if len(keys) else 0
 
-        def draw_all_nodes(node):
+        grid = np.zeros((2 ** depth, 2 ** depth))
+        deep = keys[:, 0] >= depth
+        shift = keys[deep, 0] - depth
+        np.add.at(grid, (keys[deep, 1] >> shift, keys[deep, 2] >> shift), values[deep])
+        for d in range(depth):
+            level = keys[:, 0] == d
+            if not level.any():
+                continue
+            coarse = np.zeros((2 ** d, 2 ** d))
+            np.add.at(coarse, (keys[level, 1], keys[level, 2]), values[level])
+            span = 2 ** (depth - d)
+            grid += np.repeat(np.repeat(coarse, span, axis=0), span, axis=1) / span ** 2
 
-            if (node.__is_leaf()==False):
-                draw_rect(node)
-                for i in range(len(node.__nodes)):
-                    draw_rect(node.__nodes[i])
-                    draw_all_nodes(node.__nodes[i])
+        self.depth = depth
+        self.origin = (xmin, ymin)
+        self.cell_size = (xmax - xmin) / 2 ** depth
+        self.counts = grid
+        horizontal = str(ept.get("srs", {}).get("horizontal", ""))
+        self.epsg = int(horizontal) if horizontal.isdigit() else None
 
-        def draw_rect(node):
-            if (node.__is_leaf()):
-                df.loc[len(df.index)] = [geometry.box(node.__bounds.x, node.__bounds.y, node.__bounds.x + node.__bounds.width, node.__bounds.y + node.__bounds.height)]
+    def __repr__(self):
+        return "<EptDensity: {0}x{0} cells of {1} m>".format(len(self.counts), self.cell_size)
+
+    def check_crs(self, epsg):
+        # The grid is in the coordinates of the EPT index: footprints in another CRS would be looked up
+        # in the wrong cells
+        if self.epsg is not None and epsg is not None and int(epsg) != self.epsg:
+            raise ValueError(f"The footprints are in EPSG:{epsg} but the EPT index is in EPSG:{self.epsg}. Use --crs {self.epsg} to reproject the footprints.")
+
+    def density(self, points):
+        # Points per square unit around each (x, y); zero outside the EPT bounds
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        ix = np.floor((points[:, 0] - self.origin[0]) / self.cell_size).astype(np.int64)
+        iy = np.floor((points[:, 1] - self.origin[1]) / self.cell_size).astype(np.int64)
+        inside = (ix >= 0) & (ix < len(self.counts)) & (iy >= 0) & (iy < len(self.counts))
+        result = np.zeros(len(points))
+        result[inside] = self.counts[ix[inside], iy[inside]] / self.cell_size ** 2
+        return result
+
+def envelopes(minx, miny, maxx, maxy):
+    # Vectorized rectangles with the same vertex order as shapely's envelope
+    import shapely
+    coords = np.stack([
+        np.column_stack([minx, miny]),
+        np.column_stack([maxx, miny]),
+        np.column_stack([maxx, maxy]),
+        np.column_stack([minx, maxy]),
+        np.column_stack([minx, miny]),
+    ], axis=1)
+    return shapely.polygons(coords)
+
+def tile_extents(bounds, nodes):
+    # Extent (minx, miny, maxx, maxy) of the buildings of each tile, from the bounds of the buildings
+    # and their tile
+    return bounds.groupby(nodes).agg({"minx": "min", "miny": "min", "maxx": "max", "maxy": "max"})
+
+def processing_areas(extent, buffer: float = 10):
+    # Processing area of each tile: its extent buffered with 16 segments per quadrant, the same as the
+    # buffered envelope of its dissolved buildings. Tiles whose buildings are all empty have no area.
+    import shapely
+    valid = extent.notna().all(axis=1).to_numpy()
+    areas = np.full(len(extent), None, dtype=object)
+    areas[valid] = shapely.buffer(envelopes(*extent.to_numpy()[valid].T), buffer, quad_segs=16)
+    return areas
+
+# Space-filling curves for ordering tiles and buildings, so that consecutive ones are close in space
+CURVES = ["hilbert", "zorder"]
+
+def spread_bits(v):
+    # Insert a zero bit between each of the lower 16 bits of v
+    v = v & 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    return (v | (v << 1)) & 0x55555555
+
+def curve_keys(points, curve: str = "hilbert", bounds=None, bits: int = 16):
+    # Position of each (x, y) along a Hilbert or Z-order curve over a 2^bits x 2^bits grid covering
+    # bounds [minx, miny, maxx, maxy], by default those of the points. Sorting by key orders the points
+    # along the curve.
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if not len(points):
+        return np.empty(0, dtype=np.int64)
+    if bounds is None:
+        bounds = [points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()]
+    n = 1 << bits
+    size = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) or 1.0
+    x = np.clip(((points[:, 0] - bounds[0]) / size * n).astype(np.int64), 0, n - 1)
+    y = np.clip(((points[:, 1] - bounds[1]) / size * n).astype(np.int64), 0, n - 1)
+
+    if curve == "zorder":
+        return spread_bits(x) | (spread_bits(y) << 1)
+
+    # Hilbert curve: add the quadrant of each level, then rotate the lower bits into its frame
+    keys = np.zeros(len(points), dtype=np.int64)
+    s = n >> 1
+    while s:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return keys
+
+def box_centers(boxes):
+    # Centers of (k, 4) [minx, miny, maxx, maxy] boxes
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.column_stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2])
+
+# OGR drivers of the supported footprint tile formats (GeoParquet is written with pyarrow)
+TILE_FORMATS = {
+    "shp": "ESRI Shapefile",
+    "fgb": "FlatGeobuf",
+    "gpkg": "GPKG",
+    "parquet": None,
+}
+
+def write_footprint_tile(group, path, tile_format):
+    if tile_format == "parquet":
+        group.to_parquet(path)
+    elif tile_format == "shp":
+        group.to_file(path, driver=TILE_FORMATS[tile_format], encoding="utf-8")
+    else:
+        group.to_file(path, driver=TILE_FORMATS[tile_format])
+
+# Number of footprints read at a time by index2d --stream
+FOOTPRINT_CHUNK_SIZE = 100_000
+
+def footprint_chunks(filename, chunk_size: int = FOOTPRINT_CHUNK_SIZE, columns=None, crs=None):
+    # Yield (offset, chunk) for the footprints of a file read chunk_size features at a time, in crs
+    # (EPSG) if given and in EPSG:3857 if geographic, like index2d. columns=[] reads only the geometry.
+    import geopandas as gpd
+    import pandas as pd
+    import pyogrio
+    total = pyogrio.read_info(filename, force_feature_count=True)["features"]
+    for start in range(0, total, chunk_size):
+        chunk = gpd.read_file(filename, rows=slice(start, start + chunk_size), columns=columns, encoding="utf-8")
+        chunk = chunk.to_crs(epsg=crs) if crs else chunk
+        if chunk.crs.is_geographic:
+            chunk = chunk.to_crs(epsg=3857)
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        yield start, chunk
+
+def footprint_centroids(filename, chunk_size: int = FOOTPRINT_CHUNK_SIZE, crs=None, density=None):
+    # First pass of index2d --stream, reading only the geometry: returns the centroid and predicted
+    # cost of every footprint, their total bounds [minx, miny, maxx, maxy] and their EPSG code.
+    # density is an EptDensity or None, raising ValueError if the footprints are in another CRS.
+    import pyogrio
+    total = pyogrio.read_info(filename, force_feature_count=True)["features"]
+    centroids = np.empty((total, 2))
+    costs = np.empty(total)
+    bounds = np.array([np.inf, np.inf, -np.inf, -np.inf])
+    epsg = None
+    for start, chunk in footprint_chunks(filename, chunk_size, columns=[], crs=crs):
+        if density is not None:
+            density.check_crs(chunk.crs.to_epsg())
+        centroid = chunk.geometry.centroid
+        points = np.column_stack([centroid.x, centroid.y])
+        centroids[start:start + len(chunk)] = points
+        costs[start:start + len(chunk)] = building_costs(chunk.geometry.values, None if density is None else density.density(points))
+        minx, miny, maxx, maxy = chunk.total_bounds
+        bounds = np.array([min(bounds[0], minx), min(bounds[1], miny), max(bounds[2], maxx), max(bounds[3], maxy)])
+        epsg = chunk.crs.to_epsg()
+    return centroids, costs, bounds, epsg
+
+def spool_footprints(filename, boundings, costs, parts_path, chunk_size: int = FOOTPRINT_CHUNK_SIZE, crs=None):
+    # Second pass of index2d --stream: join each chunk of footprints with the tiles and append the
+    # buildings of each tile to {parts_path}/tile_{node}.pkl. Returns the extent (minx, miny, maxx,
+    # maxy) and total cost of each tile, indexed by node.
+    import pickle
+    import pandas as pd
+    extent, total = None, None
+    for start, chunk in footprint_chunks(filename, chunk_size, crs=crs):
+        chunk["OIDN"] = footprint_ids(footprint_hashes(chunk))
+        chunk = chunk.sjoin(boundings, how="inner", predicate="intersects")
+        chunk = chunk.rename(columns={"index_right": "node"})
+        chunk["node"] = chunk["node"].astype(np.int64)
+
+        nodes = chunk["node"]
+        cost = pd.Series(costs[chunk.index.to_numpy()], index=chunk.index).groupby(nodes).sum()
+        bounds = tile_extents(chunk.bounds, nodes)
+        total = cost if total is None else total.add(cost, fill_value=0)
+        if extent is None:
+            extent = bounds
+        else:
+            extent = pd.concat([extent, bounds]).groupby(level=0).agg({"minx": "min", "miny": "min", "maxx": "max", "maxy": "max"})
+
+        for node, group in chunk.groupby("node"):
+            with open(os.path.join(parts_path, f"tile_{node}.pkl"), "ab") as f:
+                pickle.dump(group, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return extent, total
+
+def write_spooled_tile(parts, path, tile_format, keys=None):
+    # Write a footprint tile from the chunks appended to its spool file by spool_footprints, with its
+    # buildings sorted by keys (indexed by building) if given
+    import pickle
+    import pandas as pd
+    groups = []
+    with open(parts, "rb") as f:
+        while True:
+            try:
+                groups.append(pickle.load(f))
+            except EOFError:
+                break
+    group = pd.concat(groups)
+    if keys is not None:
+        group = group.iloc[np.argsort(keys[group.index.to_numpy()], kind="stable")]
+    write_footprint_tile(group, path, tile_format)
+    os.remove(parts)
+
+def footprint_hashes(features):
+    # 64-bit hash of the geometry (as WKB) and attributes of each footprint, so that index2d --update
+    # finds the buildings that were added, removed or changed, whatever their ID and row order
+    import pandas as pd
+    import shapely
+    frame = pd.DataFrame(features.drop(columns=features.geometry.name))
+    frame["__wkb"] = shapely.to_wkb(np.asarray(features.geometry.values))
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
 
-        draw_all_nodes(self)
-        return df
+def footprint_ids(hashes):
+    # OIDN of each footprint, the hex of its hash: a building gets the same identifier in every tile it
+    # belongs to and from one run to the next, so that merge can keep only one of its reconstructions
+    return np.array([f"{h:016x}" for h in np.asarray(hashes, dtype=np.uint64).tolist()], dtype=object)
 
-def tile(index, features, indexed_path, tiles_path, in_crs, out_crs):
+def tile_signatures(hashes, tiles, n: int):
+    # Number of buildings and signature of each of n tiles, given the hash of every (building, tile)
+    # pair. The signature is the sum of the hashes modulo 2**64, so it does not depend on the order
+    # of the buildings and only stays the same if the tile has the same buildings.
+    counts = np.bincount(tiles, minlength=n)
+    signatures = np.zeros(n, dtype=np.uint64)
+    np.add.at(signatures, tiles, np.asarray(hashes, dtype=np.uint64))
+    return counts, signatures
+
+def update_tile_ids(previous, boxes):
+    # Number the tiles of the (n, 4) leaf boxes from 0 to n-1, keeping the number of the previous
+    # tile with the same box. New leaves take the numbers left free by the removed ones, as do the
+    # kept tiles numbered n or more, so that the numbers stay contiguous. Returns the numbers and
+    # whether each tile kept its previous number.
+    known = {tuple(box): number for number, box in enumerate(np.asarray(previous).tolist())}
+    ids = np.array([known.get(tuple(box), -1) for box in np.asarray(boxes).tolist()], dtype=np.int64)
+    kept = (ids >= 0) & (ids < len(ids))
+    ids[~kept] = np.setdiff1d(np.arange(len(ids)), ids[kept])
+    return ids, kept
+
+def find_tile(directory, name, extensions):
+    # Path of the first existing {name}.{extension} in directory, or None
+    for extension in extensions:
+        path = os.path.join(directory, f"{name}.{extension}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def footprint_area(filename, distance: float, crs=None):
+    # Union of the footprints of a tile buffered by distance, in crs if given: the points outside
+    # of it are dropped by tile3d --crop
+    import geopandas as gpd
+    import shapely
+    footprints = gpd.read_file(filename)
+    if crs is not None:
+        footprints = footprints.to_crs(crs)
+    area = shapely.union_all(shapely.buffer(footprints.geometry.values, distance))
+    shapely.prepare(area)
+    return area
+
+def crop_points(points, crop, crs=None):
+    # Points within the distance of the footprints, crop being the (footprint tile, distance) of --crop
+    import shapely
+    with span("crop"):
+        area = footprint_area(*crop, crs)
+        return points[shapely.contains_xy(area, points["X"], points["Y"])]
+
+# Extensions of the point cloud tiles, in the order reconstruct looks for them
+POINTCLOUD_FORMATS = ["las", "laz"]
+
+def points_crs(in_crs, out_crs):
+    # CRS of the points written by a pipeline: they are only reprojected if both CRS are known
+    return out_crs if in_crs is not None and out_crs is not None else in_crs
+
+def las_writer(filename, prune: bool = False, srs=None):
+    # writers.las stage of a tile, compressed with LASzip if the filename ends with .laz. With prune,
+    # only the dimensions of LAS point format 0 are written (XYZ, intensity, returns, classification,
+    # scan angle, user data and point source), without GPS time, colors or extra dimensions. srs is
+    # written to the header, as points from numpy arrays do not carry their CRS.
+    stage = {"type": "writers.las", "filename": filename}
+    if srs is not None:
+        stage["a_srs"] = srs
+    if filename.lower().endswith(".laz"):
+        stage["compression"] = "laszip"
+    if prune:
+        stage["dataformat_id"] = 0
+    return stage
+
+def keep_classes(points, classes):
+    # Points whose classification is one of classes, or all the points if classes is None
+    if classes is None or "Classification" not in points.dtype.names:
+        return points
+    return points[np.isin(points["Classification"], classes)]
+
+def tile(index, features, indexed_path, tiles_path, in_crs, out_crs, crop=None, classes=None, prune: bool = False, extension: str = "las"):
+    # Write the points of a processing area to its tile, keeping only the given classes and the
+    # points near the footprints if crop is given. Returns the number of points in the area (of
+    # the given classes) and the number written.
+    import pdal
     minx = features.bounds.iloc[index].minx
     maxx = features.bounds.iloc[index].maxx
     miny = features.bounds.iloc[index].miny
@@ -315,6 +1188,12 @@ def tile(index, features, indexed_path, tiles_path, in_crs, out_crs):
         ]
     }
 
+    if classes is not None:
+        data["pipeline"].append({
+            "type":"filters.range",
+            "limits":",".join(f"Classification[{c}:{c}]" for c in classes)
+        })
+
     if in_crs is not None and out_crs is not None:
         data["pipeline"].append({
             "type":"filters.reprojection",
@@ -322,10 +1201,329 @@ def tile(index, features, indexed_path, tiles_path, in_crs, out_crs):
             "out_srs":out_crs
         })
 
-    data["pipeline"].append({
-        "type":"writers.las",
-        "filename":f"{tiles_path}/tile_{index}.las"
-    })
+    filename = f"{tiles_path}/tile_{index}.{extension}"
+    if crop is not None:
+        pipeline = pdal.Pipeline(json.dumps(data))
+        with span("pdal execute"):
+            count = pipeline.execute()
+        points = np.concatenate(pipeline.arrays) if len(pipeline.arrays) > 1 else pipeline.arrays[0]
+        points = crop_points(points, crop, points_crs(in_crs, out_crs))
+        write_points(points, filename, points_crs(in_crs, out_crs), None, prune)
+        return count, len(points)
+
+    data["pipeline"].append(las_writer(filename, prune, points_crs(in_crs, out_crs)))
+
+    pipeline = pdal.Pipeline(json.dumps(data))
+    with span("pdal execute"):
+        count = pipeline.execute()
+    return count, count
+
+# File extension of the EPT node data for each dataType of ept.json
+EPT_DATA_EXTENSIONS = {"laszip": "laz", "binary": "bin", "zstandard": "zst"}
+
+class EptIndex(object):
+    # Nodes of an EPT index as flat arrays: keys [depth, x, y, z], 2D bounds [xmin, ymin, xmax, ymax],
+    # point counts and the size in bytes of their data files
+    def __init__(self, indexed_path):
+        with open(os.path.join(indexed_path, "ept.json")) as f:
+            ept = json.load(f)
+        xmin, ymin, _, xmax, _, _ = ept["bounds"]
+        counts = read_ept_hierarchy(indexed_path)
+
+        self.path = indexed_path
+        self.data_type = ept.get("dataType", "laszip")
+        self.schema = ept.get("schema", [])
+        self.keys = np.array([[int(v) for v in key.split("-")] for key in counts], dtype=np.int64).reshape(-1, 4)
+        self.counts = np.array(list(counts.values()), dtype=np.int64)
+
+        size = (xmax - xmin) / 2.0 ** self.keys[:, 0]
+        self.bounds = np.column_stack([
+            xmin + self.keys[:, 1] * size,
+            ymin + self.keys[:, 2] * size,
+            xmin + (self.keys[:, 1] + 1) * size,
+            ymin + (self.keys[:, 2] + 1) * size,
+        ])
+
+        extension = EPT_DATA_EXTENSIONS.get(self.data_type, "laz")
+        self.files = [os.path.join(indexed_path, "ept-data", f"{key}.{extension}") for key in counts]
+        self.sizes = np.array([os.path.getsize(f) if os.path.exists(f) else 0 for f in self.files], dtype=np.int64)
+
+    def __repr__(self):
+        return "<EptIndex: {} nodes, {} points>".format(len(self.keys), self.counts.sum())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def overlaps(self, boxes, chunk_size: int = 4_000_000):
+        # (box index, node index) pairs for every node whose bounds overlap a [minx, miny, maxx, maxy] box,
+        # i.e. the nodes readers.ept fetches when it is given that box as bounds
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        step = max(1, chunk_size // max(1, len(self.keys)))
+        found = []
+        for start in range(0, len(boxes), step):
+            b = boxes[start:start + step, None]
+            overlap = (b[..., 0] <= self.bounds[:, 2]) & (b[..., 2] >= self.bounds[:, 0]) & (b[..., 1] <= self.bounds[:, 3]) & (b[..., 3] >= self.bounds[:, 1])
+            rows, cols = np.nonzero(overlap & (self.counts > 0))
+            found.append(np.vstack([rows + start, cols]))
+        return np.hstack(found) if found else np.empty((2, 0), dtype=np.int64)
+
+    def estimate(self, boxes, pairs=None):
+        # Predicted point count of each [minx, miny, maxx, maxy] box, assuming the points of a node
+        # are spread evenly over its footprint
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        pairs = self.overlaps(boxes) if pairs is None else pairs
+        b = boxes[pairs[0]]
+        n = self.bounds[pairs[1]]
+        width = np.clip(np.minimum(b[:, 2], n[:, 2]) - np.maximum(b[:, 0], n[:, 0]), 0, None)
+        height = np.clip(np.minimum(b[:, 3], n[:, 3]) - np.maximum(b[:, 1], n[:, 1]), 0, None)
+        fraction = width * height / ((n[:, 2] - n[:, 0]) * (n[:, 3] - n[:, 1]))
+        return np.bincount(pairs[0], weights=self.counts[pairs[1]] * fraction, minlength=len(boxes))
+
+    def batches(self, nodes, max_points: int):
+        # Split nodes into batches of about max_points, keeping nodes of the same region together
+        nodes = np.asarray(nodes, dtype=np.int64)
+        depth = self.keys[nodes, 0]
+        group_depth = max(0, int(depth.max()) - 2) if len(nodes) else 0
+        shift = np.maximum(depth - group_depth, 0)
+        order = np.lexsort((self.keys[nodes, 2] >> shift, self.keys[nodes, 1] >> shift, depth >= group_depth))
+
+        batches = []
+        current = []
+        points = 0
+        for node in nodes[order]:
+            if current and points + self.counts[node] > max_points:
+                batches.append(np.array(current))
+                current = []
+                points = 0
+            current.append(node)
+            points += self.counts[node]
+        if current:
+            batches.append(np.array(current))
+        return batches
+
+class TileRouter(object):
+    # Uniform grid over the tile boxes [minx, miny, maxx, maxy]: every cell lists the boxes that
+    # overlap it, so a point is only tested against the few boxes of its cell. Boxes may overlap
+    # (buffered processing areas), in which case a point is routed to each of them. Counts the points
+    # routed and the time spent, for the throughput.
+    def __init__(self, boxes, tile_ids=None, cell_size=None, max_cells: int = 4_000_000):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.boxes = boxes
+        self.tile_ids = np.arange(len(boxes)) if tile_ids is None else np.asarray(tile_ids)
+        self.points = 0
+        self.assigned = 0
+        self.seconds = 0.0
+
+        # Cells of about half the smallest side of a typical box, so that a box spans a few cells
+        if len(boxes):
+            self.origin = boxes[:, :2].min(axis=0)
+            extent = np.maximum(boxes[:, 2:].max(axis=0) - self.origin, 1e-9)
+            if cell_size is None:
+                cell_size = np.median(np.minimum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])) / 2
+            cell_size = max(cell_size, 1e-9, float(np.sqrt(extent.prod() / max_cells)))
+        else:
+            self.origin = np.zeros(2)
+            extent = np.ones(2)
+            cell_size = 1.0
+        self.cell_size = cell_size
+        self.shape = (np.floor(extent / cell_size).astype(np.int64) + 1)
+
+        # Cell ranges of every box, expanded to sorted (cell, box) pairs
+        low = np.floor((boxes[:, :2] - self.origin) / cell_size).astype(np.int64)
+        high = np.minimum(np.floor((boxes[:, 2:] - self.origin) / cell_size).astype(np.int64), self.shape - 1)
+        spans = high - low + 1
+        count = spans[:, 0] * spans[:, 1]
+        box = np.repeat(np.arange(len(boxes)), count)
+        offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        cx = low[box, 0] + offset % spans[box, 0]
+        cy = low[box, 1] + offset // spans[box, 0]
+        cell = cy * self.shape[0] + cx
+        order = np.argsort(cell, kind="stable")
+        self.cell_boxes = box[order]
+        self.cell_start = np.searchsorted(cell[order], np.arange(self.shape.prod() + 1))
+
+    def __repr__(self):
+        return "<TileRouter: {} boxes, {}x{} cells of {} m>".format(len(self.boxes), self.shape[0], self.shape[1], self.cell_size)
+
+    @property
+    def points_per_second(self) -> float:
+        return self.points / self.seconds if self.seconds else 0.0
+
+    def route(self, x, y):
+        # (point index, box index) of every point inside every box, sorted by box
+        start = time.perf_counter()
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        ix = np.floor((x - self.origin[0]) / self.cell_size).astype(np.int64)
+        iy = np.floor((y - self.origin[1]) / self.cell_size).astype(np.int64)
+        inside = (ix >= 0) & (ix < self.shape[0]) & (iy >= 0) & (iy < self.shape[1])
+        points = np.nonzero(inside)[0]
+        cell = iy[points] * self.shape[0] + ix[points]
+
+        # Candidate boxes of the cell of each point, then the exact test
+        first = self.cell_start[cell]
+        count = self.cell_start[cell + 1] - first
+        points = np.repeat(points, count)
+        candidates = self.cell_boxes[np.repeat(first - np.cumsum(count) + count, count) + np.arange(count.sum())]
+        b = self.boxes[candidates]
+        px = x[points]
+        py = y[points]
+        hit = (px >= b[:, 0]) & (px <= b[:, 2]) & (py >= b[:, 1]) & (py <= b[:, 3])
+        points, candidates = points[hit], candidates[hit]
+        order = np.argsort(candidates, kind="stable")
+
+        self.points += len(x)
+        self.assigned += len(order)
+        self.seconds += time.perf_counter() - start
+        return points[order], candidates[order]
+
+    def groups(self, x, y):
+        # (tile id, point indices) of every tile that contains points
+        points, boxes = self.route(x, y)
+        starts = np.flatnonzero(np.diff(boxes, prepend=-1))
+        for begin, end in zip(starts, np.append(starts[1:], len(boxes))):
+            yield self.tile_ids[boxes[begin]], points[begin:end]
+
+def read_ept_node(filename, data_type, schema):
+    # Points of a single EPT node as a structured array, with scaled X, Y and Z like PDAL
+    if data_type == "laszip":
+        import pdal
+        pipeline = pdal.Pipeline(json.dumps({"pipeline": [{"type": "readers.las", "filename": filename}]}))
+        pipeline.execute()
+        return pipeline.arrays[0]
+
+    with open(filename, "rb") as f:
+        buffer = f.read()
+    if data_type == "zstandard":
+        import zstandard
+        buffer = zstandard.ZstdDecompressor().decompressobj().decompress(buffer)
+
+    kinds = {"signed": "i", "unsigned": "u", "float": "f"}
+    raw = np.frombuffer(buffer, dtype=[(d["name"], f"<{kinds[d['type']]}{d['size']}") for d in schema])
+    points = np.empty(len(raw), dtype=[(d["name"], "<f8" if "scale" in d else raw.dtype[d["name"]]) for d in schema])
+    for d in schema:
+        points[d["name"]] = raw[d["name"]] * d["scale"] + d.get("offset", 0) if "scale" in d else raw[d["name"]]
+    return points
+
+def write_points(points, filename, in_crs, out_crs, prune: bool = False):
+    import pdal
+    data = {"pipeline": []}
+
+    if in_crs is not None and out_crs is not None:
+        data["pipeline"].append({
+            "type":"filters.reprojection",
+            "in_srs":in_crs,
+            "out_srs":out_crs
+        })
+
+    data["pipeline"].append(las_writer(filename, prune, points_crs(in_crs, out_crs)))
+
+    pipeline = pdal.Pipeline(json.dumps(data), arrays=[points])
+    pipeline.execute()
+
+def tile_ept_nodes(batch, files, data_type, schema, boxes, tile_ids, parts_path, in_crs, out_crs, classes=None):
+    # Read a batch of EPT nodes once and write the points of every tile box that contains them
+    # to a part file, keeping only the given classes. Returns the written (tile id, part file, point count), the bytes read and the
+    # (points, seconds) spent routing.
+    bytes_read = sum(os.path.getsize(f) for f in files)
+    with span("read"):
+        arrays = [read_ept_node(f, data_type, schema) for f in files]
+    points = keep_classes(np.concatenate(arrays) if len(arrays) > 1 else arrays[0], classes)
+    router = TileRouter(boxes, tile_ids)
+
+    parts = []
+    with span("route"):
+        groups = list(router.groups(points["X"], points["Y"]))
+    for tile_id, indices in groups:
+        filename = os.path.join(parts_path, f"tile_{tile_id}_{batch}.las")
+        with span("write part", tile_id):
+            write_points(points[indices], filename, in_crs, out_crs)
+        parts.append((tile_id, filename, len(indices)))
+    return parts, bytes_read, (router.points, router.seconds)
+
+# Points read per chunk from a raw LAS/LAZ file, and points buffered per worker before the
+# largest tile buffers are written to part files
+DIRECT_CHUNK_POINTS = 1_000_000
+DIRECT_BUFFER_POINTS = 10_000_000
+
+def las_files(pointcloud):
+    # LAS/LAZ files of a file or directory, sorted by name
+    if os.path.isdir(pointcloud):
+        return sorted(os.path.join(pointcloud, f) for f in os.listdir(pointcloud) if f.lower().endswith((".las", ".laz")))
+    return [pointcloud]
+
+def tile_las_file(number, filename, boxes, tile_ids, parts_path, in_crs, out_crs, classes=None, chunk_size: int = DIRECT_CHUNK_POINTS, buffer_points: int = DIRECT_BUFFER_POINTS):
+    # Stream a raw LAS/LAZ file in chunks and route every point of the given classes to the tile
+    # boxes that contain it.
+    # Points are buffered per tile, and the largest buffers are written to part files whenever more
+    # than buffer_points are held, so memory stays bounded. Returns the written (tile id, part file,
+    # point count), the points read and the (points, seconds) spent routing.
+    import pdal
+    router = TileRouter(boxes, tile_ids)
+    pipeline = pdal.Pipeline(json.dumps({"pipeline": [{"type": "readers.las", "filename": filename}]}))
+
+    buffers = {}
+    buffered = 0
+    parts = []
+    points_read = 0
+
+    def flush(tile_id):
+        arrays = buffers.pop(tile_id)
+        points = np.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+        part = os.path.join(parts_path, f"tile_{tile_id}_{number}_{len(parts)}.las")
+        with span("write part", tile_id):
+            write_points(points, part, in_crs, out_crs)
+        parts.append((tile_id, part, len(points)))
+        return len(points)
+
+    chunks = pipeline.iterator(chunk_size=chunk_size)
+    while True:
+        with span("read"):
+            points = next(chunks, None)
+        if points is None:
+            break
+        points_read += len(points)
+        points = keep_classes(points, classes)
+        with span("route"):
+            groups = list(router.groups(points["X"], points["Y"]))
+        for tile_id, indices in groups:
+            buffers.setdefault(tile_id, []).append(points[indices])
+            buffered += len(indices)
+
+        # Write the largest buffers until half of the budget is free
+        if buffered > buffer_points:
+            while buffered > buffer_points // 2:
+                largest = max(buffers, key=lambda tile_id: sum(len(a) for a in buffers[tile_id]))
+                buffered -= flush(largest)
+
+    for tile_id in list(buffers):
+        flush(tile_id)
+    return parts, points_read, (router.points, router.seconds)
+
+def merge_tile_parts(parts, filename, crop=None, crs=None, prune: bool = False):
+    # Merge the part files of a tile into its final LAS/LAZ file, the points being in crs. With crop,
+    # only the points near the footprints are kept and their number is returned.
+    if crop is not None:
+        import pdal
+        pipeline = pdal.Pipeline(json.dumps({"pipeline": list(parts)}))
+        pipeline.execute()
+        points = np.concatenate(pipeline.arrays) if len(pipeline.arrays) > 1 else pipeline.arrays[0]
+        points = crop_points(points, crop, crs)
+        write_points(points, filename, crs, None, prune)
+        for part in parts:
+            os.remove(part)
+        return len(points)
+
+    # Parts are plain LAS files with every dimension, so they are only moved if the tile is too
+    if len(parts) == 1 and not prune and not filename.lower().endswith(".laz"):
+        os.replace(parts[0], filename)
+        return
+
+    import pdal
+
+    data = {"pipeline": list(parts) + [las_writer(filename, prune, crs)]}
 
     pipeline = pdal.Pipeline(json.dumps(data))
-    pipeline.execute()
\ No newline at end of file
+    pipeline.execute()
+    for part in parts:
+        os.remove(part)
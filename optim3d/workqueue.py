@@ -0,0 +1,260 @@
+# Copyright (c) 2022-2023 - University of Liège
+# Author : Anass Yarroudh (ayarroudh@uliege.be), GeoScITY Lab of ULiege
+# This file is distributed under the BSD-3 licence. See LICENSE file for complete text of the license.
+
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import threading
+
+# Seconds without heartbeat after which the lease of a worker is stale and its task can be taken
+# over, and seconds between two scans of the queue
+LEASE_TIMEOUT = 120
+POLL_INTERVAL = 2.0
+
+def write_json(path, data):
+    # Write to a temporary file first and rename it, so that other hosts never read a partial file
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class WorkQueue(object):
+    # Tasks shared between processes and hosts through a directory on a shared file system, without
+    # a broker:
+    #   tasks/{id}.json   stage and arguments of a task, with a token that changes when it is submitted again
+    #   leases/{id}.json  the worker running the task. Created with O_EXCL so that only one worker gets it,
+    #                     and touched by the heartbeat of its worker. After lease_timeout without heartbeat,
+    #                     the lease is stale and another worker can take the task over.
+    #   done/{id}.json    status and result of the task, for the token it was run with
+    # Lease ages are measured with the clock of the file server, not with the clocks of the hosts, which
+    # may differ: heartbeats touch the lease without giving a time, so the file server sets its mtime,
+    # and the current time is the mtime of a clock file touched the same way. This assumes a file server
+    # that sets the mtime on its own clock, as NFS and Lustre do; on a local disk, it is the local clock.
+    def __init__(self, path, lease_timeout=None):
+        self.path = path
+        self.clock = os.path.join(path, f".clock.{socket.gethostname()}")
+        for folder in ("tasks", "leases", "done"):
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+        # The lease timeout is set by the coordinator, so that all workers use the same
+        config_path = os.path.join(path, "queue.json")
+        config = read_json(config_path)
+        if lease_timeout is not None or config is None:
+            config = {"lease_timeout": lease_timeout or LEASE_TIMEOUT}
+            write_json(config_path, config)
+        self.lease_timeout = config["lease_timeout"]
+
+    def __repr__(self):
+        return "<WorkQueue: {}>".format(self.path)
+
+    def file(self, folder, task_id):
+        return os.path.join(self.path, folder, f"{task_id}.json")
+
+    def tasks(self):
+        return sorted(f[:-5] for f in os.listdir(os.path.join(self.path, "tasks")) if f.endswith(".json"))
+
+    def task(self, task_id):
+        return read_json(self.file("tasks", task_id))
+
+    def submit(self, task_id, stage, args) -> str:
+        # Add or replace a task, returns its token. A worker still running an older version of the task
+        # keeps its lease, and the new version is run after it.
+        token = uuid.uuid4().hex
+        write_json(self.file("tasks", task_id), {"id": task_id, "stage": stage, "args": args, "token": token})
+        return token
+
+    def result(self, task_id, token=None):
+        # Status and result of a finished task, or None. With a token, only for that version of the task.
+        done = read_json(self.file("done", task_id))
+        if done is None or (token is not None and done["token"] != token):
+            return None
+        return done
+
+    def now(self) -> float:
+        # Current time on the clock of the file server
+        with open(self.clock, "a"):
+            pass
+        os.utime(self.clock)
+        return os.stat(self.clock).st_mtime
+
+    def lease_age(self, task_id, now=None):
+        # Seconds since the last heartbeat of the lease of a task, or None if it is not leased
+        try:
+            return (now or self.now()) - os.stat(self.file("leases", task_id)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def claim(self, worker):
+        # Lease a task that is neither done nor leased, taking over stale leases. Returns the task or None.
+        # Tasks are scanned in random order so that workers starting together do not all race for the same.
+        ids = self.tasks()
+        random.shuffle(ids)
+        now = self.now()
+        for task_id in ids:
+            task = self.task(task_id)
+            if task is None or self.result(task_id, task["token"]) is not None:
+                continue
+            age = self.lease_age(task_id, now)
+            if age is not None and (age < self.lease_timeout or not self.reclaim(task_id)):
+                continue
+            try:
+                fd = os.open(self.file("leases", task_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"worker": worker, "token": task["token"], "claimed": time.time()}, f)
+
+            # The task may have been finished or submitted again since it was read
+            task = self.task(task_id)
+            if task is None or self.result(task_id, task["token"]) is not None:
+                self.release(task_id, worker)
+                continue
+            return task
+        return None
+
+    def reclaim(self, task_id) -> bool:
+        # Take a stale lease away by renaming it, which only one worker can do. If its worker sent a
+        # heartbeat in the meantime, the lease is put back.
+        lease = self.file("leases", task_id)
+        moved = f"{lease}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(lease, moved)
+        except FileNotFoundError:
+            return False
+        try:
+            if self.now() - os.stat(moved).st_mtime < self.lease_timeout:
+                try:
+                    os.link(moved, lease)
+                except FileExistsError:
+                    pass
+                return False
+            return True
+        finally:
+            os.remove(moved)
+
+    def renew(self, task_ids):
+        # Heartbeat of the leases of a worker
+        for task_id in task_ids:
+            try:
+                os.utime(self.file("leases", task_id))
+            except FileNotFoundError:
+                pass
+
+    def release(self, task_id, worker):
+        # Remove a lease, unless it was taken over by another worker
+        lease = read_json(self.file("leases", task_id))
+        if lease is not None and lease["worker"] == worker:
+            try:
+                os.remove(self.file("leases", task_id))
+            except FileNotFoundError:
+                pass
+
+    def complete(self, task, worker, status, result=None, error=None, seconds=None):
+        write_json(self.file("done", task["id"]), {"token": task["token"], "status": status, "result": result, "error": error, "worker": worker, "seconds": seconds, "finished": time.time()})
+        self.release(task["id"], worker)
+
+    def wait(self, tokens, interval: float = POLL_INTERVAL):
+        # Yield (task id, result) as the given tasks {task id: token} finish
+        pending = dict(tokens)
+        while pending:
+            for task_id, token in list(pending.items()):
+                done = self.result(task_id, token)
+                if done is not None:
+                    del pending[task_id]
+                    yield task_id, done
+            if pending:
+                time.sleep(interval)
+
+    def status(self):
+        # Number of tasks per state, and the running and finished tasks of each worker
+        counts = {"total": 0, "done": 0, "failed": 0, "running": 0, "stale": 0, "pending": 0}
+        workers = {}
+        now = self.now()
+        for task_id in self.tasks():
+            task = self.task(task_id)
+            if task is None:
+                continue
+            counts["total"] += 1
+            done = self.result(task_id, task["token"])
+            age = self.lease_age(task_id, now)
+            if done is not None:
+                counts["done" if done["status"] == "done" else "failed"] += 1
+                entry = workers.setdefault(done["worker"], {"running": 0, "finished": 0, "seconds": 0.0})
+                entry["finished"] += 1
+                entry["seconds"] += done["seconds"] or 0.0
+            elif age is None:
+                counts["pending"] += 1
+            elif age >= self.lease_timeout:
+                counts["stale"] += 1
+            else:
+                counts["running"] += 1
+                lease = read_json(self.file("leases", task_id))
+                if lease is not None:
+                    workers.setdefault(lease["worker"], {"running": 0, "finished": 0, "seconds": 0.0})["running"] += 1
+        return counts, workers
+
+    def finished(self) -> bool:
+        counts, _ = self.status()
+        return counts["done"] + counts["failed"] == counts["total"]
+
+def work(queue, execute, max_workers: int = 1, wait: float = 60.0, worker=None):
+    # Claim and run the tasks of a queue with execute(stage, args) in max_workers threads, until every
+    # task is finished and no new task came for wait seconds. Returns the number of tasks run.
+    worker = worker or worker_name()
+    held = set()
+    lock = threading.Lock()
+    stop = threading.Event()
+    count = [0]
+
+    def heartbeat():
+        while not stop.wait(queue.lease_timeout / 4):
+            with lock:
+                task_ids = list(held)
+            queue.renew(task_ids)
+
+    def loop():
+        idle = time.time()
+        while True:
+            task = queue.claim(worker)
+            if task is None:
+                if queue.finished() and time.time() - idle > wait:
+                    return
+                time.sleep(POLL_INTERVAL)
+                continue
+            with lock:
+                held.add(task["id"])
+            start = time.time()
+            try:
+                result = execute(task["stage"], task["args"])
+                queue.complete(task, worker, "done", result, seconds=time.time() - start)
+            except Exception as e:
+                queue.complete(task, worker, "failed", error=str(e), seconds=time.time() - start)
+            finally:
+                with lock:
+                    held.discard(task["id"])
+                    count[0] += 1
+            idle = time.time()
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    threads = [threading.Thread(target=loop) for _ in range(max(1, max_workers))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+    return count[0]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of optim3d import each other by name, like main.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "optim3d"))
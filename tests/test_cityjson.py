@@ -0,0 +1,89 @@
+import json
+
+import numpy as np
+import pytest
+
+from cityjson import CityJSONMerger, namespace_ids
+
+
+def building(key, x0, y0, vertices):
+    # A box building with one BuildingPart, its vertices appended to the vertex list of the tile
+    base = len(vertices)
+    for x, y, z in [(0, 0, 0), (4, 0, 0), (4, 4, 0), (0, 4, 0), (0, 0, 3), (4, 0, 3), (4, 4, 3), (0, 4, 3)]:
+        vertices.append([(x0 + x) * 1000, (y0 + y) * 1000, z * 1000])
+    faces = [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 5, 4], [1, 2, 6, 5], [2, 3, 7, 6], [3, 0, 4, 7]]
+    return {
+        key: {"type": "Building", "children": [f"{key}-0"]},
+        f"{key}-0": {"type": "BuildingPart", "parents": [key], "geometry": [{"type": "Solid", "lod": "2.2", "boundaries": [[[[base + i for i in face]] for face in faces]]}]},
+    }
+
+
+def write_tile(path, tile, buildings, translate):
+    # Buildings given as (source ID, x, y), with the T{tile}_ prefix of the postprocessing
+    vertices = []
+    objects = {}
+    for key, x0, y0 in buildings:
+        objects.update(building(key, x0 - translate[0], y0 - translate[1], vertices))
+    data = {"type": "CityJSON", "version": "2.0", "transform": {"scale": [0.001, 0.001, 0.001], "translate": list(translate)}, "CityObjects": objects, "vertices": vertices}
+    namespace_ids(data, f"T{tile}_")
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+def coordinates(data, key):
+    # Real coordinates of the vertices of an object of the merged file, sorted
+    transform = data["transform"]
+    vertices = np.asarray(data["vertices"], dtype=np.float64) * transform["scale"] + transform["translate"]
+    indices = [i for shell in data["CityObjects"][key]["geometry"][0]["boundaries"] for face in shell for ring in face for i in ring]
+    return sorted(map(tuple, vertices[indices].round(3).tolist()))
+
+
+@pytest.fixture
+def tiles(tmp_path):
+    # Two tiles side by side, split at x = 100. Building "b" straddles the border and is in both tiles,
+    # "c" and "d" touch at x = 100 and share 4 vertices.
+    first = write_tile(tmp_path / "tile_0.city.json", 0, [("a", 10, 10), ("b", 98, 50), ("c", 96, 20)], (0, 0, 0))
+    second = write_tile(tmp_path / "tile_1.city.json", 1, [("b", 98, 50), ("d", 100, 20), ("e", 150, 80)], (100, 0, 0))
+    areas = [[0, 0, 105, 100], [95, 0, 200, 100]]
+    return tmp_path, [first, second], areas
+
+
+def test_merge_drops_duplicate_buildings_and_shared_vertices(tiles):
+    tmp_path, filenames, areas = tiles
+    merger = CityJSONMerger(str(tmp_path / "city.json"), areas=areas)
+    for tile, filename in enumerate(filenames):
+        merger.add(filename, tile=tile)
+    merger.close()
+
+    data = json.loads((tmp_path / "city.json").read_text())
+    buildings = sorted(key for key, value in data["CityObjects"].items() if value["type"] == "Building")
+    assert buildings == ["T0_a", "T0_b", "T0_c", "T1_d", "T1_e"]
+    assert merger.duplicates == 1
+    # 5 buildings of 8 vertices, minus the 4 shared by c and d
+    assert len(data["vertices"]) == merger.vertices_out == 36
+    assert len({tuple(v) for v in data["vertices"]}) == len(data["vertices"])
+    assert coordinates(data, "T1_d-0")[0] == (100.0, 20.0, 0.0)
+    assert coordinates(data, "T1_e-0")[-1] == (154.0, 84.0, 3.0)
+
+
+def test_merge_without_areas_only_drops_duplicate_buildings(tiles):
+    tmp_path, filenames, _ = tiles
+    merger = CityJSONMerger(str(tmp_path / "city.json"))
+    for tile, filename in enumerate(filenames):
+        merger.add(filename, tile=tile)
+    merger.close()
+
+    data = json.loads((tmp_path / "city.json").read_text())
+    assert len([value for value in data["CityObjects"].values() if value["type"] == "Building"]) == 5
+    assert len(data["vertices"]) == 40
+
+
+def test_merge_seq_drops_duplicate_buildings(tiles):
+    tmp_path, filenames, areas = tiles
+    merger = CityJSONMerger(str(tmp_path / "city.city.jsonl"), seq=True, areas=areas)
+    for tile, filename in enumerate(filenames):
+        merger.add(filename, tile=tile)
+    merger.close()
+
+    lines = (tmp_path / "city.city.jsonl").read_text().splitlines()
+    assert [json.loads(line)["id"] for line in lines[1:]] == ["T0_a", "T0_b", "T0_c", "T1_d", "T1_e"]
@@ -0,0 +1,249 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+shapely = pytest.importorskip("shapely")
+
+from manifest import Manifest
+from utils import EptDensity, tile_extents, processing_areas, tile_signatures, update_tile_ids
+
+
+def random_footprints(seed, n=300):
+    # Rectangles and triangles in [0, 300]², plus one isolated building in [900, 1000]²
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(0, 300, n), rng.uniform(0, 300, n)
+    w, h = rng.uniform(2, 20, n), rng.uniform(2, 20, n)
+    geometries = list(shapely.box(x, y, x + w, y + h))
+    geometries[::7] = [shapely.Polygon([(a, b), (a + c, b), (a, b + d)]) for a, b, c, d in zip(x[::7], y[::7], w[::7], h[::7])]
+    geometries.append(shapely.box(950, 950, 960, 958))
+    return gpd.GeoDataFrame({"name": [f"b{i}" for i in range(len(geometries))]}, geometry=geometries)
+
+
+def tiles(buildings):
+    # 4x4 grid of 250 m tiles over [0, 1000]²: most are empty, one has a single building, and the
+    # buildings on tile borders belong to several tiles, like the intersects join of index2d
+    x, y = np.meshgrid(np.arange(0, 1000, 250.0), np.arange(0, 1000, 250.0))
+    grid = gpd.GeoDataFrame(geometry=shapely.box(x.ravel(), y.ravel(), x.ravel() + 250, y.ravel() + 250))
+    joined = buildings.sjoin(grid, how="left", predicate="intersects")
+    return joined.rename(columns={"index_right": "node"})
+
+
+def dissolved_areas(buildings, buffer):
+    # Processing areas as index2d computed them before they were aggregated from the building bounds
+    return buildings.groupby("node").apply(lambda g: g.dissolve().boundary.iloc[0].envelope.buffer(buffer))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("buffer", [10, 2.5])
+def test_processing_areas_match_dissolved_envelopes(seed, buffer):
+    buildings = tiles(random_footprints(seed))
+    extent = tile_extents(buildings.bounds, buildings["node"])
+    areas = processing_areas(extent, buffer)
+    expected = dissolved_areas(buildings, buffer)
+
+    # Tiles without buildings have no processing area, and the others are the same geometries
+    assert list(extent.index) == list(expected.index)
+    assert 0 < len(extent) < 16
+    assert shapely.equals_exact(areas, expected.to_numpy(), tolerance=0).all()
+
+
+def test_single_building_tile():
+    buildings = tiles(random_footprints(0))
+    single = buildings[buildings["node"] == 15]
+    assert len(single) == 1
+
+    extent = tile_extents(single.bounds, single["node"])
+    areas = processing_areas(extent)
+    assert shapely.equals_exact(areas[0], single.geometry.iloc[0].envelope.buffer(10), tolerance=0)
+
+
+def test_tile_of_empty_buildings_has_no_area():
+    buildings = gpd.GeoDataFrame({"node": [0, 1, 1]}, geometry=[shapely.Polygon(), shapely.Polygon(), shapely.box(0, 0, 5, 5)])
+    areas = processing_areas(tile_extents(buildings.bounds, buildings["node"]))
+    assert areas[0] is None
+    assert shapely.equals_exact(areas[1], buildings.geometry.iloc[2].envelope.buffer(10), tolerance=0)
+
+
+def write_ept(path, srs):
+    # EPT index of 100 m over [0, 100]², with 4 points in the root node and 12 in its south-west child
+    (path / "ept-hierarchy").mkdir()
+    (path / "ept.json").write_text(json.dumps({"bounds": [0, 0, 0, 100, 100, 100], "srs": srs}))
+    (path / "ept-hierarchy" / "0-0-0-0.json").write_text(json.dumps({"0-0-0-0": 4, "1-0-0-0": 12}))
+    return str(path)
+
+
+def test_ept_density_checks_the_footprints_crs(tmp_path):
+    density = EptDensity(write_ept(tmp_path, {"horizontal": "31370"}))
+    assert density.epsg == 31370
+    assert density.density([[25, 25], [75, 75], [150, 50]]).tolist() == [(1 + 12) / 2500, 1 / 2500, 0]
+    density.check_crs(31370)
+    density.check_crs(None)
+    with pytest.raises(ValueError, match="EPSG:31370"):
+        density.check_crs(3857)
+
+
+def test_ept_density_without_srs(tmp_path):
+    density = EptDensity(write_ept(tmp_path, {}))
+    assert density.epsg is None
+    density.check_crs(3857)
+
+
+def test_tile_signatures_do_not_depend_on_the_order_of_the_buildings():
+    hashes = np.array([2**63 + 5, 7, 2**64 - 1, 11, 13], dtype=np.uint64)
+    tiles = np.array([0, 2, 0, 2, 0])
+    counts, signatures = tile_signatures(hashes, tiles, 4)
+    assert counts.tolist() == [3, 0, 2, 0]
+    assert signatures.tolist() == [(2**63 + 5 + 2**64 - 1 + 13) % 2**64, 0, 18, 0]
+
+    order = np.array([4, 3, 2, 1, 0])
+    assert [a.tolist() for a in tile_signatures(hashes[order], tiles[order], 4)] == [counts.tolist(), signatures.tolist()]
+
+    # A building replaced by another one changes the signature of its tile only
+    changed = hashes.copy()
+    changed[1] = 8
+    assert (tile_signatures(changed, tiles, 4)[1] != signatures).tolist() == [False, False, True, False]
+
+
+def test_update_tile_ids_keeps_the_numbers_of_unchanged_leaves():
+    previous = np.array([[0, 0, 1, 1], [1, 0, 1, 1], [2, 0, 1, 1], [3, 0, 1, 1], [4, 0, 1, 1]], dtype=float)
+
+    # Same leaves in another order
+    ids, kept = update_tile_ids(previous, previous[[3, 1, 4, 0, 2]])
+    assert ids.tolist() == [3, 1, 4, 0, 2] and kept.all()
+
+    # Leaf 1 split in two, leaf 3 removed: the new leaves take the free numbers, from the lowest
+    boxes = np.vstack([previous[[0, 2, 4]], [[1, 0, 0.5, 1], [1.5, 0, 0.5, 1]]])
+    ids, kept = update_tile_ids(previous, boxes)
+    assert ids.tolist() == [0, 2, 4, 1, 3]
+    assert kept.tolist() == [True, True, True, False, False]
+
+    # Fewer tiles: a kept leaf numbered past the end is renumbered so that the numbers stay contiguous
+    ids, kept = update_tile_ids(previous, previous[[0, 4, 2]])
+    assert sorted(ids.tolist()) == [0, 1, 2]
+    assert ids.tolist() == [0, 1, 2] and kept.tolist() == [True, False, True]
+
+    # No previous tiles
+    ids, kept = update_tile_ids(np.empty((0, 4)), previous[:2])
+    assert ids.tolist() == [0, 1] and not kept.any()
+
+
+def run_index2d(*args):
+    from click.testing import CliRunner
+    from main import cli
+    result = CliRunner().invoke(cli, list(args), catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    assert "Error" not in result.output, result.output
+    return result.output
+
+
+def footprints_file(path, buildings):
+    buildings.set_crs(31370, allow_override=True).to_file(path, driver="GPKG")
+    return str(path)
+
+
+def read_tiles(output, extension="gpkg"):
+    # Buildings of every footprint tile as {tile number: {(name, wkb)}}
+    tiles_path = os.path.join(output, "footprint_tiles")
+    tiles = {}
+    for f in os.listdir(tiles_path):
+        if f.endswith(f".{extension}"):
+            frame = gpd.read_file(os.path.join(tiles_path, f))
+            tiles[int(f.split(".")[0].split("_")[1])] = set(zip(frame["name"], shapely.to_wkb(frame.geometry.values)))
+    return tiles
+
+
+def grid_footprints(n=1500, seed=5):
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(0, 1000, n), rng.uniform(0, 1000, n)
+    return gpd.GeoDataFrame({"name": [f"b{i}" for i in range(n)]}, geometry=shapely.box(x, y, x + rng.uniform(3, 15, n), y + rng.uniform(3, 15, n)))
+
+
+def test_update_only_rewrites_the_changed_tiles(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    output = str(tmp_path / "output")
+    buildings = grid_footprints()
+    run_index2d("prepare", "--output", output)
+    run_index2d("index2d", footprints_file(tmp_path / "before.gpkg", buildings), "--output", output, "--max", "60", "--tile-format", "gpkg")
+    before = read_tiles(output)
+    assert sorted(before) == list(range(len(before))) and len(before) > 20
+
+    # Outputs of the next stages for every tile, and footprint tiles dated so that rewritten ones stand out
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+    for tile in before:
+        pointcloud = os.path.join(output, "pointcloud_tiles", f"tile_{tile}.las")
+        cityjson = os.path.join(output, "model", "cityjson", f"tile_{tile}.city.json")
+        for path in (pointcloud, cityjson):
+            open(path, "w").close()
+        manifest.record("tile3d", tile, "done", {}, {}, [pointcloud])
+        manifest.record("reconstruct", tile, "done", {}, {}, [cityjson])
+        manifest.record("post", f"tile_{tile}.city.json", "done", {}, {}, [cityjson])
+        os.utime(os.path.join(output, "footprint_tiles", f"tile_{tile}.gpkg"), (0, 0))
+    manifest.save()
+
+    # Three buildings moved by a metre, and every building of the north-east corner removed, so that
+    # leaves merge and the number of tiles drops
+    edited = buildings.copy()
+    moved = [10, 200, 700]
+    edited.loc[moved, "geometry"] = edited.loc[moved].geometry.translate(1, 0)
+    centroids = edited.geometry.centroid
+    edited = edited[~((centroids.x > 750) & (centroids.y > 750))]
+    run_index2d("index2d", footprints_file(tmp_path / "after.gpkg", edited), "--output", output, "--max", "60", "--tile-format", "gpkg", "--update")
+    after = read_tiles(output)
+    assert sorted(after) == list(range(len(after))) and len(after) < len(before)
+
+    # Only the tiles whose buildings changed are rewritten
+    rewritten = {tile for tile in after if os.stat(os.path.join(output, "footprint_tiles", f"tile_{tile}.gpkg")).st_mtime != 0}
+    assert rewritten == {tile for tile in after if after[tile] != before.get(tile)}
+    assert 0 < len(rewritten) < len(after) // 2
+    assert set().union(*after.values()) == set(zip(edited["name"], shapely.to_wkb(edited.geometry.values)))
+
+    # Row i of the processing areas is the buffered extent of tile i
+    areas = gpd.read_file(os.path.join(output, "processing_areas.gpkg"))
+    assert len(areas) == len(after)
+    for tile, members in after.items():
+        extent = shapely.GeometryCollection(shapely.from_wkb([wkb for _, wkb in members])).bounds
+        np.testing.assert_allclose(areas.geometry.iloc[tile].bounds, np.array(extent) + [-10, -10, 10, 10])
+
+    # The next stages forget the rewritten tiles, and the removed tiles lose their outputs
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+    for tile in range(len(before)):
+        kept = tile in after and tile not in rewritten
+        assert (manifest.entry("tile3d", tile) is not None) == kept
+        assert (manifest.entry("reconstruct", tile) is not None) == kept
+        assert (manifest.entry("post", f"tile_{tile}.city.json") is not None) == kept
+        removed = tile >= len(after)
+        assert os.path.exists(os.path.join(output, "pointcloud_tiles", f"tile_{tile}.las")) != removed
+        assert os.path.exists(os.path.join(output, "model", "cityjson", f"tile_{tile}.city.json")) != removed
+        assert os.path.exists(os.path.join(output, "footprint_tiles", f"tile_{tile}.gpkg")) != removed
+
+
+@pytest.mark.parametrize("partition", ["quadtree", "cost"])
+def test_stream_writes_the_same_tiles(tmp_path, monkeypatch, partition):
+    pytest.importorskip("pyogrio")
+    monkeypatch.chdir(tmp_path)
+    footprints = footprints_file(tmp_path / "footprints.gpkg", grid_footprints())
+    outputs = {}
+    for mode, extra in [("memory", []), ("stream", ["--stream", "--chunk-size", "400"])]:
+        output = str(tmp_path / mode)
+        run_index2d("prepare", "--output", output)
+        run_index2d("index2d", footprints, "--output", output, "--max", "60", "--tile-format", "gpkg", "--partition", partition, *extra)
+        outputs[mode] = output
+
+    # Same buildings in every tile, with the same attributes in the same order
+    memory, stream = read_tiles(outputs["memory"]), read_tiles(outputs["stream"])
+    assert len(memory) > 20 and memory == stream
+    for tile in memory:
+        a = gpd.read_file(os.path.join(outputs["memory"], "footprint_tiles", f"tile_{tile}.gpkg"))
+        b = gpd.read_file(os.path.join(outputs["stream"], "footprint_tiles", f"tile_{tile}.gpkg"))
+        assert sorted(a.columns) == sorted(b.columns)
+        assert a[sorted(a.columns)].equals(b[sorted(a.columns)])
+
+    # Same processing areas, row for row
+    a = gpd.read_file(os.path.join(outputs["memory"], "processing_areas.gpkg"))
+    b = gpd.read_file(os.path.join(outputs["stream"], "processing_areas.gpkg"))
+    assert a.crs == b.crs
+    assert shapely.equals_exact(a.geometry.values, b.geometry.values, tolerance=1e-9).all()
+    np.testing.assert_allclose(a["cost"], b["cost"])
@@ -0,0 +1,230 @@
+import numpy as np
+import pytest
+
+from utils import QuadTree, ArrayQuadTree, WeightedKdTree, Bounds, Point, load_tree
+
+ROOT = Bounds(0, 0, 1000, 1000)
+
+
+def dataset(kind, n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 1000, (n, 2))
+    if kind == "duplicates":
+        # Every point three times, and many on a coarse grid
+        points = np.round(np.repeat(points[:n // 3], 3, axis=0) / 100) * 100
+    elif kind == "midlines":
+        # Points exactly on the midlines of the root and of its children
+        points[::2, 0] = rng.choice([250.0, 500.0, 750.0], len(points[::2]))
+        points[::3, 1] = rng.choice([250.0, 500.0, 750.0], len(points[::3]))
+    elif kind == "outside":
+        # A third of the points outside the root bounds
+        points[::3] = rng.uniform(-500, 1500, (len(points[::3]), 2))
+    return points
+
+
+def queries(points, seed=1):
+    rng = np.random.default_rng(seed)
+    return np.vstack([rng.uniform(-300, 1300, (40, 2)), points[:10], [[500, 500], [250, 750], [0, 0]]])
+
+
+def brute(points, query, radius=None, square=False):
+    # Indices of the points within radius of the query (all without radius), nearest first, and the
+    # distance to every point
+    distances = np.hypot(points[:, 0] - query[0], points[:, 1] - query[1])
+    inside = np.ones(len(points), dtype=bool)
+    if radius is not None:
+        inside = (np.maximum(abs(points[:, 0] - query[0]), abs(points[:, 1] - query[1])) if square else distances) <= radius
+    idx = np.flatnonzero(inside)
+    return idx[np.argsort(distances[idx], kind="stable")], distances
+
+
+def object_tree(points):
+    tree = QuadTree(ROOT, max_objects=8, max_level=6)
+    for i, (x, y) in enumerate(points):
+        tree.insert(Point(x, y, i))
+    return tree
+
+
+KINDS = ["random", "duplicates", "midlines", "outside"]
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("k", [1, 7])
+@pytest.mark.parametrize("radius", [None, 0.0, 60.0])
+def test_knn_matches_brute_force(kind, k, radius):
+    points = dataset(kind)
+    tree = ArrayQuadTree(ROOT, points, max_objects=8, max_level=6)
+    q = queries(points)
+    distances, indices = tree.knn(q, k, radius)
+    assert distances.shape == indices.shape == (len(q), k)
+    for i, query in enumerate(q):
+        expected, d = brute(points, query, radius)
+        found = indices[i][indices[i] >= 0]
+        assert len(found) == min(k, len(expected))
+        assert len(set(found.tolist())) == len(found)
+        np.testing.assert_allclose(d[found], d[expected[:k]])
+        np.testing.assert_allclose(distances[i][:len(found)], d[found])
+        assert np.isinf(distances[i][len(found):]).all()
+
+
+def test_knn_with_k_larger_than_the_number_of_points():
+    points = dataset("random", n=5)
+    tree = ArrayQuadTree(ROOT, points, max_objects=2)
+    distances, indices = tree.knn(queries(points), k=9)
+    assert (np.sort(indices[:, :5], axis=1) == np.arange(5)).all()
+    assert (indices[:, 5:] == -1).all() and np.isinf(distances[:, 5:]).all()
+    assert (np.diff(distances[:, :5], axis=1) >= 0).all()
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("radius", [0.0, 25.0, 150.0])
+def test_query_radius_matches_brute_force(kind, radius):
+    points = dataset(kind)
+    tree = ArrayQuadTree(ROOT, points, max_objects=8, max_level=6)
+    q = queries(points)
+    pairs = tree.query_radius(q, radius)
+    assert (np.diff(pairs[0]) >= 0).all()
+    for i, query in enumerate(q):
+        expected, d = brute(points, query, radius)
+        found = pairs[1][pairs[0] == i]
+        assert sorted(found.tolist()) == sorted(expected.tolist())
+        assert (np.diff(d[found]) >= 0).all()
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("search_type", ["rectangle", "circle"])
+@pytest.mark.parametrize("radius,max_num", [(None, 5), (0.0, 10), (80.0, 10), (80.0, None), (None, 1000)])
+def test_nearest_neighbors_match_brute_force(kind, search_type, radius, max_num):
+    points = dataset(kind, n=150)
+    array_tree = ArrayQuadTree(ROOT, points, max_objects=8, max_level=6)
+    tree = object_tree(points)
+    for query in queries(points)[::3]:
+        expected, d = brute(points, query, radius, square=search_type == "rectangle")
+        expected = expected[:max_num]
+        found = [p.data for p in tree.nearest_neighbors(Point(*query), radius, max_num, search_type)]
+        assert len(found) == len(expected)
+        np.testing.assert_allclose(d[found], d[expected])
+        found = array_tree.nearest_neighbors(Point(*query), radius, max_num, search_type)
+        assert len(found) == len(expected)
+        np.testing.assert_allclose(d[found], d[expected])
+
+
+def test_nearest_neighbors_rejects_unknown_search_type():
+    points = dataset("random", n=10)
+    with pytest.raises(ValueError):
+        object_tree(points).nearest_neighbors(Point(0, 0), search_type="diamond")
+    with pytest.raises(ValueError):
+        ArrayQuadTree(ROOT, points).nearest_neighbors(Point(0, 0), search_type="diamond")
+
+
+def windows(seed=2):
+    # Random windows, and windows crossing the midlines of the root and of its children
+    rng = np.random.default_rng(seed)
+    random = np.column_stack([rng.uniform(-300, 1200, (30, 2)), rng.uniform(0, 400, (30, 2))])
+    crossing = [[400, 400, 200, 200], [0, 450, 1000, 100], [450, 0, 100, 1000], [200, 200, 100, 100], [700, 700, 100, 100], [500, 500, 0, 0], [-500, -500, 2000, 2000]]
+    return np.vstack([random, crossing])
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_retrieve_intersections_matches_brute_force(kind):
+    points = dataset(kind)
+    tree = object_tree(points)
+    for x, y, width, height in windows():
+        window = Bounds(x, y, width, height)
+        found = sorted(p.data for p in tree.retrieve_intersections(window))
+        expected = np.flatnonzero((points[:, 0] >= x) & (points[:, 0] <= x + width) & (points[:, 1] >= y) & (points[:, 1] <= y + height))
+        assert found == expected.tolist()
+    assert len(list(tree)) == len(points)
+
+
+def test_retrieve_intersections_of_bounds_reaching_past_their_quadrant():
+    # Boxes go down the tree by their corner, so a box west of a midline can still cross it
+    rng = np.random.default_rng(3)
+    corners = rng.uniform(0, 1000, (400, 2))
+    sizes = rng.uniform(0, 150, (400, 2))
+    tree = QuadTree(ROOT, max_objects=8, max_level=6)
+    objects = [Bounds(x, y, w, h) for (x, y), (w, h) in zip(corners, sizes)]
+    for obj in objects:
+        tree.insert(obj)
+    for x, y, width, height in windows():
+        window = Bounds(x, y, width, height)
+        found = {id(obj) for obj in tree.retrieve_intersections(window)}
+        assert found == {id(obj) for obj in objects if window.intersects(obj)}
+    assert len(list(tree)) == len(objects)
+
+
+def object_nodes(tree):
+    # (box, sorted point numbers, is leaf) of every node of a QuadTree, depth-first in split order
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        bounds = node._QuadTree__bounds
+        children = node._QuadTree__nodes
+        nodes.append(((bounds.x, bounds.y, bounds.width, bounds.height), sorted(p.data for p in node._QuadTree__objects), not children))
+        stack.extend(reversed(children))
+    return nodes
+
+
+def array_nodes(tree):
+    nodes = []
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        nodes.append((tuple(tree.bounds[node].tolist()), sorted(tree.node_points(node).tolist()), bool(tree.is_leaf(node))))
+        if not tree.is_leaf(node):
+            stack.extend(reversed(tree.children[node].tolist()))
+    return nodes
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("max_objects, max_level", [(8, 2), (8, 6), (1, 10), (50, 4)])
+def test_array_quadtree_has_the_same_leaves_as_quadtree(kind, max_objects, max_level):
+    points = dataset(kind)
+    tree = QuadTree(ROOT, max_objects=max_objects, max_level=max_level)
+    for i, (x, y) in enumerate(points):
+        tree.insert(Point(x, y, i))
+    array = ArrayQuadTree(ROOT, points, max_objects=max_objects, max_level=max_level)
+
+    # Same nodes with the same points, including the points kept on midlines by inner nodes
+    assert array_nodes(array) == object_nodes(tree)
+    assert array.node_num == tree.node_num
+
+    # Same leaf boxes, in the same order
+    pytest.importorskip("geopandas")
+    leaves = array.bounds[array.leaves()]
+    np.testing.assert_array_equal(np.column_stack([leaves[:, 0], leaves[:, 1], leaves[:, 0] + leaves[:, 2], leaves[:, 1] + leaves[:, 3]]), tree.create().bounds.to_numpy())
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_saved_array_quadtree_loads_back_the_same_tree(kind, tmp_path):
+    points = dataset(kind)
+    tree = ArrayQuadTree(ROOT, points, max_objects=8, max_level=6)
+    tree.save(str(tmp_path / "quadtree.npz"))
+    loaded = load_tree(str(tmp_path / "quadtree.npz"))
+
+    assert type(loaded) is ArrayQuadTree
+    assert (loaded.max_objects, loaded.max_level) == (tree.max_objects, tree.max_level)
+    np.testing.assert_array_equal(loaded.points, tree.points)
+    np.testing.assert_array_equal(loaded.bounds, tree.bounds)
+    np.testing.assert_array_equal(loaded.leaves(), tree.leaves())
+    assert array_nodes(loaded) == array_nodes(tree)
+    q = queries(points)
+    np.testing.assert_array_equal(loaded.locate(q), tree.locate(q))
+    np.testing.assert_array_equal(loaded.knn(q, 5)[1], tree.knn(q, 5)[1])
+
+
+def test_saved_weighted_kd_tree_loads_back_the_same_tree(tmp_path):
+    points = dataset("random")
+    weights = np.random.default_rng(4).uniform(0.5, 3, len(points))
+    tree = WeightedKdTree(ROOT, points, weights, max_weight=40)
+    tree.save(str(tmp_path / "kdtree.npz"))
+    loaded = load_tree(str(tmp_path / "kdtree.npz"))
+
+    assert type(loaded) is WeightedKdTree
+    assert loaded.max_weight == tree.max_weight
+    np.testing.assert_array_equal(loaded.points, tree.points)
+    np.testing.assert_array_equal(loaded.weights, tree.weights)
+    np.testing.assert_array_equal(loaded.bounds, tree.bounds)
+    np.testing.assert_array_equal(loaded.leaves(), tree.leaves())
+    np.testing.assert_array_equal(loaded.totals, tree.totals)
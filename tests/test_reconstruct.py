@@ -0,0 +1,21 @@
+import pandas as pd
+
+from utils import log_reconstruct_times
+
+
+def test_reconstruct_times_keep_the_other_tiles(tmp_path):
+    path = str(tmp_path / "reconstruct_times.csv")
+    first = log_reconstruct_times(path, pd.DataFrame({"tile": [0, 1, 2], "bytes": [100, 200, 300], "seconds": [1.0, 2.0, 3.0]}))
+    assert first["previous_seconds"].isna().all()
+
+    # A resumed run that only reconstructs tile 1 and a new tile 3
+    second = log_reconstruct_times(path, pd.DataFrame({"tile": [1, 3], "bytes": [150, 400], "seconds": [1.5, 4.0]}))
+    assert list(second["tile"]) == [1, 3]
+    assert second.loc[0, "previous_bytes"] == 200 and second.loc[0, "previous_seconds"] == 2.0
+    assert pd.isna(second.loc[1, "previous_seconds"])
+
+    logged = pd.read_csv(path, index_col="tile")
+    assert list(logged.index) == [0, 1, 2, 3]
+    assert list(logged["seconds"]) == [1.0, 1.5, 3.0, 4.0]
+    assert list(logged["bytes"]) == [100, 150, 300, 400]
+    assert logged.loc[1, "previous_seconds"] == 2.0
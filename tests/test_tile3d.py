@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from utils import TileRouter, las_writer, points_crs
+
+
+def test_points_are_only_reprojected_when_both_crs_are_known():
+    assert points_crs("EPSG:31370", "EPSG:3812") == "EPSG:3812"
+    assert points_crs("EPSG:31370", None) == "EPSG:31370"
+    assert points_crs(None, "EPSG:3812") is None
+    assert points_crs(None, None) is None
+
+
+def test_las_writer_assigns_the_crs():
+    assert las_writer("tile_0.las", srs="EPSG:31370") == {"type": "writers.las", "filename": "tile_0.las", "a_srs": "EPSG:31370"}
+    assert las_writer("tile_0.laz", prune=True) == {"type": "writers.las", "filename": "tile_0.laz", "compression": "laszip", "dataformat_id": 0}
+
+
+def brute_route(boxes, x, y):
+    inside = (x[:, None] >= boxes[:, 0]) & (x[:, None] <= boxes[:, 2]) & (y[:, None] >= boxes[:, 1]) & (y[:, None] <= boxes[:, 3])
+    points, candidates = np.nonzero(inside)
+    return sorted(zip(candidates.tolist(), points.tolist()))
+
+
+def router_case(seed):
+    # Overlapping boxes of various sizes, points inside and around them, and points exactly on the
+    # edges and corners of the boxes, including those on the edge of the grid
+    rng = np.random.default_rng(seed)
+    corners = rng.uniform(0, 1000, (40, 2))
+    boxes = np.hstack([corners, corners + rng.uniform(1, 300, (40, 2))])
+    x, y = rng.uniform(-100, 1400, 3000), rng.uniform(-100, 1400, 3000)
+    edges = np.vstack([boxes[:, [0, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]], boxes[:, [2, 1]], np.column_stack([boxes[:, 0], rng.uniform(boxes[:, 1], boxes[:, 3])])])
+    grid = [[boxes[:, 0].min(), boxes[:, 1].min()], [boxes[:, 2].max(), boxes[:, 3].max()], [np.nextafter(boxes[:, 2].max(), np.inf), boxes[:, 3].max()]]
+    points = np.vstack([np.column_stack([x, y]), edges, grid])
+    return boxes, points[:, 0], points[:, 1]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("options", [{}, {"cell_size": 7.3}, {"cell_size": 5000}, {"max_cells": 16}])
+def test_tile_router_matches_brute_force(seed, options):
+    boxes, x, y = router_case(seed)
+    router = TileRouter(boxes, **options)
+    points, candidates = router.route(x, y)
+    assert sorted(zip(candidates.tolist(), points.tolist())) == brute_route(boxes, x, y)
+    assert (np.diff(candidates) >= 0).all()
+    assert router.points == len(x) and router.assigned == len(points)
+
+
+def test_tile_router_groups_by_tile_id():
+    boxes, x, y = router_case(3)
+    tile_ids = np.arange(len(boxes)) * 10 + 5
+    expected = {}
+    for box, point in brute_route(boxes, x, y):
+        expected.setdefault(int(tile_ids[box]), []).append(point)
+    groups = {int(tile_id): sorted(points.tolist()) for tile_id, points in TileRouter(boxes, tile_ids).groups(x, y)}
+    assert groups == expected
+
+
+def test_tile_router_without_boxes():
+    points, candidates = TileRouter(np.empty((0, 4))).route([1.0, 2.0], [3.0, 4.0])
+    assert len(points) == len(candidates) == 0
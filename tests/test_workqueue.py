@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import time
+
+import workqueue
+from workqueue import WorkQueue, work
+
+
+def execute(stage, args):
+    # Record every run of a task, and hang on the first run of a "hang" task until the worker is killed
+    with open(os.path.join(args["log"], f"{args['n']}.{os.getpid()}.{time.time_ns()}"), "w"):
+        pass
+    if stage == "hang" and not os.path.exists(args["marker"]):
+        open(args["marker"], "w").close()
+        time.sleep(60)
+    time.sleep(args.get("seconds", 0))
+    return args["n"] * 2
+
+
+def run_worker(path, name, max_workers=2):
+    workqueue.POLL_INTERVAL = 0.05
+    work(WorkQueue(path), execute, max_workers=max_workers, wait=0.5, worker=name)
+
+
+def start(path, name):
+    process = multiprocessing.Process(target=run_worker, args=(path, name))
+    process.start()
+    return process
+
+
+def runs(log):
+    # Number of runs of each task
+    counts = {}
+    for f in os.listdir(log):
+        n = int(f.split(".")[0])
+        counts[n] = counts.get(n, 0) + 1
+    return counts
+
+
+def test_workers_run_every_task_once(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"), lease_timeout=1)
+    log = tmp_path / "log"
+    log.mkdir()
+    tokens = {f"t{n}": queue.submit(f"t{n}", "double", {"n": n, "log": str(log), "seconds": 0.3 if n % 4 == 0 else 0.01}) for n in range(24)}
+
+    # Tasks of 0.3 s with a lease timeout of 1 s: the heartbeats keep the leases of running tasks
+    workers = [start(queue.path, f"w{i}") for i in range(3)]
+    results = dict(queue.wait(tokens, interval=0.05))
+    for process in workers:
+        process.join(30)
+        assert process.exitcode == 0
+
+    assert {task_id: done["result"] for task_id, done in results.items()} == {f"t{n}": n * 2 for n in range(24)}
+    assert runs(log) == {n: 1 for n in range(24)}
+    assert len({done["worker"] for done in results.values()}) > 1
+    assert queue.finished()
+
+
+def test_lease_of_a_killed_worker_is_reclaimed(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"), lease_timeout=1)
+    log = tmp_path / "log"
+    log.mkdir()
+    marker = tmp_path / "hung"
+    token = queue.submit("t0", "hang", {"n": 0, "log": str(log), "marker": str(marker)})
+
+    # The first worker hangs on the task and is killed while it holds the lease
+    first = start(queue.path, "first")
+    deadline = time.time() + 30
+    while not marker.exists() and time.time() < deadline:
+        time.sleep(0.05)
+    first.kill()
+    first.join()
+    assert queue.status()[0]["running"] == 1
+
+    # The lease is not touched anymore, so the second worker takes the task over after the lease timeout
+    killed = time.time()
+    second = start(queue.path, "second")
+    (task_id, done), = queue.wait({"t0": token}, interval=0.05)
+    second.join(30)
+    assert second.exitcode == 0
+    assert time.time() - killed >= 1
+    assert done["status"] == "done" and done["worker"] == "second" and done["result"] == 0
+    assert runs(log) == {0: 2}
+
+
+def test_lease_age_does_not_depend_on_the_clock_of_the_host(tmp_path, monkeypatch):
+    queue = WorkQueue(str(tmp_path / "queue"), lease_timeout=1)
+    queue.submit("t0", "double", {"n": 0})
+    assert queue.claim("a")["id"] == "t0"
+
+    # A host whose clock is an hour ahead does not see the lease as stale
+    now = time.time
+    monkeypatch.setattr(workqueue.time, "time", lambda: now() + 3600)
+    assert queue.lease_age("t0") < 1
+    assert queue.claim("b") is None
+    assert queue.status()[0]["running"] == 1